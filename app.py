@@ -1,34 +1,87 @@
-from flask import Flask, jsonify, request, render_template
+from flask import Flask, Response, g, jsonify, request, render_template
 from backend.register import register_user
 from backend.profile import profile_bp
-from backend.preferences import get_preferences, save_preferences
+from backend.preferences import save_preferences
+from backend.catalogue import catalogue_bp, catalogue_index
 from recommendations.hybrid import HybridRecommender
 from recommendations.cold_start import ColdStartRecommender
-from backend.user_check import is_new_user
+from recommendations.batch import BatchRecommender, PrecomputedRecommendations
+from recommendations.context import UserContext
+import hmac
 import logging
 import os
+import signal
+import threading
+import time
 from dotenv import load_dotenv
-from recommendations.utils import Neo4jConnection
+from recommendations.utils import get_connection
+from recommendations.cache import create_recommendation_cache
+from recommendations.factor_model import list_versions
+from recommendations.metrics import CONTENT_TYPE, HTTP_SECONDS, REGISTRY, stage, track_connection
 
 # Load environment variables from .env file
 load_dotenv()
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
+# Configure logging; DEBUG adds per-request detail, per-stage timings are on /metrics
+logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO').upper())
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 app.register_blueprint(profile_bp)
+# Paginated, prefix-searchable titles and tags for the preferences page
+app.register_blueprint(catalogue_bp)
 
-# Neo4j connection
-uri = os.getenv('NEO4J_URI')
-username = os.getenv('NEO4J_USERNAME')
-password = os.getenv('NEO4J_PASSWORD')
-database = os.getenv('NEO4J_DATABASE')
-connection = Neo4jConnection(uri, username, password)
+# Neo4j connection, shared with the backend modules
+connection = get_connection()
+track_connection(connection)
 
-hybrid_recommender = HybridRecommender(connection)
-cold_start_recommender = ColdStartRecommender(connection)
+@app.before_request
+def start_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_request(response):
+    start = g.pop('request_start', None)
+    if start is not None:
+        endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        HTTP_SECONDS.observe(time.perf_counter() - start, endpoint, request.method, str(response.status_code))
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
+
+hybrid_latency_budget = os.getenv('HYBRID_LATENCY_BUDGET')
+hybrid_recommender = HybridRecommender(
+    connection,
+    max_workers=int(os.getenv('HYBRID_WORKERS', 0)) or None,
+    latency_budget=float(hybrid_latency_budget) if hybrid_latency_budget else None,
+)
+cold_start_recommender = ColdStartRecommender(connection, ttl=float(os.getenv('COLD_START_TTL', 300)))
+cold_start_recommender.start_refresher()
+recommendation_cache = create_recommendation_cache()
+batch_recommender = BatchRecommender(hybrid_recommender, cold_start_recommender)
+max_batch_size = int(os.getenv('RECOMMENDATION_BATCH_MAX', 500))
+
+# Lists written by `python -m recommendations.batch`, served ahead of the online recommenders
+# for PRECOMPUTED_TTL seconds (default a day) after the job computed them.
+precomputed_path = os.getenv('PRECOMPUTED_RECOMMENDATIONS')
+precomputed = (PrecomputedRecommendations.load(precomputed_path, float(os.getenv('PRECOMPUTED_TTL', 86400)))
+               if precomputed_path and os.path.exists(precomputed_path) else None)
+
+# New factor model versions from `python -m recommendations.train` are swapped in without a restart:
+# by polling `CURRENT` every MF_MODEL_WATCH_INTERVAL seconds, on SIGHUP, or through /admin/reload-model.
+collaborative_filtering = hybrid_recommender.collaborative_filtering
+model_watch_interval = float(os.getenv('MF_MODEL_WATCH_INTERVAL', 0))
+if model_watch_interval > 0:
+    collaborative_filtering.start_model_watcher(model_watch_interval)
+admin_token = os.getenv('ADMIN_TOKEN')
+
+def reload_model_in_background(signum=None, frame=None):
+    threading.Thread(target=collaborative_filtering.reload_model, name="model-reload", daemon=True).start()
+
+if hasattr(signal, 'SIGHUP') and threading.current_thread() is threading.main_thread():
+    signal.signal(signal.SIGHUP, reload_model_in_background)
 
 @app.route('/')
 def home():
@@ -46,6 +99,7 @@ def register():
     
     try:
         register_user(user_id, name, email)
+        recommendation_cache.invalidate(int(user_id))
         logger.info(f"User {user_id} registered successfully in the database.")
         return jsonify({"message": "User registered successfully!"}), 201
     except Exception as e:
@@ -57,17 +111,57 @@ def recommendations():
     user_id = request.args.get('user_id')
     try:
         logger.debug(f"Getting recommendations for user {user_id}")
-        if is_new_user(connection, int(user_id)):
-            logger.info(f"User {user_id} is new.")
-            recommendations = cold_start_recommender.recommend_for_new_user()
-            return jsonify({"is_new_user": True, "recommendations": recommendations}), 200
-        else:
-            recommendations = hybrid_recommender.recommend_for_existing_user(int(user_id))
-            return jsonify({"is_new_user": False, "recommendations": recommendations}), 200
+        # Degraded results are served but not cached, so the next request retries the late branches.
+        response = recommendation_cache.get_or_compute(
+            int(user_id), 'recommendations', lambda: compute_recommendations(int(user_id)),
+            store_if=lambda response: not response.get("degraded"),
+        )
+        return jsonify(response), 200
     except Exception as e:
         logger.error(f"Error getting recommendations for user {user_id}: {e}")
         return jsonify({"error": str(e)}), 500
 
+def compute_recommendations(user_id):
+    precomputed_recs = precomputed_recommendations(user_id)
+    if precomputed_recs is not None:
+        return {"is_new_user": False, "recommendations": precomputed_recs, "precomputed": True}
+    # One loader per request: the new-user check and both branches share its reads.
+    context = UserContext(connection, user_id)
+    with stage("is_new_user"):
+        is_new = context.is_new_user()
+    if is_new:
+        logger.info(f"User {user_id} is new.")
+        recommendations = cold_start_recommender.recommend_for_new_user()
+        return {"is_new_user": True, "recommendations": recommendations}
+    result = hybrid_recommender.recommend_within_budget(user_id, context=context)
+    return {
+        "is_new_user": False,
+        "recommendations": result["recommendations"],
+        "degraded": result["degraded"],
+        "timings": result["timings"],
+    }
+
+def precomputed_recommendations(user_id):
+    if precomputed is None:
+        return None
+    # Lists of users whose cache version moved on, in any worker, are stale.
+    return precomputed.with_details(user_id, hybrid_recommender.content_based_filtering.genre_index,
+                                    recommendation_cache.version(user_id))
+
+@app.route('/recommendations/batch', methods=['POST'])
+def recommendations_batch():
+    data = request.get_json()
+    user_ids = data.get('userIds', [])
+    limit = int(data.get('limit', 12))
+    if len(user_ids) > max_batch_size:
+        return jsonify({"error": f"At most {max_batch_size} users per batch."}), 400
+    try:
+        logger.debug(f"Getting recommendations for a batch of {len(user_ids)} users")
+        return jsonify({"results": batch_recommender.recommend_many(user_ids, limit)}), 200
+    except Exception as e:
+        logger.error(f"Error getting batch recommendations: {e}")
+        return jsonify({"error": str(e)}), 500
+
 @app.route('/recommendations_page', methods=['GET'])
 def recommendations_page():
     user_id = request.args.get('user_id')
@@ -80,15 +174,6 @@ def user_preferences_page():
     logger.debug("Rendering user preferences page")
     return render_template('user_preferences.html')
 
-@app.route('/preferences', methods=['GET'])
-def preferences():
-    try:
-        preferences_data = get_preferences()
-        return jsonify(preferences_data), 200
-    except Exception as e:
-        logger.error(f"Error fetching preferences: {e}")
-        return jsonify({"error": str(e)}), 500
-
 @app.route('/preferences', methods=['POST'])
 def update_preferences():
     data = request.get_json()
@@ -96,15 +181,35 @@ def update_preferences():
     ratings = data.get('ratings', [])
     tags = data.get('tags', [])
 
-    logger.debug(f"Received preferences for user {user_id}: ratings={ratings}, tags={tags}")
+    logger.debug(f"Received preferences for user {user_id}: {len(ratings)} ratings, {len(tags)} tags")
     
     try:
-        save_preferences(user_id, ratings, tags)
-        return jsonify({"message": "Preferences updated successfully!"}), 200
+        saved = save_preferences(user_id, ratings, tags)
+        catalogue_index.add_tags(tag['tag'] for tag in tags)
+        hybrid_recommender.collaborative_filtering.refresh_user(int(user_id))
+        recommendation_cache.invalidate(int(user_id))
+        return jsonify({"message": "Preferences updated successfully!", "unresolved": saved["unresolved"]}), 200
     except Exception as e:
         logger.error(f"Error saving preferences for user {user_id}: {e}")
         return jsonify({"error": str(e)}), 500
 
+@app.route('/admin/reload-model', methods=['POST'])
+def reload_model():
+    # Without ADMIN_TOKEN the endpoint is disabled rather than open.
+    if not admin_token:
+        return jsonify({"error": "Not found"}), 404
+    if not hmac.compare_digest(request.headers.get('X-Admin-Token', ''), admin_token):
+        return jsonify({"error": "Forbidden"}), 403
+    version = (request.get_json(silent=True) or {}).get('version')
+    if version is not None and version not in list_versions():
+        return jsonify({"error": f"Unknown model version: {version}"}), 400
+    try:
+        reloaded = collaborative_filtering.reload_model(version)
+        return jsonify({"reloaded": reloaded, "version": collaborative_filtering.factors.version}), 200
+    except Exception as e:
+        logger.error(f"Error reloading the factor model: {e}")
+        return jsonify({"error": str(e)}), 500
+
 if __name__ == '__main__':
     logger.debug("Starting Flask application")
     app.run(debug=True, port=5001)
\ No newline at end of file
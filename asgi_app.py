@@ -0,0 +1,261 @@
+from quart import Quart, Response, g, jsonify, request, render_template
+from backend.register import register_user_async
+from backend.profile import fetch_profile_async, profile_response
+from backend.preferences import save_preferences_async
+from backend.catalogue import catalogue_index, catalogue_response, page_arguments
+from recommendations.hybrid import HybridRecommender
+from recommendations.async_recommender import AsyncHybridRecommender
+from recommendations.cold_start import ColdStartRecommender
+from recommendations.batch import BatchRecommender, PrecomputedRecommendations
+from backend.user_check import is_new_user_async
+import asyncio
+import hmac
+import logging
+import os
+import time
+from dotenv import load_dotenv
+from recommendations.utils import AsyncNeo4jConnection, connection_settings, get_connection
+from recommendations.cache import create_recommendation_cache
+from recommendations.factor_model import list_versions
+from recommendations.metrics import CONTENT_TYPE, HTTP_SECONDS, REGISTRY, stage, track_connection
+
+# Async serving mode: the endpoints and JSON responses of app.py, served by an ASGI server
+# (e.g. `hypercorn asgi_app:app`). Requires the quart package and neo4j 5 or later.
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Configure logging
+logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO').upper())
+logger = logging.getLogger(__name__)
+
+app = Quart(__name__)
+
+# In-memory models and indexes load through the shared blocking connection, off the event loop.
+connection = get_connection()
+track_connection(connection)
+
+hybrid_latency_budget = os.getenv('HYBRID_LATENCY_BUDGET')
+hybrid_recommender = HybridRecommender(connection)
+cold_start_recommender = ColdStartRecommender(connection, ttl=float(os.getenv('COLD_START_TTL', 300)))
+cold_start_recommender.start_refresher()
+recommendation_cache = create_recommendation_cache()
+batch_recommender = BatchRecommender(hybrid_recommender, cold_start_recommender)
+max_batch_size = int(os.getenv('RECOMMENDATION_BATCH_MAX', 500))
+
+# Lists written by `python -m recommendations.batch`, served ahead of the online recommenders
+# for PRECOMPUTED_TTL seconds (default a day) after the job computed them.
+precomputed_path = os.getenv('PRECOMPUTED_RECOMMENDATIONS')
+precomputed = (PrecomputedRecommendations.load(precomputed_path, float(os.getenv('PRECOMPUTED_TTL', 86400)))
+               if precomputed_path and os.path.exists(precomputed_path) else None)
+
+# New factor model versions are swapped in by polling `CURRENT` or through /admin/reload-model.
+collaborative_filtering = hybrid_recommender.collaborative_filtering
+model_watch_interval = float(os.getenv('MF_MODEL_WATCH_INTERVAL', 0))
+if model_watch_interval > 0:
+    collaborative_filtering.start_model_watcher(model_watch_interval)
+admin_token = os.getenv('ADMIN_TOKEN')
+
+# Request-path reads go through the async driver, created once the event loop is running.
+async_connection = None
+async_recommender = None
+
+@app.before_serving
+async def open_async_connection():
+    global async_connection, async_recommender
+    async_connection = AsyncNeo4jConnection(**connection_settings())
+    track_connection(async_connection, 'async')
+    async_recommender = AsyncHybridRecommender(
+        hybrid_recommender, async_connection,
+        latency_budget=float(hybrid_latency_budget) if hybrid_latency_budget else None,
+    )
+
+@app.after_serving
+async def close_async_connection():
+    cold_start_recommender.stop_refresher()
+    collaborative_filtering.stop_model_watcher()
+    await async_connection.close()
+
+@app.before_request
+async def start_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+async def record_request(response):
+    start = getattr(g, 'request_start', None)
+    if start is not None:
+        endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        HTTP_SECONDS.observe(time.perf_counter() - start, endpoint, request.method, str(response.status_code))
+    return response
+
+@app.route('/metrics', methods=['GET'])
+async def metrics():
+    return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
+
+@app.route('/')
+async def home():
+    return await render_template('index.html')
+
+@app.route('/register', methods=['POST'])
+async def register():
+    data = await request.get_json()
+    user_id = data['userId']
+    name = data['name']
+    email = data['email']
+
+    logger.info(f"Received registration for userId: {user_id}, name: {name}, email: {email}")
+
+    try:
+        await register_user_async(async_connection, user_id, name, email)
+        recommendation_cache.invalidate(int(user_id))
+        return jsonify({"message": "User registered successfully!"}), 201
+    except Exception as e:
+        logger.error(f"Error registering user {user_id}: {e}")
+        return jsonify({"message": "Failed to register user."}), 500
+
+@app.route('/recommendations', methods=['GET'])
+async def recommendations():
+    user_id = request.args.get('user_id')
+    try:
+        # Degraded results are served but not cached, so the next request retries the late branches.
+        response = await recommendation_cache.get_or_compute_async(
+            int(user_id), 'recommendations', lambda: compute_recommendations(int(user_id)),
+            store_if=lambda response: not response.get("degraded"),
+        )
+        return jsonify(response), 200
+    except Exception as e:
+        logger.error(f"Error getting recommendations for user {user_id}: {e}")
+        return jsonify({"error": str(e)}), 500
+
+async def compute_recommendations(user_id):
+    if precomputed is not None:
+        # Lists of users whose cache version moved on, in any worker, are stale.
+        precomputed_recs = await asyncio.to_thread(
+            precomputed.with_details, user_id, hybrid_recommender.content_based_filtering.genre_index,
+            recommendation_cache.version(user_id))
+        if precomputed_recs is not None:
+            return {"is_new_user": False, "recommendations": precomputed_recs, "precomputed": True}
+    with stage("is_new_user"):
+        is_new = await is_new_user_async(async_connection, user_id)
+    if is_new:
+        logger.info(f"User {user_id} is new.")
+        recommendations = await asyncio.to_thread(cold_start_recommender.recommend_for_new_user)
+        return {"is_new_user": True, "recommendations": recommendations}
+    result = await async_recommender.recommend_within_budget(user_id)
+    return {
+        "is_new_user": False,
+        "recommendations": result["recommendations"],
+        "degraded": result["degraded"],
+        "timings": result["timings"],
+    }
+
+@app.route('/recommendations/batch', methods=['POST'])
+async def recommendations_batch():
+    data = await request.get_json()
+    user_ids = data.get('userIds', [])
+    limit = int(data.get('limit', 12))
+    if len(user_ids) > max_batch_size:
+        return jsonify({"error": f"At most {max_batch_size} users per batch."}), 400
+    try:
+        # Batches share reads through the blocking connection, off the event loop.
+        results = await asyncio.to_thread(batch_recommender.recommend_many, user_ids, limit)
+        return jsonify({"results": results}), 200
+    except Exception as e:
+        logger.error(f"Error getting batch recommendations: {e}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/recommendations_page', methods=['GET'])
+async def recommendations_page():
+    user_id = request.args.get('user_id')
+    is_new = request.args.get('is_new') == 'true'
+    return await render_template('recommendations.html', user_id=user_id, is_new=is_new)
+
+@app.route('/user_preferences', methods=['GET'])
+async def user_preferences_page():
+    return await render_template('user_preferences.html')
+
+async def catalogue_page(kind):
+    # Loading or reloading the catalogue reads the graph through the blocking connection, off the event loop.
+    await asyncio.to_thread(catalogue_index.refresh_if_stale, connection)
+    try:
+        page = getattr(catalogue_index, kind)(*page_arguments(request.args))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    body, headers = catalogue_response(page, request.if_none_match)
+    if body is None:
+        return Response('', status=304, headers=headers)
+    return jsonify(body), 200, headers
+
+@app.route('/catalogue/movies', methods=['GET'])
+async def catalogue_movies():
+    try:
+        return await catalogue_page("movies")
+    except Exception as e:
+        logger.error(f"Error fetching catalogue movies: {e}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/catalogue/tags', methods=['GET'])
+async def catalogue_tags():
+    try:
+        return await catalogue_page("tags")
+    except Exception as e:
+        logger.error(f"Error fetching catalogue tags: {e}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/preferences', methods=['POST'])
+async def update_preferences():
+    data = await request.get_json()
+    user_id = data['userId']
+    ratings = data.get('ratings', [])
+    tags = data.get('tags', [])
+
+    try:
+        saved = await save_preferences_async(async_connection, user_id, ratings, tags)
+        catalogue_index.add_tags(tag['tag'] for tag in tags)
+        await async_recommender.refresh_user(int(user_id))
+        recommendation_cache.invalidate(int(user_id))
+        return jsonify({"message": "Preferences updated successfully!", "unresolved": saved["unresolved"]}), 200
+    except Exception as e:
+        logger.error(f"Error saving preferences for user {user_id}: {e}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/profile/', methods=['GET'])
+async def profile_page():
+    return await render_template('profile.html')
+
+@app.route('/profile/<int:user_id>', methods=['GET'])
+async def get_profile(user_id):
+    try:
+        profile_data = await fetch_profile_async(async_connection, user_id, request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error fetching profile for user {user_id}: {e}")
+        return jsonify({"error": str(e)}), 500
+    if profile_data is None:
+        return jsonify({"error": "User not found"}), 404
+    body, headers = profile_response(profile_data, request.if_none_match)
+    if body is None:
+        return Response('', status=304, headers=headers)
+    return jsonify(body), 200, headers
+
+@app.route('/admin/reload-model', methods=['POST'])
+async def reload_model():
+    # Without ADMIN_TOKEN the endpoint is disabled rather than open.
+    if not admin_token:
+        return jsonify({"error": "Not found"}), 404
+    if not hmac.compare_digest(request.headers.get('X-Admin-Token', ''), admin_token):
+        return jsonify({"error": "Forbidden"}), 403
+    version = ((await request.get_json(silent=True)) or {}).get('version')
+    if version is not None and version not in list_versions():
+        return jsonify({"error": f"Unknown model version: {version}"}), 400
+    try:
+        # Loading the arrays and building the ANN index runs off the event loop.
+        reloaded = await asyncio.to_thread(collaborative_filtering.reload_model, version)
+        return jsonify({"reloaded": reloaded, "version": collaborative_filtering.factors.version}), 200
+    except Exception as e:
+        logger.error(f"Error reloading the factor model: {e}")
+        return jsonify({"error": str(e)}), 500
+
+if __name__ == '__main__':
+    app.run(port=5001)
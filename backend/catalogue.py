@@ -0,0 +1,229 @@
+import bisect
+import hashlib
+import logging
+import threading
+import time
+from flask import Blueprint, Response, jsonify, request
+from dotenv import load_dotenv
+from backend.pagination import conditional, decode_cursor, encode_cursor, parse_limit
+from recommendations.utils import READ_ACCESS, get_catalogue_version, get_connection
+
+# Load environment variables from .env file
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+catalogue_bp = Blueprint('catalogue', __name__)
+
+CATALOGUE_MOVIES = "MATCH (m:Movie) RETURN m.movieId AS movieId, m.title AS title, m.genres AS genres"
+CATALOGUE_TAGS = "MATCH ()-[t:TAGGED]->() WHERE t.tag IS NOT NULL RETURN DISTINCT t.tag AS tag"
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+# Browsers and proxies may keep a page but must revalidate it with its ETag before reuse.
+CACHE_CONTROL = "public, no-cache"
+
+
+def _key(text):
+    return " ".join(str(text).split()).casefold()
+
+
+class _SortedEntries:
+    """
+    Immutable, case-insensitively sorted entries, searched by prefix with bisect.
+
+    Entries are ordered by (key, tiebreak), where the tiebreak makes every position unique,
+    so a page cursor is the sort position of the last entry returned and stays valid when
+    entries are added or removed between pages.
+    """
+
+    def __init__(self, entries):
+        """
+        :param entries: Iterable of tuples (key, tiebreak, item)
+        """
+        entries = sorted(entries, key=lambda entry: entry[:2])
+        self.positions = [entry[:2] for entry in entries]
+        self.items = [entry[2] for entry in entries]
+        digest = hashlib.blake2b(digest_size=8)
+        for position in self.positions:
+            digest.update(repr(position).encode())
+            digest.update(b"\0")
+        # Identical contents give identical digests, so every worker derives the same ETags.
+        self.digest = digest.hexdigest()
+
+    def __len__(self):
+        return len(self.items)
+
+    def page(self, prefix="", after=None, limit=DEFAULT_PAGE_SIZE):
+        """
+        :param prefix: Case-insensitive prefix of the entries to return
+        :param after: Sort position of the last entry of the previous page
+        :param limit: Number of entries to return
+        :return: Tuple (items, sort position to continue after or None on the last page)
+        """
+        prefix = _key(prefix)
+        start = bisect.bisect_left(self.positions, (prefix,))
+        end = bisect.bisect_left(self.positions, (prefix + "\U0010ffff",)) if prefix else len(self.positions)
+        if after is not None:
+            start = max(start, bisect.bisect_right(self.positions, after))
+        stop = min(start + limit, end)
+        following = self.positions[stop - 1] if stop < end else None
+        return self.items[start:stop], following
+
+
+class CatalogueIndex:
+    """
+    In-process movie titles and tag vocabulary for the preferences page.
+
+    Titles and tags are read from the graph once, kept sorted, and served in pages by
+    prefix, so a typeahead request costs two bisects instead of a query. Like the genre
+    index, the catalogue reloads when its version in the graph changes; tags saved through
+    this process are added right away.
+    """
+
+    def __init__(self, check_interval=30.0):
+        """
+        :param check_interval: Minimum seconds between catalogue version checks
+        """
+        self.check_interval = check_interval
+        self.version = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        self._movies = _SortedEntries([])
+        self._tags = _SortedEntries([])
+
+    def reload(self, connection):
+        """
+        Replace the indexed titles and tags with the ones currently in the graph.
+        """
+        version = get_catalogue_version(connection)
+        movies = connection.query(CATALOGUE_MOVIES, access_mode=READ_ACCESS) or []
+        tags = connection.query(CATALOGUE_TAGS, access_mode=READ_ACCESS) or []
+        movie_entries = _SortedEntries(
+            (_key(record["title"]), record["movieId"],
+             {"movieId": record["movieId"], "title": record["title"], "genres": record["genres"]})
+            for record in movies if record["title"] is not None
+        )
+        tag_entries = _tag_entries(record["tag"] for record in tags)
+        with self._lock:
+            self._movies, self._tags = movie_entries, tag_entries
+            self.version = version
+            self._checked_at = time.monotonic()
+        logger.info(f"Catalogue loaded: {len(movie_entries)} movies, {len(tag_entries)} tags, "
+                    f"catalogue version {version}.")
+
+    def refresh_if_stale(self, connection):
+        """
+        Load the catalogue on first use, then reload it if its version changed, checking at
+        most every `check_interval` seconds.
+        """
+        if self.version is None:
+            self.reload(connection)
+            return
+        if time.monotonic() - self._checked_at < self.check_interval:
+            return
+        self._checked_at = time.monotonic()
+        if get_catalogue_version(connection) != self.version:
+            self.reload(connection)
+
+    def add_tags(self, tags):
+        """
+        Add tags submitted from the preferences form; known tags are ignored.
+
+        :param tags: Iterable of tag strings
+        """
+        with self._lock:
+            known = set(self._tags.items)
+            new = {tag for tag in tags if tag and tag not in known}
+            if new:
+                self._tags = _tag_entries(known | new)
+        if new:
+            logger.debug(f"Added {len(new)} tags to the catalogue")
+
+    def movies(self, prefix="", cursor=None, limit=DEFAULT_PAGE_SIZE):
+        """
+        One page of movies whose title starts with a prefix, in title order.
+
+        :return: Dictionary with items (movieId, title and genres), next cursor and ETag
+        """
+        return self._page("movies", self._movies, prefix, cursor, limit, int)
+
+    def tags(self, prefix="", cursor=None, limit=DEFAULT_PAGE_SIZE):
+        """
+        One page of tags starting with a prefix, in alphabetical order.
+
+        :return: Dictionary with items (tag strings), next cursor and ETag
+        """
+        return self._page("tags", self._tags, prefix, cursor, limit, str)
+
+    def _page(self, kind, entries, prefix, cursor, limit, tiebreak_type):
+        """
+        :raises ValueError: On an invalid cursor or limit
+        """
+        limit = parse_limit(limit, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE)
+        after = decode_cursor(cursor, str, tiebreak_type) if cursor else None
+        items, following = entries.page(prefix, after, limit)
+        # A page is fully determined by the contents and the request, so its ETag is known
+        # before anything is serialized and a revalidation costs no JSON encoding.
+        request_key = f"{kind}\0{entries.digest}\0{_key(prefix)}\0{cursor or ''}\0{limit}"
+        return {
+            "items": items,
+            "next": encode_cursor(following) if following is not None else None,
+            "etag": hashlib.blake2b(request_key.encode(), digest_size=12).hexdigest(),
+        }
+
+
+def _tag_entries(tags):
+    return _SortedEntries((_key(tag), tag, tag) for tag in tags if tag)
+
+
+catalogue_index = CatalogueIndex()
+
+
+def page_arguments(args):
+    """
+    Prefix, cursor and limit of a catalogue request from its query string.
+    """
+    return args.get('prefix', ''), args.get('cursor') or None, args.get('limit', DEFAULT_PAGE_SIZE)
+
+
+def catalogue_response(page, if_none_match):
+    """
+    JSON response of a catalogue page, or 304 Not Modified if the client holds its ETag.
+
+    :param page: Page dictionary from CatalogueIndex
+    :param if_none_match: ETags of the request's If-None-Match header
+    :return: Tuple (body or None, headers); a None body means 304
+    """
+    return conditional({"items": page["items"], "next": page["next"]}, page["etag"], if_none_match, CACHE_CONTROL)
+
+
+def serve_page(kind):
+    catalogue_index.refresh_if_stale(get_connection())
+    try:
+        page = getattr(catalogue_index, kind)(*page_arguments(request.args))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    body, headers = catalogue_response(page, request.if_none_match)
+    if body is None:
+        return Response(status=304, headers=headers)
+    return jsonify(body), 200, headers
+
+
+@catalogue_bp.route('/catalogue/movies', methods=['GET'])
+def catalogue_movies():
+    try:
+        return serve_page("movies")
+    except Exception as e:
+        logger.error(f"Error fetching catalogue movies: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+@catalogue_bp.route('/catalogue/tags', methods=['GET'])
+def catalogue_tags():
+    try:
+        return serve_page("tags")
+    except Exception as e:
+        logger.error(f"Error fetching catalogue tags: {e}")
+        return jsonify({"error": str(e)}), 500
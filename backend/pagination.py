@@ -0,0 +1,62 @@
+import base64
+import hashlib
+import json
+
+
+def encode_cursor(position):
+    """
+    Opaque, URL-safe cursor for the sort position of the last item of a page.
+
+    :param position: Tuple or list of JSON-serializable sort values
+    """
+    return base64.urlsafe_b64encode(json.dumps(list(position), separators=(",", ":")).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor, *types):
+    """
+    :param cursor: Cursor produced by encode_cursor
+    :param types: Expected type of every sort value of the position
+    :return: Tuple of the sort values
+    :raises ValueError: If the cursor was not produced by encode_cursor for such a position
+    """
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except Exception:
+        raise ValueError(f"Invalid cursor: {cursor!r}")
+    if (not isinstance(position, list) or len(position) != len(types)
+            or not all(isinstance(value, kind) and not isinstance(value, bool) for value, kind in zip(position, types))):
+        raise ValueError(f"Invalid cursor: {cursor!r}")
+    return tuple(position)
+
+
+def parse_limit(value, default, maximum, minimum=1):
+    """
+    :raises ValueError: If the limit is not an integer between minimum and maximum
+    """
+    limit = int(value) if value not in (None, '') else default
+    if not minimum <= limit <= maximum:
+        raise ValueError(f"limit must be between {minimum} and {maximum}")
+    return limit
+
+
+def body_etag(body):
+    """
+    ETag of a JSON body, identical in every worker for identical contents.
+    """
+    return hashlib.blake2b(json.dumps(body, sort_keys=True, separators=(",", ":")).encode(), digest_size=12).hexdigest()
+
+
+def conditional(body, etag, if_none_match, cache_control):
+    """
+    Body and headers of a conditional GET.
+
+    :param body: Response body
+    :param etag: ETag of the body, unquoted
+    :param if_none_match: ETags of the request's If-None-Match header
+    :param cache_control: Cache-Control header value
+    :return: Tuple (body or None, headers); a None body means 304 Not Modified
+    """
+    headers = {"ETag": f'"{etag}"', "Cache-Control": cache_control}
+    if if_none_match.contains(etag):
+        return None, headers
+    return body, headers
@@ -1,7 +1,7 @@
 import logging
-from neo4j import GraphDatabase
 from dotenv import load_dotenv
-import os
+from recommendations.utils import get_connection
+from recommendations.movie_stats import rating_delta
 
 # Load environment variables from .env file
 load_dotenv()
@@ -10,67 +10,123 @@ load_dotenv()
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
-# Neo4j connection (update with your credentials)
-uri = os.getenv('NEO4J_URI')
-username = os.getenv('NEO4J_USERNAME')
-password = os.getenv('NEO4J_PASSWORD')
-database = os.getenv('NEO4J_DATABASE')
+RESOLVE_TITLES = """
+UNWIND $titles AS title
+MATCH (m:Movie {title: title})
+RETURN title, min(m.movieId) AS movieId
+"""
 
-logger.info(f"Connecting to Neo4j at {uri} with user {username}")
+WRITE_RATINGS = """
+MATCH (u:User {userId: $user_id})
+// Marks the user's SIMILAR edges as stale until the similarity job next runs.
+SET u.ratingsChangedAt = timestamp() / 1000
+WITH u
+UNWIND $rows AS row
+MATCH (m:Movie {movieId: row.movieId})
+MERGE (u)-[r:RATED]->(m)
+WITH m, r, r.rating AS old_rating, row.rating AS rating
+// Unix seconds, as in the MovieLens files; an unchanged rating keeps its time.
+SET r.rating = rating,
+    r.timestamp = CASE WHEN old_rating = rating THEN r.timestamp ELSE timestamp() / 1000 END
+WITH m, old_rating, rating
+WHERE old_rating IS NULL OR old_rating <> rating
+""" + rating_delta('m', 'old_rating', 'rating')
 
-driver = GraphDatabase.driver(uri, auth=(username, password))
+WRITE_TAGS = """
+MATCH (u:User {userId: $user_id})
+UNWIND $rows AS row
+MATCH (m:Movie {movieId: row.movieId})
+MERGE (u)-[t:TAGGED]->(m)
+SET t.timestamp = CASE WHEN t.tag = row.tag THEN t.timestamp ELSE timestamp() / 1000 END,
+    t.tag = row.tag
+"""
 
-def get_preferences():
-    logger.debug("Fetching preferences")
-    try:
-        with driver.session(database=database) as session:
-            # Fetch unique movie titles
-            movies_result = session.run("MATCH (m:Movie) RETURN DISTINCT m.title AS movie ORDER BY movie")
-            # Fetch unique tags
-            tags_result = session.run("MATCH (t:Tag) RETURN DISTINCT t.tag AS tag ORDER BY tag")
-
-            movies = [record["movie"] for record in movies_result]
-            tags = [record["tag"] for record in tags_result]
-
-            preferences_data = {
-                "movies": movies,
-                "tags": tags
-            }
-            logger.debug(f"Preferences data: {preferences_data}")
-            return preferences_data
-    except Exception as e:
-        logger.error(f"Error fetching preferences: {e}")
-        raise e
+def write_preferences(tx, user_id, ratings, tags):
+    """
+    Resolve movie titles and write all ratings and tags of a user in one transaction.
+
+    Titles are looked up through the Movie.title index; a title naming several movies
+    resolves to the lowest movieId.
+
+    :param tx: Neo4j transaction
+    :param user_id: User ID
+    :param ratings: Dictionary of title -> rating
+    :param tags: Dictionary of title -> tag
+    :return: Titles that matched no movie
+    """
+    titles = sorted(set(ratings) | set(tags))
+    resolved = {record["title"]: record["movieId"] for record in tx.run(RESOLVE_TITLES, titles=titles)}
+    rating_rows, tag_rows = preference_rows(resolved, ratings, tags)
+    if rating_rows:
+        tx.run(WRITE_RATINGS, user_id=user_id, rows=rating_rows)
+    if tag_rows:
+        tx.run(WRITE_TAGS, user_id=user_id, rows=tag_rows)
+    return [title for title in titles if title not in resolved]
+
+async def write_preferences_async(tx, user_id, ratings, tags):
+    """
+    Async counterpart of write_preferences.
+    """
+    titles = sorted(set(ratings) | set(tags))
+    result = await tx.run(RESOLVE_TITLES, titles=titles)
+    resolved = {record["title"]: record["movieId"] async for record in result}
+    rating_rows, tag_rows = preference_rows(resolved, ratings, tags)
+    if rating_rows:
+        await (await tx.run(WRITE_RATINGS, user_id=user_id, rows=rating_rows)).consume()
+    if tag_rows:
+        await (await tx.run(WRITE_TAGS, user_id=user_id, rows=tag_rows)).consume()
+    return [title for title in titles if title not in resolved]
+
+def preference_rows(resolved, ratings, tags):
+    """
+    UNWIND rows for the ratings and tags whose titles resolved to a movieId.
+    """
+    rating_rows = [{"movieId": resolved[title], "rating": rating} for title, rating in ratings.items() if title in resolved]
+    tag_rows = [{"movieId": resolved[title], "tag": tag} for title, tag in tags.items() if title in resolved]
+    return rating_rows, tag_rows
 
 def save_preferences(user_id, ratings, tags):
-    logger.debug(f"Saving preferences for user {user_id}")
+    """
+    Save the ratings and tags submitted from the preferences form.
+
+    :param user_id: User ID
+    :param ratings: List of dictionaries with movie (title) and rating
+    :param tags: List of dictionaries with movie (title) and tag
+    :return: Dictionary with the number of ratings and tags submitted and the titles that did not resolve
+    """
+    logger.debug(f"Saving preferences for user {user_id}: {len(ratings)} ratings, {len(tags)} tags")
+    ratings_by_title, tags_by_title = by_title(ratings, tags)
     try:
-        with driver.session(database=database) as session:
-            for rating in ratings:
-                movie = rating['movie']
-                rating_value = int(rating['rating'])
-                logger.debug(f"Rating: user_id={user_id}, movie={movie}, rating={rating_value}")
-                session.run(
-                    """
-                    MATCH (u:User {userId: $user_id}), (m:Movie {title: $movie})
-                    MERGE (u)-[r:RATED]->(m)
-                    SET r.rating = $rating
-                    """,
-                    user_id=int(user_id), movie=movie, rating=rating_value
-                )
-            for tag in tags:
-                movie = tag['movie']
-                tag_value = tag['tag']
-                logger.debug(f"Tag: user_id={user_id}, movie={movie}, tag={tag_value}")
-                session.run(
-                    """
-                    MATCH (u:User {userId: $user_id}), (m:Movie {title: $movie})
-                    MERGE (u)-[t:TAGGED]->(m)
-                    SET t.tag = $tag
-                    """,
-                    user_id=int(user_id), movie=movie, tag=tag_value
-                )
-        logger.debug(f"Preferences saved for user {user_id}")
+        with get_connection().session() as session:
+            unresolved = session.execute_write(write_preferences, int(user_id), ratings_by_title, tags_by_title)
+        return saved_report(user_id, ratings_by_title, tags_by_title, unresolved)
     except Exception as e:
         logger.error(f"Error saving preferences for user {user_id}: {e}")
-        raise e
\ No newline at end of file
+        raise e
+
+async def save_preferences_async(connection, user_id, ratings, tags):
+    """
+    Async counterpart of save_preferences.
+
+    :param connection: AsyncNeo4jConnection instance
+    """
+    ratings_by_title, tags_by_title = by_title(ratings, tags)
+    async with connection.session() as session:
+        unresolved = await session.execute_write(write_preferences_async, int(user_id), ratings_by_title, tags_by_title)
+    return saved_report(user_id, ratings_by_title, tags_by_title, unresolved)
+
+def by_title(ratings, tags):
+    # A movie submitted twice keeps its last value.
+    ratings_by_title = {rating['movie']: int(rating['rating']) for rating in ratings}
+    tags_by_title = {tag['movie']: tag['tag'] for tag in tags}
+    return ratings_by_title, tags_by_title
+
+def saved_report(user_id, ratings_by_title, tags_by_title, unresolved):
+    if unresolved:
+        logger.warning(f"Unknown movie titles for user {user_id}: {unresolved}")
+    logger.debug(f"Preferences saved for user {user_id}")
+    return {
+        "ratings": len(ratings_by_title),
+        "tags": len(tags_by_title),
+        "unresolved": unresolved,
+    }
@@ -1,8 +1,8 @@
 import logging
-from neo4j import GraphDatabase
-from flask import Blueprint, jsonify, request, render_template
+from flask import Blueprint, Response, jsonify, request, render_template
 from dotenv import load_dotenv
-import os
+from backend.pagination import body_etag, conditional, decode_cursor, encode_cursor, parse_limit
+from recommendations.utils import READ_ACCESS, get_connection
 
 # Load environment variables from .env file
 load_dotenv()
@@ -11,16 +11,6 @@ load_dotenv()
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
-# Neo4j connection (update with your credentials)
-uri = os.getenv('NEO4J_URI')
-username = os.getenv('NEO4J_USERNAME')
-password = os.getenv('NEO4J_PASSWORD')
-database = os.getenv('NEO4J_DATABASE')
-
-logger.info(f"Connecting to Neo4j at {uri} with user {username}")
-
-driver = GraphDatabase.driver(uri, auth=(username, password))
-
 profile_bp = Blueprint('profile', __name__)
 
 @profile_bp.route('/profile/', methods=['GET'])
@@ -31,52 +21,141 @@ def profile_page():
 def get_profile(user_id):
     logger.debug(f"Fetching profile for user_id: {user_id}")
     try:
-        with driver.session(database=database) as session:
-            user_result = session.run(
-                "MATCH (u:User {userId: $user_id}) RETURN u.userId AS userId, u.name AS name, u.email AS email",
-                user_id=user_id
-            )
-            user = user_result.single()
-            if not user:
-                logger.debug(f"No user found with user_id: {user_id}")
-                return jsonify({"error": "User not found"}), 404
-
-            ratings_result = session.run(
-                "MATCH (u:User {userId: $user_id})-[r:RATED]->(m:Movie) RETURN m.title AS movie, r.rating AS rating",
-                user_id=user_id
-            )
-            tags_result = session.run(
-                "MATCH (u:User {userId: $user_id})-[t:TAGGED]->(m:Movie) RETURN m.title AS movie, t.tag AS tag",
-                user_id=user_id
-            )
-
-            ratings_dict = {}
-            for record in ratings_result:
-                movie = record["movie"]
-                rating = record["rating"]
-                if movie not in ratings_dict:
-                    ratings_dict[movie] = []
-                ratings_dict[movie].append(rating)
-
-            tags_dict = {}
-            for record in tags_result:
-                movie = record["movie"]
-                tag = record["tag"]
-                if movie not in tags_dict:
-                    tags_dict[movie] = []
-                tags_dict[movie].append(tag)
-
-            profile_data = {
-                "userId": user["userId"],
-                "name": user["name"],
-                "email": user["email"],
-                "ratings": [{"movie": movie, "rating": ratings[0]} for movie, ratings in ratings_dict.items()],
-                "tags": [{"movie": movie, "tag": tags[0]} for movie, tags in tags_dict.items()]
-            }
-
-            logger.debug(f"Profile data: {profile_data}")
-
-            return jsonify(profile_data), 200
+        profile_data = fetch_profile(get_connection(), user_id, request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         logger.error(f"Error fetching profile for user {user_id}: {e}")
-        return jsonify({"error": str(e)}), 500
\ No newline at end of file
+        return jsonify({"error": str(e)}), 500
+    if profile_data is None:
+        logger.debug(f"No user found with user_id: {user_id}")
+        return jsonify({"error": "User not found"}), 404
+    logger.debug(f"Profile of user {user_id}: {len(profile_data['ratings'])} of {profile_data['ratingCount']} ratings, "
+                 f"{len(profile_data['tags'])} of {profile_data['tagCount']} tags")
+    body, headers = profile_response(profile_data, request.if_none_match)
+    if body is None:
+        return Response(status=304, headers=headers)
+    return jsonify(body), 200, headers
+
+PROFILE_PAGE_SIZE = 20
+MAX_PROFILE_PAGE_SIZE = 100
+
+# The profile is private to its user; clients keep it but revalidate before reuse.
+CACHE_CONTROL = "private, no-cache"
+
+# The user, counts and one page each of ratings and tags, newest first, in one round trip.
+# Writes without a timestamp sort as the oldest. Pages continue strictly after the
+# (timestamp, movieId[, tag]) position of their cursor, so entries added meanwhile never
+# shift later pages.
+PROFILE_QUERY = """
+MATCH (u:User {userId: $user_id})
+CALL {
+    WITH u
+    MATCH (u)-[r:RATED]->(m:Movie)
+    WITH m, r, coalesce(r.timestamp, 0) AS ts
+    WHERE $ratings_fetch > 0 AND ($ratings_after IS NULL
+        OR ts < $ratings_after[0]
+        OR (ts = $ratings_after[0] AND m.movieId < $ratings_after[1]))
+    WITH m, r, ts
+    ORDER BY ts DESC, m.movieId DESC
+    LIMIT $ratings_fetch
+    RETURN collect({movieId: m.movieId, movie: m.title, rating: r.rating, timestamp: ts}) AS ratings
+}
+CALL {
+    WITH u
+    MATCH (u)-[t:TAGGED]->(m:Movie)
+    WITH m, t, coalesce(t.timestamp, 0) AS ts, coalesce(t.tag, '') AS tag
+    WHERE $tags_fetch > 0 AND ($tags_after IS NULL
+        OR ts < $tags_after[0]
+        OR (ts = $tags_after[0] AND (m.movieId < $tags_after[1]
+            OR (m.movieId = $tags_after[1] AND tag < $tags_after[2]))))
+    WITH m, tag, ts
+    ORDER BY ts DESC, m.movieId DESC, tag DESC
+    LIMIT $tags_fetch
+    RETURN collect({movieId: m.movieId, movie: m.title, tag: tag, timestamp: ts}) AS tags
+}
+RETURN u.userId AS userId, u.name AS name, u.email AS email,
+       size([(u)-[:RATED]->(:Movie) | 1]) AS rating_count,
+       size([(u)-[:TAGGED]->(:Movie) | 1]) AS tag_count,
+       ratings, tags
+"""
+
+def profile_parameters(user_id, args):
+    """
+    Query parameters of a profile page from a request's query string.
+
+    `limit` sets the size of both pages, `ratings_limit` and `tags_limit` override it per
+    list, and 0 leaves a list out, e.g. to page through ratings alone.
+
+    :raises ValueError: On an invalid limit or cursor
+    """
+    limit = parse_limit(args.get('limit'), PROFILE_PAGE_SIZE, MAX_PROFILE_PAGE_SIZE, minimum=0)
+    ratings_limit = parse_limit(args.get('ratings_limit'), limit, MAX_PROFILE_PAGE_SIZE, minimum=0)
+    tags_limit = parse_limit(args.get('tags_limit'), limit, MAX_PROFILE_PAGE_SIZE, minimum=0)
+    ratings_cursor = args.get('ratings_cursor')
+    tags_cursor = args.get('tags_cursor')
+    return {
+        "user_id": user_id,
+        # One extra row tells whether another page follows.
+        "ratings_fetch": ratings_limit + 1 if ratings_limit else 0,
+        "tags_fetch": tags_limit + 1 if tags_limit else 0,
+        "ratings_after": list(decode_cursor(ratings_cursor, int, int)) if ratings_cursor else None,
+        "tags_after": list(decode_cursor(tags_cursor, int, int, str)) if tags_cursor else None,
+    }
+
+def fetch_profile(connection, user_id, args):
+    """
+    One page of a user's profile.
+
+    :param connection: Neo4jConnection instance
+    :param user_id: User ID
+    :param args: Query string with the limits and cursors
+    :return: Profile dictionary, or None if the user does not exist
+    :raises ValueError: On an invalid limit or cursor
+    """
+    parameters = profile_parameters(user_id, args)
+    result = connection.query(PROFILE_QUERY, parameters=parameters, access_mode=READ_ACCESS)
+    return build_profile(result, parameters)
+
+async def fetch_profile_async(connection, user_id, args):
+    """
+    Async counterpart of fetch_profile.
+
+    :param connection: AsyncNeo4jConnection instance
+    """
+    parameters = profile_parameters(user_id, args)
+    result = await connection.query(PROFILE_QUERY, parameters=parameters, access_mode=READ_ACCESS)
+    return build_profile(result, parameters)
+
+def build_profile(result, parameters):
+    if not result:
+        return None
+    record = result[0]
+    ratings, ratings_next = page_of(record["ratings"], parameters["ratings_fetch"], ("timestamp", "movieId"))
+    tags, tags_next = page_of(record["tags"], parameters["tags_fetch"], ("timestamp", "movieId", "tag"))
+    return {
+        "userId": record["userId"],
+        "name": record["name"],
+        "email": record["email"],
+        "ratingCount": record["rating_count"],
+        "tagCount": record["tag_count"],
+        "ratings": ratings,
+        "tags": tags,
+        "next": {"ratings": ratings_next, "tags": tags_next},
+    }
+
+def page_of(rows, fetch, position):
+    """
+    :return: Tuple (the rows of the page, cursor of the next page or None)
+    """
+    rows = [dict(row) for row in rows]
+    if not fetch or len(rows) < fetch:
+        return rows, None
+    rows = rows[:fetch - 1]
+    return rows, encode_cursor(rows[-1][key] for key in position)
+
+def profile_response(profile, if_none_match):
+    """
+    Body and headers of a profile page; the body is None if the client's copy is current.
+    """
+    return conditional(profile, body_etag(profile), if_none_match, CACHE_CONTROL)
@@ -1,7 +1,6 @@
-import os
-from neo4j import GraphDatabase
 from dotenv import load_dotenv
 import logging
+from recommendations.utils import get_connection
 
 # Load environment variables from .env file
 load_dotenv()
@@ -10,30 +9,36 @@ load_dotenv()
 logging.basicConfig(filename='register.log', level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
-# Neo4j connection (update with your credentials)
-uri = os.getenv('NEO4J_URI')
-username = os.getenv('NEO4J_USERNAME')
-password = os.getenv('NEO4J_PASSWORD')
-database = os.getenv('NEO4J_DATABASE')
-
-logger.info(f"Connecting to Neo4j at {uri} with user {username}")
-
-driver = GraphDatabase.driver(uri, auth=(username, password))
+CREATE_USER = "CREATE (u:User {userId: $user_id, name: $name, email: $email})"
 
 def create_user(tx, user_id, name, email):
     logger.debug(f"Running CREATE (u:User {{userId: {user_id}, name: {name}, email: {email}}})")
-    result = tx.run("CREATE (u:User {userId: $user_id, name: $name, email: $email})",
-           user_id=int(user_id), name=name, email=email)
+    result = tx.run(CREATE_USER, user_id=int(user_id), name=name, email=email)
     summary = result.consume().counters
     logger.info(f"Transaction summary: {summary}")
 
 def register_user(user_id, name, email):
     logger.debug(f"Starting session to register user {user_id}")
-    with driver.session(database=database) as session:
+    with get_connection().session() as session:
         logger.debug(f"Executing create_user transaction for {user_id}")
         session.execute_write(create_user, user_id, name, email)
         logger.info(f"User {user_id} registered successfully with name: {name} and email: {email}")
 
+async def create_user_async(tx, user_id, name, email):
+    result = await tx.run(CREATE_USER, user_id=int(user_id), name=name, email=email)
+    summary = (await result.consume()).counters
+    logger.info(f"Transaction summary: {summary}")
+
+async def register_user_async(connection, user_id, name, email):
+    """
+    Async counterpart of register_user.
+
+    :param connection: AsyncNeo4jConnection instance
+    """
+    async with connection.session() as session:
+        await session.execute_write(create_user_async, user_id, name, email)
+        logger.info(f"User {user_id} registered successfully with name: {name} and email: {email}")
+
 if __name__ == '__main__':
     import sys
     logger.debug(f"Script started with arguments: {sys.argv}")
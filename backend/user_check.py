@@ -1,37 +1,59 @@
-from recommendations.utils import get_user_ratings
+import asyncio
+import logging
+from recommendations.utils import READ_ACCESS
 
-def is_new_user(connection, user_id):
-    # Check if user has ratings
-    query = """
-    MATCH (u:User {userId: $user_id})-[:RATED]->(m:Movie)
-    RETURN COUNT(*) AS rating_count
-    """
-    result = connection.query(query, parameters={"user_id": user_id})
-    rating_count = result[0]['rating_count']
-    print(f"User {user_id} rating count: {rating_count}")  # Debug log
+logger = logging.getLogger(__name__)
 
-    if rating_count > 0:
-        return False
+RATING_COUNT = """
+MATCH (u:User {userId: $user_id})-[:RATED]->(m:Movie)
+RETURN COUNT(*) AS rating_count
+"""
 
-    # Check if user has genres
-    query = """
-    MATCH (u:User {userId: $user_id})-[:LIKES]->(g:Genre)
-    RETURN COUNT(*) AS genre_count
-    """
-    result = connection.query(query, parameters={"user_id": user_id})
-    genre_count = result[0]['genre_count']
-    print(f"User {user_id} genre count: {genre_count}")  # Debug log
+GENRE_COUNT = """
+MATCH (u:User {userId: $user_id})-[:LIKES]->(g:Genre)
+RETURN COUNT(*) AS genre_count
+"""
+
+TAG_COUNT = """
+MATCH (u:User {userId: $user_id})-[:TAGGED]->(t:Tag)
+RETURN COUNT(*) AS tag_count
+"""
 
-    if genre_count > 0:
-        return False
+def find_new_users(connection, user_ids):
+    """
+    Batched new-user check for users already known to have no ratings.
 
-    # Check if user has tags
+    :param connection: Neo4jConnection instance
+    :param user_ids: User IDs without ratings
+    :return: Set of the user IDs that also have no liked genres or tags
+    """
+    if not user_ids:
+        return set()
     query = """
-    MATCH (u:User {userId: $user_id})-[:TAGGED]->(t:Tag)
-    RETURN COUNT(*) AS tag_count
+    UNWIND $user_ids AS user_id
+    OPTIONAL MATCH (u:User {userId: user_id})-[likes:LIKES]->(:Genre)
+    WITH user_id, count(likes) AS genres
+    OPTIONAL MATCH (u:User {userId: user_id})-[tagged:TAGGED]->(:Tag)
+    WITH user_id, genres, count(tagged) AS tags
+    WHERE genres = 0 AND tags = 0
+    RETURN user_id AS userId
     """
-    result = connection.query(query, parameters={"user_id": user_id})
-    tag_count = result[0]['tag_count']
-    print(f"User {user_id} tag count: {tag_count}")  # Debug log
+    result = connection.query(query, parameters={"user_ids": list(user_ids)}, access_mode=READ_ACCESS)
+    return {record["userId"] for record in result}
 
-    return tag_count == 0
\ No newline at end of file
+async def is_new_user_async(connection, user_id):
+    """
+    Whether a user has no ratings, liked genres or tags, for the ASGI app; the three
+    counts are queried concurrently. The Flask app reads them through UserContext.
+
+    :param connection: AsyncNeo4jConnection instance
+    :param user_id: User ID
+    :return: True if the user has no ratings, liked genres or tags
+    """
+    parameters = {"user_id": user_id}
+    ratings, genres, tags = await asyncio.gather(
+        connection.query(RATING_COUNT, parameters=parameters, access_mode=READ_ACCESS),
+        connection.query(GENRE_COUNT, parameters=parameters, access_mode=READ_ACCESS),
+        connection.query(TAG_COUNT, parameters=parameters, access_mode=READ_ACCESS),
+    )
+    return ratings[0]['rating_count'] == 0 and genres[0]['genre_count'] == 0 and tags[0]['tag_count'] == 0
\ No newline at end of file
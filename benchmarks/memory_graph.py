@@ -0,0 +1,331 @@
+import logging
+import threading
+import time
+from collections import defaultdict
+
+from backend.catalogue import CATALOGUE_TAGS
+from backend.profile import PROFILE_QUERY
+from recommendations.movie_stats import REBUILD_MOVIE_STATS
+from recommendations.similarity import DATABASE_TIME, STALE_USERS, WRITE_SIMILAR_MOVIES, WRITE_SIMILAR_USERS
+from recommendations.snapshot import EXPORT_MOVIES, EXPORT_RATINGS, EXPORT_TAGS, EXPORT_USERS
+from recommendations.stand_in import GraphStandIn
+from recommendations.utils import BUMP_CATALOGUE_VERSION, Neo4jConnection
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryGraph(GraphStandIn):
+    """
+    In-memory stand-in for the Neo4j graph, answering the queries the recommenders,
+    backend reads and ingestion functions issue.
+
+    Queries are recognized by their text, as GraphStandIn does. A query the stand-in does
+    not know raises NotImplementedError naming it, so a changed query shows up as a failing
+    benchmark instead of silently measuring something else.
+    """
+
+    def __init__(self):
+        self.movies = {}
+        self.users = set()
+        self.ratings = defaultdict(dict)
+        self.tags = defaultdict(dict)
+        self.likes = defaultdict(set)
+        self.catalogue_version = None
+        # SIMILAR edges by label, as id -> list of (neighbour id, score), and the times
+        # compared to tell whether a user's edges are current.
+        self.similar = {"User": {}, "Movie": {}}
+        self.similar_computed_at = {}
+        self.ratings_changed_at = {}
+        queries = {
+            BUMP_CATALOGUE_VERSION: self._bump_catalogue_version,
+            CATALOGUE_TAGS: self._tag_names,
+            PROFILE_QUERY: self._profile,
+            STALE_USERS: self._stale_users,
+            DATABASE_TIME: self._database_time,
+            WRITE_SIMILAR_USERS: lambda parameters, match: self._write_similar("User", parameters),
+            WRITE_SIMILAR_MOVIES: lambda parameters, match: self._write_similar("Movie", parameters),
+            REBUILD_MOVIE_STATS: self._rebuild_movie_stats,
+            EXPORT_USERS: self._export_users,
+            EXPORT_MOVIES: self._export_movies,
+            EXPORT_RATINGS: self._export_ratings,
+            EXPORT_TAGS: self._export_tags,
+        }
+        patterns = [
+            (r"^CREATE INDEX ", self._no_op),
+            (r"^UNWIND \$rows AS row MERGE \(u:User \{userId: row.userId\}\)$", self._create_users),
+            (r"^UNWIND \$rows AS row MERGE \(m:Movie \{movieId: row.movieId\}\) SET m.title = row.title, m.genres = row.genres$", self._create_movies),
+            (r"^UNWIND \$rows AS row MATCH \(m:Movie \{movieId: row.movieId\}\) SET m.imdbId = row.imdbId, m.tmdbId = row.tmdbId$", self._create_links),
+            (r"^UNWIND \$rows AS row MATCH \(u:User \{userId: row.userId\}\) MATCH \(m:Movie \{movieId: row.movieId\}\) (CREATE|MERGE) \(u\)-\[\w*:RATED", self._create_ratings),
+            (r"^UNWIND \$rows AS row MATCH \(u:User \{userId: row.userId\}\) MATCH \(m:Movie \{movieId: row.movieId\}\) (CREATE|MERGE) \(u\)-\[\w*:TAGGED", self._create_tags),
+        ]
+        super().__init__(queries, patterns, lock=threading.RLock())
+
+    @classmethod
+    def from_dataset(cls, dataset):
+        """
+        Graph holding a SyntheticDataset, with movie aggregates built as after ingestion.
+        """
+        graph = cls()
+        for movie_id, title, genres in zip(dataset.movies["movieId"], dataset.movies["title"], dataset.movies["genres"]):
+            graph.movies[int(movie_id)] = {"movieId": int(movie_id), "title": title, "genres": genres}
+        for movie_id, imdb_id, tmdb_id in zip(dataset.links["movieId"], dataset.links["imdbId"], dataset.links["tmdbId"]):
+            graph.movies[int(movie_id)].update(imdbId=int(imdb_id), tmdbId=int(tmdb_id))
+        ratings = dataset.ratings
+        for user_id, movie_id, rating, timestamp in zip(ratings["userId"].tolist(), ratings["movieId"].tolist(),
+                                                       ratings["rating"].tolist(), ratings["timestamp"].tolist()):
+            graph.ratings[user_id][movie_id] = {"rating": rating, "timestamp": timestamp}
+        tags = dataset.tags
+        for user_id, movie_id, tag, timestamp in zip(tags["userId"].tolist(), tags["movieId"].tolist(),
+                                                    tags["tag"].tolist(), tags["timestamp"].tolist()):
+            graph.tags[user_id][(movie_id, tag)] = {"timestamp": timestamp}
+        graph.users.update(graph.ratings)
+        graph.users.update(graph.tags)
+        graph.catalogue_version = 1
+        graph.update_movie_stats()
+        return graph
+
+    def describe(self):
+        return {
+            "users": len(self.users),
+            "movies": len(self.movies),
+            "ratings": sum(len(movies) for movies in self.ratings.values()),
+            "tags": sum(len(tags) for tags in self.tags.values()),
+        }
+
+    # Reads
+
+    def _user_context(self, parameters, match):
+        user_id = parameters["user_id"]
+        if user_id not in self.users:
+            return []
+        return [{
+            "ratings": [[movie_id, rel["rating"]] for movie_id, rel in self.ratings.get(user_id, {}).items()],
+            "genre_count": len(self.likes.get(user_id, ())),
+            "tag_count": len(self.tags.get(user_id, ())),
+            "similar": [list(neighbour) for neighbour in self._current_similar(user_id)],
+        }]
+
+    def _current_similar(self, user_id):
+        computed_at = self.similar_computed_at.get(("User", user_id))
+        if computed_at is None or self.ratings_changed_at.get(user_id, 0) >= computed_at:
+            return []
+        return self.similar["User"].get(user_id, [])
+
+    def _similar_users(self, parameters, match):
+        neighbours = sorted(self._current_similar(parameters["user_id"]), key=lambda neighbour: -neighbour[1])
+        return [{"userId": user_id, "score": score} for user_id, score in neighbours[:parameters["top_n"]]]
+
+    def _stale_users(self, parameters, match):
+        return [{"userId": user_id} for user_id, movies in self.ratings.items() if movies
+                and (self.similar_computed_at.get(("User", user_id)) is None
+                     or self.ratings_changed_at.get(user_id, 0) >= self.similar_computed_at[("User", user_id)])]
+
+    def _database_time(self, parameters, match):
+        return [{"now": int(time.time())}]
+
+    def _profile(self, parameters, match):
+        user_id = parameters["user_id"]
+        if user_id not in self.users:
+            return []
+        ratings = sorted(
+            ((rel.get("timestamp") or 0, movie_id, rel["rating"]) for movie_id, rel in self.ratings.get(user_id, {}).items()),
+            reverse=True)
+        tags = sorted(
+            ((rel.get("timestamp") or 0, movie_id, tag or "") for (movie_id, tag), rel in self.tags.get(user_id, {}).items()),
+            reverse=True)
+        if parameters["ratings_after"] is not None:
+            ratings = [row for row in ratings if row[:2] < tuple(parameters["ratings_after"])]
+        if parameters["tags_after"] is not None:
+            tags = [row for row in tags if row < tuple(parameters["tags_after"])]
+        title = lambda movie_id: self.movies.get(movie_id, {}).get("title")
+        return [{
+            "userId": user_id, "name": None, "email": None,
+            "rating_count": len(self.ratings.get(user_id, ())),
+            "tag_count": len(self.tags.get(user_id, ())),
+            "ratings": [{"movieId": movie_id, "movie": title(movie_id), "rating": rating, "timestamp": ts}
+                        for ts, movie_id, rating in ratings[:parameters["ratings_fetch"]]],
+            "tags": [{"movieId": movie_id, "movie": title(movie_id), "tag": tag, "timestamp": ts}
+                     for ts, movie_id, tag in tags[:parameters["tags_fetch"]]],
+        }]
+
+    def _export_users(self, parameters, match):
+        return [{"userId": user_id} for user_id in sorted(self.users)]
+
+    def _export_movies(self, parameters, match):
+        return [self._movie_record(self.movies[movie_id]) for movie_id in sorted(self.movies)]
+
+    def _export_ratings(self, parameters, match):
+        return [{"userId": user_id, "movieId": movie_id, "rating": rel["rating"], "timestamp": rel.get("timestamp") or 0}
+                for user_id in sorted(self.ratings) if parameters["from_id"] <= user_id < parameters["to_id"]
+                for movie_id, rel in sorted(self.ratings[user_id].items())]
+
+    def _export_tags(self, parameters, match):
+        return [{"userId": user_id, "movieId": movie_id, "tag": tag, "timestamp": rel.get("timestamp") or 0}
+                for user_id in sorted(self.tags) if parameters["from_id"] <= user_id < parameters["to_id"]
+                for (movie_id, tag), rel in sorted(self.tags[user_id].items()) if tag is not None]
+
+    def _movie_details(self, parameters, match):
+        return [self._movie_record(self.movies[movie_id]) for movie_id in parameters["movie_ids"] if movie_id in self.movies]
+
+    def _users_ratings(self, parameters, match):
+        return [
+            {"userId": user_id, "ratings": [[movie_id, rel["rating"]] for movie_id, rel in self.ratings[user_id].items()]}
+            for user_id in parameters["user_ids"] if self.ratings.get(user_id)
+        ]
+
+    def _users_top_ratings(self, parameters, match):
+        return [
+            dict(record, ratings=sorted(record["ratings"], key=lambda entry: (-entry[1], entry[0]))[:parameters["per_user"]])
+            for record in self._users_ratings(parameters, match)
+        ]
+
+    def _user_ratings(self, parameters, match):
+        return [{"movieId": movie_id, "rating": rel["rating"]}
+                for movie_id, rel in self.ratings.get(parameters["user_id"], {}).items()]
+
+    def _user_count(self, parameters, match):
+        user_id = parameters["user_id"]
+        relationships = {"RATED": self.ratings, "LIKES": self.likes, "TAGGED": self.tags}[match.group(1)]
+        return [{match.group(2): len(relationships.get(user_id, ()))}]
+
+    def _all_ratings(self, parameters, match):
+        return [{"userId": user_id, "movieId": movie_id, "rating": rel["rating"]}
+                for user_id, movies in self.ratings.items() for movie_id, rel in movies.items()]
+
+    def _movie_ratings(self, parameters, match):
+        movie_id = parameters["movie_id"]
+        return [{"userId": user_id, "rating": movies[movie_id]["rating"]}
+                for user_id, movies in self.ratings.items() if movie_id in movies]
+
+    def _catalogue_version(self, parameters, match):
+        return [] if self.catalogue_version is None else [{"version": self.catalogue_version}]
+
+    def _all_movies(self, parameters, match):
+        return [self._movie_record(movie) for movie in self.movies.values()]
+
+    def _tag_names(self, parameters, match):
+        names = {tag for movies in self.tags.values() for _, tag in movies}
+        return [{"tag": tag} for tag in names]
+
+    def _movie_id_bounds(self, parameters, match):
+        if not self.movies:
+            return [{"low": None, "high": None}]
+        return [{"low": min(self.movies), "high": max(self.movies)}]
+
+    def _popular_by_aggregates(self, parameters, match):
+        movies = [movie for movie in self.movies.values() if movie.get("avgRating") is not None]
+        movies.sort(key=lambda movie: (-movie["avgRating"], -movie["ratingCount"]))
+        return [dict(self._movie_record(movie), avgRating=movie["avgRating"], ratingCount=movie["ratingCount"])
+                for movie in movies[:parameters["limit"]]]
+
+    def _popular_by_ratings(self, parameters, match):
+        totals = defaultdict(lambda: [0.0, 0])
+        for movies in self.ratings.values():
+            for movie_id, rel in movies.items():
+                totals[movie_id][0] += rel["rating"]
+                totals[movie_id][1] += 1
+        ranked = sorted(totals.items(), key=lambda item: (-item[1][0] / item[1][1], -item[1][1]))
+        return [dict(self._movie_record(self.movies[movie_id]), avgRating=total / count, ratingCount=count)
+                for movie_id, (total, count) in ranked[:parameters["limit"]]]
+
+    def _trending(self, parameters, match):
+        since = int(time.time() * 1000) - 30 * 24 * 60 * 60 * 1000
+        counts = defaultdict(int)
+        for movies in self.ratings.values():
+            for movie_id, rel in movies.items():
+                if rel.get("timestamp") is not None and rel["timestamp"] > since:
+                    counts[movie_id] += 1
+        ranked = sorted(counts.items(), key=lambda item: -item[1])
+        return [dict(self._movie_record(self.movies[movie_id]), ratingCount=count)
+                for movie_id, count in ranked[:parameters["limit"]]]
+
+    def _diverse(self, parameters, match):
+        movies = sorted(self.movies.values(), key=lambda movie: movie.get("genres") or "")
+        return [self._movie_record(movie) for movie in movies[:parameters["limit"]]]
+
+    @staticmethod
+    def _movie_record(movie):
+        return {"movieId": movie["movieId"], "title": movie.get("title"), "genres": movie.get("genres")}
+
+    # Writes
+
+    def _no_op(self, parameters, match):
+        return []
+
+    def _bump_catalogue_version(self, parameters, match):
+        self.catalogue_version = (self.catalogue_version or 0) + 1
+        return []
+
+    def _create_users(self, parameters, match):
+        self.users.update(row["userId"] for row in parameters["rows"])
+        return []
+
+    def _create_movies(self, parameters, match):
+        for row in parameters["rows"]:
+            movie = self.movies.setdefault(row["movieId"], {"movieId": row["movieId"]})
+            movie.update(title=row["title"], genres=row["genres"])
+        return []
+
+    def _create_links(self, parameters, match):
+        for row in parameters["rows"]:
+            if row["movieId"] in self.movies:
+                self.movies[row["movieId"]].update(imdbId=row["imdbId"], tmdbId=row["tmdbId"])
+        return []
+
+    def _create_ratings(self, parameters, match):
+        for row in parameters["rows"]:
+            if row["userId"] in self.users and row["movieId"] in self.movies:
+                self.ratings[row["userId"]][row["movieId"]] = {"rating": row["rating"], "timestamp": row["timestamp"]}
+        return []
+
+    def _create_tags(self, parameters, match):
+        for row in parameters["rows"]:
+            if row["userId"] in self.users and row["movieId"] in self.movies:
+                self.tags[row["userId"]][(row["movieId"], row["tag"])] = {"timestamp": row["timestamp"]}
+        return []
+
+    def _write_similar(self, label, parameters):
+        nodes = self.users if label == "User" else self.movies
+        for row in parameters["rows"]:
+            if row["id"] not in nodes:
+                continue
+            self.similar[label][row["id"]] = [(neighbour, score) for neighbour, score in zip(row["neighbours"], row["scores"])
+                                              if neighbour in nodes]
+            self.similar_computed_at[(label, row["id"])] = parameters["computed_at"]
+        return []
+
+    def _rebuild_movie_stats(self, parameters, match):
+        movie_ids = [movie_id for movie_id in self.movies if parameters["from_id"] <= movie_id < parameters["to_id"]]
+        self.update_movie_stats(movie_ids)
+        return [{"movies": len(movie_ids)}]
+
+    def update_movie_stats(self, movie_ids=None):
+        """
+        Recompute ratingSum, ratingCount, ratingHist and avgRating, as `rebuild_movie_stats` does.
+        """
+        selected = set(self.movies if movie_ids is None else movie_ids)
+        stats = {movie_id: [0.0, 0, [0] * 10] for movie_id in selected}
+        for movies in self.ratings.values():
+            for movie_id, rel in movies.items():
+                if movie_id in stats:
+                    entry = stats[movie_id]
+                    entry[0] += rel["rating"]
+                    entry[1] += 1
+                    entry[2][min(max(int(round(rel["rating"] * 2)) - 1, 0), 9)] += 1
+        for movie_id, (total, count, hist) in stats.items():
+            self.movies[movie_id].update(ratingSum=total, ratingCount=count, ratingHist=hist,
+                                         avgRating=total / count if count else None)
+
+
+class InMemoryConnection(Neo4jConnection):
+    """
+    Neo4jConnection over a MemoryGraph instead of a Neo4j server. Sessions, `query`,
+    error handling and counters are the ones of Neo4jConnection.
+    """
+
+    def __init__(self, graph=None, database=None):
+        self.graph = graph if graph is not None else MemoryGraph()
+        super().__init__(None, None, None, database=database)
+
+    def _create_driver(self, uri, auth, config):
+        return self.graph
@@ -0,0 +1,325 @@
+import argparse
+import gc
+import json
+import logging
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from backend.catalogue import CatalogueIndex
+from backend.profile import fetch_profile
+from recommendations.cold_start import ColdStartRecommender
+from recommendations.collaborative_filtering import CollaborativeFiltering
+from recommendations.content_based import ContentBasedFiltering
+from recommendations.hybrid import HybridRecommender
+from recommendations.pipeline import Ranker
+from recommendations.similarity import materialize
+from recommendations.snapshot import SnapshotConnection, export_snapshot
+from recommendations.train import ALSTrainer, RatingData
+from recommendations.utils import get_connection, set_connection
+
+from .memory_graph import InMemoryConnection, MemoryGraph
+from .synthetic import SyntheticDataset
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RESULTS_DIR = './benchmarks/results'
+
+
+def summarize(latencies):
+    """
+    Latency percentiles in milliseconds.
+    """
+    ms = np.asarray(latencies) * 1000
+    return {
+        "iterations": len(ms),
+        "p50_ms": round(float(np.percentile(ms, 50)), 3),
+        "p90_ms": round(float(np.percentile(ms, 90)), 3),
+        "p99_ms": round(float(np.percentile(ms, 99)), 3),
+        "mean_ms": round(float(ms.mean()), 3),
+        "min_ms": round(float(ms.min()), 3),
+        "max_ms": round(float(ms.max()), 3),
+    }
+
+
+def peak_memory(function, *args):
+    """
+    Run `function` once under tracemalloc.
+
+    :return: Tuple (result, peak traced memory in MB)
+    """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        result = function(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, round(peak / 2 ** 20, 3)
+
+
+def benchmark(function, inputs, iterations, warmup=10, memory_iterations=5):
+    """
+    Time `function` over `inputs`, cycling through them, then measure its peak memory.
+
+    The memory pass runs separately because tracemalloc slows every allocation.
+
+    :param function: Callable taking one input
+    :param inputs: Inputs, e.g. user IDs
+    :param iterations: Timed calls
+    :param warmup: Untimed calls made first
+    :param memory_iterations: Calls whose peak memory is measured
+    :return: Dictionary of latency percentiles and peak_memory_mb
+    """
+    for i in range(warmup):
+        function(inputs[i % len(inputs)])
+    latencies = []
+    for i in range(iterations):
+        start = time.perf_counter()
+        function(inputs[i % len(inputs)])
+        latencies.append(time.perf_counter() - start)
+    _, peak = peak_memory(lambda: [function(inputs[i % len(inputs)]) for i in range(memory_iterations)])
+    result = summarize(latencies)
+    result["peak_memory_mb"] = peak
+    return result
+
+
+def timed_setup(report, name, function, *args):
+    """
+    Run a setup step, recording its duration and peak memory under `report[name]`.
+
+    Setup steps run once, so they are timed with tracemalloc running and their durations
+    are inflated by it; compare them between reports rather than with the latencies.
+    """
+    start = time.perf_counter()
+    result, peak = peak_memory(function, *args)
+    report[name] = {"seconds": round(time.perf_counter() - start, 3), "peak_memory_mb": peak}
+    return result
+
+
+def train_model(dataset, root, n_factors, n_epochs):
+    """
+    Train a factor model on the synthetic ratings and save it as the current version under `root`.
+    """
+    ratings = dataset.ratings
+    data = RatingData(ratings["userId"], ratings["movieId"], ratings["rating"])
+    model, _ = ALSTrainer(n_factors=n_factors, n_epochs=n_epochs).fit(data)
+    model.save(root, metadata={"training": {"source": "synthetic", "seed": dataset.seed}})
+    return model
+
+
+def recommender_benchmarks(dataset, connection, args, setup):
+    """
+    Latency and memory of every recommender on the in-memory graph.
+    """
+    cf = timed_setup(setup, "collaborative_filtering", CollaborativeFiltering, connection)
+    if cf.ann_index is None:
+        timed_setup(setup, "rating_matrix", lambda: cf.rating_matrix)
+    cbf = timed_setup(setup, "content_based_filtering", ContentBasedFiltering, connection)
+    timed_setup(setup, "genre_index", lambda: cbf.genre_index)
+    cold_start = ColdStartRecommender(connection)
+    timed_setup(setup, "cold_start_snapshot", cold_start.build_snapshot)
+    hybrid = HybridRecommender(connection, max_workers=args.workers, collaborative_filtering=cf,
+                               content_based_filtering=cbf, ranker=Ranker("weighted"))
+    hybrid_rrf = HybridRecommender(connection, max_workers=args.workers, collaborative_filtering=cf,
+                                   content_based_filtering=cbf, ranker=Ranker("rrf"))
+    # Neighbours materialized as SIMILAR edges, read with the user instead of searched online.
+    timed_setup(setup, "similar_edges", materialize, connection, cf.rating_matrix, "users", None, 10, 1, args.workers)
+    cf_edges = CollaborativeFiltering(connection, rating_matrix=cf.rating_matrix, ann_index=cf.ann_index,
+                                      similar_edges=True)
+    catalogue = CatalogueIndex()
+    timed_setup(setup, "catalogue", catalogue.reload, connection)
+    # The same graph exported to a columnar snapshot and read back memory-mapped, without the graph.
+    snapshot_directory = tempfile.TemporaryDirectory()
+    timed_setup(setup, "snapshot_export", export_snapshot, connection, snapshot_directory.name)
+    snapshot_connection = timed_setup(setup, "snapshot_load", SnapshotConnection.load, snapshot_directory.name)
+    cf_snapshot = CollaborativeFiltering(snapshot_connection, ann_index=cf.ann_index)
+    timed_setup(setup, "snapshot_rating_matrix", lambda: cf_snapshot.rating_matrix)
+    cold_start_from_snapshot = ColdStartRecommender(snapshot_connection)
+
+    rng = np.random.default_rng(args.seed)
+    users = rng.choice(np.unique(dataset.ratings["userId"]), min(args.sample_users, dataset.n_users), replace=False)
+    users = [int(user_id) for user_id in users]
+    # Typeahead prefixes of one to four characters of random titles.
+    titles = dataset.movies["title"][rng.choice(dataset.n_movies, len(users))]
+    prefixes = [title[:length] for title, length in zip(titles, rng.integers(1, 5, len(users)))]
+    results = {}
+    cases = [
+        ("collaborative", lambda user_id: cf.user_based_recommendations(user_id, 10), users, args.iterations),
+        ("collaborative_edges", lambda user_id: cf_edges.user_based_recommendations(user_id, 10), users, args.iterations),
+        ("content", lambda user_id: cbf.content_based_recommendations(user_id, 10), users, args.iterations),
+        ("cold_start", lambda _: cold_start.recommend_for_new_user(10), [None], args.iterations),
+        ("cold_start_snapshot", lambda _: cold_start.build_snapshot(), [None], max(args.iterations // 20, 3)),
+        ("hybrid", lambda user_id: hybrid.recommend_within_budget(user_id), users, args.iterations),
+        ("hybrid_rrf", lambda user_id: hybrid_rrf.recommend_within_budget(user_id), users, args.iterations),
+        ("catalogue_search", lambda prefix: catalogue.movies(prefix), prefixes, args.iterations),
+        ("profile", lambda user_id: fetch_profile(connection, user_id, {}), users, args.iterations),
+        ("snapshot_collaborative", lambda user_id: cf_snapshot.user_based_recommendations(user_id, 10), users,
+         args.iterations),
+        ("snapshot_cold_start_snapshot", lambda _: cold_start_from_snapshot.build_snapshot(), [None],
+         max(args.iterations // 20, 3)),
+    ]
+    for name, function, inputs, iterations in cases:
+        results[name] = benchmark(function, inputs, iterations, warmup=min(args.warmup, iterations))
+        logger.info(f"{name}: {results[name]}")
+    hybrid.executor.shutdown()
+    hybrid_rrf.executor.shutdown()
+    snapshot_directory.cleanup()
+    return results
+
+
+def ingestion_benchmarks(dataset, directory, repeat):
+    """
+    Time each stage of a full ingestion of the synthetic CSVs into a fresh in-memory graph.
+
+    The ingestion functions run unchanged: they read the CSV paths from the environment and
+    write through the shared connection, which points at the stand-in for the duration.
+    """
+    paths = dataset.write_csv(os.path.join(directory, "data"))
+    for entity, path in paths.items():
+        os.environ[f"{entity.upper()}_PATH"] = path
+    import ingest_data
+
+    rows = {"movies": dataset.n_movies, "users": dataset.n_users, "links": dataset.n_movies,
+            "ratings": dataset.n_ratings, "tags": len(dataset.tags["tag"]), "movie_stats": dataset.n_movies}
+    stages = [
+        ("movies", ingest_data.ingest_movies),
+        ("users", ingest_data.ingest_users),
+        ("links", ingest_data.ingest_links),
+        ("ratings", ingest_data.ingest_ratings),
+        ("tags", ingest_data.ingest_tags),
+        ("movie_stats", lambda checkpoint: ingest_data.rebuild_movie_stats(get_connection())),
+    ]
+
+    def run(measure_memory=False):
+        set_connection(InMemoryConnection())
+        checkpoint = {"offsets": {}, "completed": []}
+        stage_results = {}
+        for name, stage in stages:
+            start = time.perf_counter()
+            if measure_memory:
+                _, stage_results[name] = peak_memory(stage, checkpoint)
+            else:
+                stage(checkpoint)
+                stage_results[name] = time.perf_counter() - start
+        return stage_results
+
+    previous = set_connection(None)
+    working_directory = os.getcwd()
+    # The checkpoint and manifest files are written to the working directory.
+    os.chdir(directory)
+    try:
+        runs = [run() for _ in range(repeat)]
+        memory = run(measure_memory=True)
+        stats = get_connection().session_stats()
+    finally:
+        os.chdir(working_directory)
+        set_connection(previous)
+
+    results = {}
+    for name, _ in stages:
+        latencies = [stage_results[name] for stage_results in runs]
+        results[f"ingest_{name}"] = summarize(latencies)
+        results[f"ingest_{name}"]["rows_per_second"] = round(rows[name] / float(np.median(latencies)))
+        results[f"ingest_{name}"]["peak_memory_mb"] = memory[name]
+        logger.info(f"ingest_{name}: {results[f'ingest_{name}']}")
+    if stats["failed_queries"]:
+        raise RuntimeError(f"{stats['failed_queries']} ingestion queries failed on the in-memory graph.")
+    return results
+
+
+def revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    """
+    Log the change in median latency of every benchmark also present in a baseline report.
+    """
+    for name, result in results["benchmarks"].items():
+        before = baseline.get("benchmarks", {}).get(name)
+        if before and before.get("p50_ms"):
+            change = (result["p50_ms"] - before["p50_ms"]) / before["p50_ms"] * 100
+            logger.info(f"{name}: p50 {before['p50_ms']:.3f} ms -> {result['p50_ms']:.3f} ms ({change:+.1f}%)")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the recommenders and ingestion on synthetic data, "
+                                                 "without Neo4j, and save the results as JSON.")
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--movies', type=int, default=4000)
+    parser.add_argument('--ratings', type=int, default=None, help="defaults to what --sparsity implies")
+    parser.add_argument('--sparsity', type=float, default=0.98)
+    parser.add_argument('--tags', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--sample-users', type=int, default=100, help="users the per-user benchmarks cycle through")
+    parser.add_argument('--workers', type=int, default=4, help="hybrid branch threads")
+    parser.add_argument('--factors', type=int, default=32)
+    parser.add_argument('--epochs', type=int, default=5)
+    parser.add_argument('--ann', action='store_true', help="find similar users with the ANN index")
+    parser.add_argument('--ingest-repeat', type=int, default=3)
+    parser.add_argument('--skip-ingestion', action='store_true')
+    parser.add_argument('--output', default=None, help="results file, defaults to benchmarks/results/<time>.json")
+    parser.add_argument('--baseline', default=None, help="earlier results file to compare median latencies with")
+    args = parser.parse_args()
+
+    # The recommenders log every request at INFO; that I/O would dominate the timings. Imported
+    # modules already configured the root logger (backend.register points it at register.log),
+    # so it is replaced instead of left as is.
+    logging.basicConfig(level=logging.WARNING, stream=sys.stderr, force=True)
+    logger.setLevel(logging.INFO)
+
+    setup = {}
+    with tempfile.TemporaryDirectory() as directory:
+        dataset = timed_setup(setup, "generate_data", SyntheticDataset.generate, args.users, args.movies, args.ratings,
+                              args.sparsity, args.tags, 8, args.seed)
+        graph = timed_setup(setup, "load_graph", MemoryGraph.from_dataset, dataset)
+        os.environ['MF_MODEL_DIR'] = os.path.join(directory, "mf")
+        os.environ['USER_ANN_INDEX'] = '1' if args.ann else '0'
+        os.environ['USER_ANN_INDEX_PATH'] = os.path.join(directory, "user_ann_index.npz")
+        timed_setup(setup, "train_model", train_model, dataset, os.environ['MF_MODEL_DIR'], args.factors, args.epochs)
+
+        connection = InMemoryConnection(graph)
+        benchmarks = recommender_benchmarks(dataset, connection, args, setup)
+        if connection.session_stats()["failed_queries"]:
+            raise RuntimeError(f"{connection.session_stats()['failed_queries']} queries failed on the in-memory graph.")
+        if not args.skip_ingestion:
+            benchmarks.update(ingestion_benchmarks(dataset, directory, args.ingest_repeat))
+
+    results = {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "revision": revision(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "dataset": dataset.describe(),
+        "options": {"iterations": args.iterations, "warmup": args.warmup, "sample_users": args.sample_users,
+                    "workers": args.workers, "factors": args.factors, "epochs": args.epochs, "ann": args.ann,
+                    "ingest_repeat": args.ingest_repeat},
+        "setup": setup,
+        "benchmarks": benchmarks,
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS.
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (2 ** 20 if platform.system() == 'Darwin' else 2 ** 10), 1),
+    }
+    output = args.output or os.path.join(DEFAULT_RESULTS_DIR, time.strftime("%Y%m%d-%H%M%S") + ".json")
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    logger.info(f"Results written to {output}.")
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
@@ -0,0 +1,178 @@
+import logging
+import os
+import time
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+GENRES = [
+    "Action", "Adventure", "Animation", "Children", "Comedy", "Crime", "Documentary", "Drama", "Fantasy",
+    "Film-Noir", "Horror", "IMAX", "Musical", "Mystery", "Romance", "Sci-Fi", "Thriller", "War", "Western",
+]
+
+
+class SyntheticDataset:
+    """
+    MovieLens-shaped data generated from a seed, so benchmarks run without the real dataset.
+
+    Movie popularity follows a Zipf-like curve and user activity a log-normal one, as in
+    MovieLens. Ratings come from low-rank user and movie tastes plus noise, on the half-star
+    scale, so collaborative filtering has structure to find. Timestamps are Unix seconds
+    spread over the five years before generation.
+    """
+
+    def __init__(self, movies, ratings, tags, links, seed):
+        """
+        :param movies: Dictionary of movieId, title and genres arrays
+        :param ratings: Dictionary of userId, movieId, rating and timestamp arrays
+        :param tags: Dictionary of userId, movieId, tag and timestamp arrays
+        :param links: Dictionary of movieId, imdbId and tmdbId arrays
+        :param seed: Seed the data was generated from
+        """
+        self.movies = movies
+        self.ratings = ratings
+        self.tags = tags
+        self.links = links
+        self.seed = seed
+
+    @classmethod
+    def generate(cls, n_users=1000, n_movies=2000, n_ratings=None, sparsity=0.98, n_tags=None, n_factors=8, seed=0):
+        """
+        :param n_users: Number of users
+        :param n_movies: Number of movies
+        :param n_ratings: Number of ratings, derived from `sparsity` if omitted
+        :param sparsity: Fraction of the user x movie matrix left empty, used when `n_ratings` is omitted
+        :param n_tags: Number of tag applications, defaults to one per 20 ratings
+        :param n_factors: Rank of the tastes the ratings are drawn from
+        :param seed: Seed for every random choice
+        :return: SyntheticDataset instance
+        """
+        if n_ratings is None:
+            n_ratings = int(round(n_users * n_movies * (1.0 - sparsity)))
+        n_ratings = min(n_ratings, n_users * n_movies)
+        if n_tags is None:
+            n_tags = n_ratings // 20
+        rng = np.random.default_rng(seed)
+        start = time.perf_counter()
+
+        movie_ids = np.arange(1, n_movies + 1, dtype=np.int64)
+        years = rng.integers(1950, 2024, n_movies)
+        genres = ["|".join(sorted(rng.choice(GENRES, rng.integers(1, 4), replace=False))) for _ in range(n_movies)]
+        movies = {
+            "movieId": movie_ids,
+            "title": np.array([f"Movie {movie_id} ({year})" for movie_id, year in zip(movie_ids, years)], dtype=object),
+            "genres": np.array(genres, dtype=object),
+        }
+        links = {
+            "movieId": movie_ids,
+            "imdbId": rng.choice(np.arange(100000, 9999999), n_movies, replace=False),
+            "tmdbId": rng.choice(np.arange(1, 999999), n_movies, replace=False),
+        }
+
+        movie_weights = 1.0 / np.arange(1, n_movies + 1) ** 0.8
+        rng.shuffle(movie_weights)
+        user_weights = rng.lognormal(0.0, 1.0, n_users)
+        users, items = _sample_pairs(rng, user_weights, movie_weights, n_ratings)
+
+        user_taste = rng.normal(0, 1, (n_users, n_factors)) / np.sqrt(n_factors)
+        movie_taste = rng.normal(0, 1, (n_movies, n_factors))
+        quality = rng.normal(0, 0.4, n_movies)
+        leniency = rng.normal(0, 0.3, n_users)
+        scores = 3.5 + quality[items] + leniency[users] + np.einsum("ij,ij->i", user_taste[users], movie_taste[items])
+        scores += rng.normal(0, 0.5, n_ratings)
+        now = int(time.time())
+        ratings = {
+            "userId": users.astype(np.int64) + 1,
+            "movieId": movie_ids[items],
+            "rating": np.clip(np.round(scores * 2) / 2, 0.5, 5.0),
+            "timestamp": rng.integers(now - 5 * 365 * 24 * 3600, now, n_ratings),
+        }
+
+        tagged = rng.choice(n_ratings, min(n_tags, n_ratings), replace=False) if n_ratings else np.empty(0, np.int64)
+        vocabulary = np.array([f"tag{i}" for i in range(max(50, n_movies // 10))], dtype=object)
+        tags = {
+            "userId": ratings["userId"][tagged],
+            "movieId": ratings["movieId"][tagged],
+            "tag": rng.choice(vocabulary, len(tagged)),
+            "timestamp": ratings["timestamp"][tagged],
+        }
+        logger.info(f"Generated {n_users} users, {n_movies} movies, {n_ratings} ratings and {len(tagged)} tags "
+                    f"in {time.perf_counter() - start:.1f}s.")
+        return cls(movies, ratings, tags, links, seed)
+
+    @property
+    def n_users(self):
+        return len(np.unique(self.ratings["userId"]))
+
+    @property
+    def n_movies(self):
+        return len(self.movies["movieId"])
+
+    @property
+    def n_ratings(self):
+        return len(self.ratings["rating"])
+
+    def describe(self):
+        """
+        Sizes and sparsity of the data, for benchmark reports.
+        """
+        n_users = self.n_users
+        return {
+            "users": n_users,
+            "movies": self.n_movies,
+            "ratings": self.n_ratings,
+            "tags": len(self.tags["tag"]),
+            "sparsity": round(1.0 - self.n_ratings / max(n_users * self.n_movies, 1), 6),
+            "seed": self.seed,
+        }
+
+    def frames(self):
+        """
+        The data as pandas DataFrames with the columns of the MovieLens CSVs.
+
+        :return: Dictionary of movies, ratings, tags and links DataFrames
+        """
+        import pandas as pd
+
+        return {
+            "movies": pd.DataFrame(self.movies),
+            "ratings": pd.DataFrame(self.ratings),
+            "tags": pd.DataFrame(self.tags),
+            "links": pd.DataFrame(self.links),
+        }
+
+    def write_csv(self, directory):
+        """
+        Write movies.csv, ratings.csv, tags.csv and links.csv, as in the MovieLens download.
+
+        :param directory: Output directory, created if missing
+        :return: Dictionary of entity -> CSV path
+        """
+        os.makedirs(directory, exist_ok=True)
+        paths = {}
+        for entity, frame in self.frames().items():
+            paths[entity] = os.path.join(directory, f"{entity}.csv")
+            frame.to_csv(paths[entity], index=False)
+        return paths
+
+
+def _sample_pairs(rng, user_weights, movie_weights, n_pairs):
+    """
+    Distinct (user, movie) index pairs drawn in proportion to the product of the weights.
+    """
+    n_users, n_movies = len(user_weights), len(movie_weights)
+    user_p = user_weights / user_weights.sum()
+    movie_p = movie_weights / movie_weights.sum()
+    keys = np.empty(0, dtype=np.int64)
+    while len(keys) < n_pairs:
+        draw = max(int((n_pairs - len(keys)) * 1.2), 1024)
+        candidates = rng.choice(n_users, draw, p=user_p) * n_movies + rng.choice(n_movies, draw, p=movie_p)
+        keys = np.unique(np.concatenate([keys, candidates]))
+        if len(keys) > 0.9 * n_users * n_movies:
+            # Nearly dense: weighted draws mostly repeat, so fill the rest uniformly.
+            missing = np.setdiff1d(np.arange(n_users * n_movies), keys)
+            keys = np.concatenate([keys, rng.choice(missing, max(n_pairs - len(keys), 0), replace=False)])
+            break
+    keys = rng.permutation(keys)[:n_pairs]
+    return keys // n_movies, keys % n_movies
@@ -1,9 +1,16 @@
+import numpy as np
 import pandas as pd
-from neo4j import GraphDatabase
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import argparse
+import json
 import logging
 import os
+import threading
+import time
 from dotenv import load_dotenv
+from recommendations.utils import BUMP_CATALOGUE_VERSION, get_connection, close_connection
+from recommendations.movie_stats import rating_delta, rebuild_movie_stats
 
 # Load environment variables from .env file
 load_dotenv()
@@ -12,122 +19,657 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Load the datasets from the data folder
+# Paths of the datasets in the data folder; files are streamed in chunks, never loaded whole
 movies_path = os.getenv('MOVIES_PATH')
 tags_path = os.getenv('TAGS_PATH')
 links_path = os.getenv('LINKS_PATH')
 ratings_path = os.getenv('RATINGS_PATH')
 
-movies = pd.read_csv(movies_path)
-tags = pd.read_csv(tags_path)
-links = pd.read_csv(links_path)
-ratings = pd.read_csv(ratings_path)
+# Rows per UNWIND transaction, concurrent writers, and batches queued ahead of the writers
+BATCH_SIZE = int(os.getenv('INGEST_BATCH_SIZE', 5000))
+MAX_WORKERS = int(os.getenv('INGEST_WORKERS', 4))
+MAX_IN_FLIGHT = int(os.getenv('INGEST_MAX_IN_FLIGHT', MAX_WORKERS * 2))
+# Rows read from a CSV at a time; a chunk is the unit of checkpointing
+CHUNK_SIZE = int(os.getenv('INGEST_CHUNK_SIZE', 100000))
 
-# Neo4j connection (update with your credentials)
-uri = os.getenv('NEO4J_URI')
-username = os.getenv('NEO4J_USERNAME')
-password = os.getenv('NEO4J_PASSWORD')
-database = os.getenv('NEO4J_DATABASE')
+# Incremental runs split each file into partitions of INGEST_PARTITION_SPAN consecutive IDs of its key
+PARTITION_SPAN = int(os.getenv('INGEST_PARTITION_SPAN', 1000))
+PARTITION_KEYS = {'movies': 'movieId', 'tags': 'userId', 'links': 'movieId', 'ratings': 'userId'}
 
-driver = GraphDatabase.driver(uri, auth=(username, password))
+# Columns read from each file
+COLUMNS = {
+    'movies': ['movieId', 'title', 'genres'],
+    'tags': ['userId', 'movieId', 'tag', 'timestamp'],
+    'links': ['movieId', 'imdbId', 'tmdbId'],
+    'ratings': ['userId', 'movieId', 'rating', 'timestamp'],
+}
 
 checkpoint_file = 'checkpoint.txt'
+manifest_file = 'ingest_manifest.json'
 
 def read_checkpoint():
+    """
+    Read the per-file checkpoint: rows durably written per entity and the finished entities.
+    """
     if os.path.exists(checkpoint_file):
         with open(checkpoint_file, 'r') as f:
-            return int(f.read().strip())
-    return 0
+            content = f.read().strip()
+        try:
+            checkpoint = json.loads(content)
+        except ValueError:
+            checkpoint = None
+        if isinstance(checkpoint, dict):
+            return checkpoint
+        logger.warning(f"Ignoring checkpoint in an unknown format: {content!r}")
+    return {"offsets": {}, "completed": []}
 
-def write_checkpoint(index):
-    with open(checkpoint_file, 'w') as f:
-        f.write(str(index))
+def write_checkpoint(checkpoint):
+    # Write to a temporary file and rename it, so a crash never leaves a torn checkpoint.
+    temp_file = checkpoint_file + '.tmp'
+    with open(temp_file, 'w') as f:
+        json.dump(checkpoint, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_file, checkpoint_file)
+
+class Checkpointer:
+    """
+    Tracks which chunks of a file are durably written and persists the offset of the
+    longest fully written prefix, so a restart resumes right after it.
+    """
+
+    def __init__(self, checkpoint, entity):
+        self.checkpoint = checkpoint
+        self.entity = entity
+        self.offset = checkpoint["offsets"].get(entity, 0)
+        self._pending = {}
+        self._finished = set()
+        self._lock = threading.Lock()
+
+    def chunk_started(self, chunk_start, chunk_end, batches):
+        with self._lock:
+            self._pending[chunk_start] = [chunk_end, batches]
+
+    def batch_done(self, chunk_start):
+        with self._lock:
+            self._pending[chunk_start][1] -= 1
+            if self._pending[chunk_start][1] == 0:
+                self._finished.add(chunk_start)
+            advanced = False
+            while self.offset in self._finished:
+                self._finished.discard(self.offset)
+                self.offset = self._pending.pop(self.offset)[0]
+                advanced = True
+            if advanced:
+                self.checkpoint["offsets"][self.entity] = self.offset
+                write_checkpoint(self.checkpoint)
+
+    def complete(self):
+        with self._lock:
+            self.checkpoint["completed"].append(self.entity)
+            write_checkpoint(self.checkpoint)
+
+class PartitionManifest:
+    """
+    Content hashes of every partition of every ingested file, as of the last full or
+    incremental run. A partition holds the rows of `span` consecutive IDs of the file's key
+    (PARTITION_KEYS), so a new or edited row only changes the partition of its own ID. A
+    partition whose hash is unchanged is skipped without touching the graph.
+    """
+
+    def __init__(self, path=manifest_file, span=PARTITION_SPAN):
+        self.path = path
+        self.span = span
+        self.partitions = {}
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                manifest = json.load(f)
+            # Partitions only line up with the previous run if they were cut the same way.
+            if manifest.get("span") == span:
+                self.partitions = manifest.get("partitions", {})
+        # Runs compare against the hashes they started from, not the ones they are recording.
+        self.previous = {entity: dict(partitions) for entity, partitions in self.partitions.items()}
+        self._lock = threading.Lock()
+
+    def partition_ids(self, entity, frame):
+        return frame[PARTITION_KEYS[entity]].to_numpy() // self.span
+
+    @staticmethod
+    def accumulate(digests, partition_ids, frame):
+        """
+        Add the rows of a frame to the running digests of their partitions.
+
+        A digest is the row count and the wrapping sum of the row hashes, so it does not
+        depend on the order of the rows or on how the file was chunked.
+
+        :param digests: Dictionary of partition -> (rows, hash sum), updated in place
+        :param partition_ids: Partition of every row of `frame`
+        """
+        hashes = pd.util.hash_pandas_object(frame, index=False).to_numpy()
+        partitions, inverse = np.unique(partition_ids, return_inverse=True)
+        sums = np.zeros(len(partitions), dtype=np.uint64)
+        np.add.at(sums, inverse, hashes)
+        counts = np.bincount(inverse, minlength=len(partitions))
+        for partition, total, count in zip(partitions.tolist(), sums.tolist(), counts.tolist()):
+            rows, digest = digests.get(partition, (0, 0))
+            digests[partition] = (rows + count, (digest + total) & 0xFFFFFFFFFFFFFFFF)
+
+    @staticmethod
+    def format(digest):
+        rows, total = digest
+        return f"{rows}:{total:016x}"
+
+    def changed(self, entity, partition, digest):
+        return self.previous.get(entity, {}).get(str(partition)) != digest
+
+    def record(self, entity, partition, digest):
+        with self._lock:
+            self.partitions.setdefault(entity, {})[str(partition)] = digest
+            self._save()
+
+    def replace(self, entity, digests):
+        """
+        Replace every partition hash of a file, or forget the file when `digests` is None.
+        """
+        with self._lock:
+            self.partitions.pop(entity, None)
+            if digests is not None:
+                self.partitions[entity] = {str(partition): self.format(digest) for partition, digest in digests.items()}
+            self._save()
+
+    def _save(self):
+        temp_file = self.path + '.tmp'
+        with open(temp_file, 'w') as f:
+            json.dump({"span": self.span, "partitions": self.partitions}, f)
+        os.replace(temp_file, self.path)
 
 def clear_existing_data():
-    with driver.session(database=database) as session:
+    with get_connection().session() as session:
         session.run("MATCH (u:User) DETACH DELETE u")
         session.run("MATCH (m:Movie) DETACH DELETE m")
         session.run("MATCH ()-[r:TAGGED]->() DELETE r")
         session.run("MATCH ()-[r:RATED]->() DELETE r")
     logger.info("Cleared existing user, movie, and relationship data.")
 
-def create_user(tx, user_id):
-    tx.run("MERGE (u:User {userId: $user_id})", user_id=user_id)
+def create_indexes():
+    # Every batch MERGEs or MATCHes on these keys, so they must be indexed before loading.
+    with get_connection().session() as session:
+        session.run("CREATE INDEX user_id IF NOT EXISTS FOR (u:User) ON (u.userId)")
+        session.run("CREATE INDEX movie_id IF NOT EXISTS FOR (m:Movie) ON (m.movieId)")
+        # Preferences are submitted by title.
+        session.run("CREATE INDEX movie_title IF NOT EXISTS FOR (m:Movie) ON (m.title)")
+        # Lets popularity queries read movies in avgRating order instead of scanning ratings.
+        session.run("CREATE INDEX movie_avg_rating IF NOT EXISTS FOR (m:Movie) ON (m.avgRating)")
+    logger.info("Ensured indexes on User.userId, Movie.movieId, Movie.title and Movie.avgRating.")
 
-def create_movie(tx, movie_id, title, genres):
-    tx.run("MERGE (m:Movie {movieId: $movie_id, title: $title, genres: $genres})",
-           movie_id=movie_id, title=title, genres=genres)
+def bump_catalogue_version():
+    with get_connection().session() as session:
+        session.run(BUMP_CATALOGUE_VERSION)
+    logger.info("Catalogue version bumped.")
 
-def create_tag(tx, user_id, movie_id, tag, timestamp):
+def create_users(tx, rows):
     tx.run("""
-        MATCH (u:User {userId: $user_id})
-        MATCH (m:Movie {movieId: $movie_id})
-        CREATE (u)-[:TAGGED {tag: $tag, timestamp: $timestamp}]->(m)
-    """, user_id=user_id, movie_id=movie_id, tag=tag, timestamp=timestamp)
+        UNWIND $rows AS row
+        MERGE (u:User {userId: row.userId})
+    """, rows=rows)
 
-def create_link(tx, movie_id, imdb_id, tmdb_id):
-    tx.run("MATCH (m:Movie {movieId: $movie_id}) SET m.imdbId = $imdb_id, m.tmdbId = $tmdb_id",
-           movie_id=movie_id, imdb_id=imdb_id, tmdb_id=tmdb_id)
+def create_movies(tx, rows):
+    tx.run("""
+        UNWIND $rows AS row
+        MERGE (m:Movie {movieId: row.movieId})
+        SET m.title = row.title, m.genres = row.genres
+    """, rows=rows)
 
-def create_rating(tx, user_id, movie_id, rating, timestamp):
+def create_tags(tx, rows):
     tx.run("""
-        MATCH (u:User {userId: $user_id})
-        MATCH (m:Movie {movieId: $movie_id})
-        CREATE (u)-[:RATED {rating: $rating, timestamp: $timestamp}]->(m)
-    """, user_id=user_id, movie_id=movie_id, rating=rating, timestamp=timestamp)
-
-def ingest_data(data, ingest_function):
-    with ThreadPoolExecutor() as executor:
-        futures = [executor.submit(ingest_function, *row) for row in data.itertuples(index=False, name=None)]
-        for future in as_completed(futures):
+        UNWIND $rows AS row
+        MATCH (u:User {userId: row.userId})
+        MATCH (m:Movie {movieId: row.movieId})
+        CREATE (u)-[:TAGGED {tag: row.tag, timestamp: row.timestamp}]->(m)
+    """, rows=rows)
+
+def merge_tags(tx, rows):
+    tx.run("""
+        UNWIND $rows AS row
+        MATCH (u:User {userId: row.userId})
+        MATCH (m:Movie {movieId: row.movieId})
+        MERGE (u)-[t:TAGGED {tag: row.tag}]->(m)
+        SET t.timestamp = row.timestamp
+    """, rows=rows)
+
+def create_links(tx, rows):
+    tx.run("""
+        UNWIND $rows AS row
+        MATCH (m:Movie {movieId: row.movieId})
+        SET m.imdbId = row.imdbId, m.tmdbId = row.tmdbId
+    """, rows=rows)
+
+def create_ratings(tx, rows):
+    tx.run("""
+        UNWIND $rows AS row
+        MATCH (u:User {userId: row.userId})
+        MATCH (m:Movie {movieId: row.movieId})
+        CREATE (u)-[:RATED {rating: row.rating, timestamp: row.timestamp}]->(m)
+    """, rows=rows)
+
+def merge_ratings(tx, rows):
+    tx.run("""
+        UNWIND $rows AS row
+        MATCH (u:User {userId: row.userId})
+        MATCH (m:Movie {movieId: row.movieId})
+        MERGE (u)-[r:RATED]->(m)
+        SET r.rating = row.rating, r.timestamp = row.timestamp
+    """, rows=rows)
+
+# Upserts for incremental mode. Each row is classified against what the graph holds and
+# only new or changed rows are written; the queries return row counts per status.
+
+def upsert_users(tx, rows):
+    result = tx.run("""
+        UNWIND $rows AS row
+        OPTIONAL MATCH (old:User {userId: row.userId})
+        WITH row, CASE WHEN old IS NULL THEN 'inserted' ELSE 'skipped' END AS status
+        FOREACH (_ IN CASE WHEN status = 'inserted' THEN [1] ELSE [] END |
+            MERGE (u:User {userId: row.userId}))
+        RETURN status, count(*) AS rows
+    """, rows=rows)
+    return {record["status"]: record["rows"] for record in result}
+
+def upsert_movies(tx, rows):
+    result = tx.run("""
+        UNWIND $rows AS row
+        OPTIONAL MATCH (old:Movie {movieId: row.movieId})
+        WITH row, CASE
+            WHEN old IS NULL THEN 'inserted'
+            WHEN old.title = row.title AND old.genres = row.genres THEN 'skipped'
+            ELSE 'updated' END AS status
+        FOREACH (_ IN CASE WHEN status <> 'skipped' THEN [1] ELSE [] END |
+            MERGE (m:Movie {movieId: row.movieId})
+            SET m.title = row.title, m.genres = row.genres)
+        RETURN status, count(*) AS rows
+    """, rows=rows)
+    return {record["status"]: record["rows"] for record in result}
+
+def upsert_tags(tx, rows):
+    result = tx.run("""
+        UNWIND $rows AS row
+        MATCH (u:User {userId: row.userId})
+        MATCH (m:Movie {movieId: row.movieId})
+        OPTIONAL MATCH (u)-[old:TAGGED {tag: row.tag}]->(m)
+        WITH u, m, row, CASE
+            WHEN old IS NULL THEN 'inserted'
+            WHEN old.timestamp = row.timestamp THEN 'skipped'
+            ELSE 'updated' END AS status
+        FOREACH (_ IN CASE WHEN status <> 'skipped' THEN [1] ELSE [] END |
+            MERGE (u)-[t:TAGGED {tag: row.tag}]->(m)
+            SET t.timestamp = row.timestamp)
+        RETURN status, count(*) AS rows
+    """, rows=rows)
+    return {record["status"]: record["rows"] for record in result}
+
+def upsert_links(tx, rows):
+    result = tx.run("""
+        UNWIND $rows AS row
+        MATCH (m:Movie {movieId: row.movieId})
+        WITH m, row, CASE
+            WHEN m.imdbId IS NULL AND m.tmdbId IS NULL THEN 'inserted'
+            WHEN m.imdbId = row.imdbId AND coalesce(m.tmdbId, -1) = coalesce(row.tmdbId, -1) THEN 'skipped'
+            ELSE 'updated' END AS status
+        FOREACH (_ IN CASE WHEN status <> 'skipped' THEN [1] ELSE [] END |
+            SET m.imdbId = row.imdbId, m.tmdbId = row.tmdbId)
+        RETURN status, count(*) AS rows
+    """, rows=rows)
+    return {record["status"]: record["rows"] for record in result}
+
+def upsert_ratings(tx, rows):
+    result = tx.run("""
+        UNWIND $rows AS row
+        MATCH (u:User {userId: row.userId})
+        MATCH (m:Movie {movieId: row.movieId})
+        OPTIONAL MATCH (u)-[old:RATED]->(m)
+        WITH u, m, row, old.rating AS old_rating, CASE
+            WHEN old IS NULL THEN 'inserted'
+            WHEN old.rating = row.rating AND old.timestamp = row.timestamp THEN 'skipped'
+            ELSE 'updated' END AS status
+        FOREACH (_ IN CASE WHEN status <> 'skipped' THEN [1] ELSE [] END |
+            MERGE (u)-[r:RATED]->(m)
+            SET r.rating = row.rating, r.timestamp = row.timestamp, u.ratingsChangedAt = timestamp() / 1000)
+        FOREACH (_ IN CASE WHEN status <> 'skipped' AND (old_rating IS NULL OR old_rating <> row.rating) THEN [1] ELSE [] END |
+            """ + rating_delta('m', 'old_rating', 'row.rating') + """)
+        RETURN status, count(*) AS rows
+    """, rows=rows)
+    return {record["status"]: record["rows"] for record in result}
+
+def to_rows(frame):
+    # Plain Python values for the driver; missing values (e.g. tmdbId) become null.
+    return frame.astype(object).where(frame.notna(), None).to_dict('records')
+
+def node_batches(frame, batch_size=BATCH_SIZE):
+    for start in range(0, len(frame), batch_size):
+        yield to_rows(frame.iloc[start:start + batch_size])
+
+def relationship_batches(frame, batch_size=BATCH_SIZE, lanes=MAX_WORKERS):
+    """
+    Split relationship rows so that concurrently running batches rarely lock the same nodes.
+
+    Rows are partitioned into lanes by userId, so batches from different lanes never share
+    a User node, and the lanes are interleaved so that the batches in flight at any time
+    come from different lanes. Within a batch rows are ordered by movieId, so transactions
+    that do meet on a Movie node lock movies in the same order instead of deadlocking.
+    """
+    lane_frames = [
+        frame[frame['userId'] % lanes == lane].sort_values(['userId', 'movieId'], kind='stable')
+        for lane in range(lanes)
+    ]
+    offsets = [0] * lanes
+    while any(offset < len(lane_frame) for offset, lane_frame in zip(offsets, lane_frames)):
+        for lane, lane_frame in enumerate(lane_frames):
+            if offsets[lane] < len(lane_frame):
+                batch = lane_frame.iloc[offsets[lane]:offsets[lane] + batch_size]
+                offsets[lane] += batch_size
+                yield to_rows(batch.sort_values('movieId', kind='stable'))
+
+def read_chunks(path, columns, offset=0, chunk_size=CHUNK_SIZE):
+    """
+    Stream a CSV in chunks, skipping the first `offset` data rows.
+
+    :return: Iterator of tuples (chunk_start, chunk_end, frame) in file row numbers
+    """
+    # A callable rather than a range, which pandas would turn into a set of every skipped row.
+    skiprows = (lambda row: 0 < row <= offset) if offset else None
+    chunk_start = offset
+    for frame in pd.read_csv(path, usecols=columns, skiprows=skiprows, chunksize=chunk_size):
+        chunk_end = chunk_start + len(frame)
+        yield chunk_start, chunk_end, frame[columns]
+        chunk_start = chunk_end
+
+def write_batch(tx_function, rows):
+    with get_connection().session() as session:
+        result = session.execute_write(tx_function, rows)
+    return len(rows), result
+
+def ingest_batches(entity, batches, tx_function, workers=MAX_WORKERS, max_in_flight=MAX_IN_FLIGHT, on_done=None,
+                   stats=None):
+    """
+    Write batches on a bounded worker pool, keeping at most `max_in_flight` batches queued.
+
+    Batches are pulled from the iterator only when there is room in the queue, so memory
+    stays bounded by the queue size rather than by the input size.
+
+    :param batches: Iterator of row lists, or of tuples (tag, rows) when `on_done` is given
+    :param on_done: Optional callback receiving the tag of every successfully written batch
+    :param stats: Optional Counter accumulating the per-status counts returned by `tx_function`
+    :return: Tuple (rows written, rows per second)
+    """
+    start = time.perf_counter()
+    written = 0
+    failed = 0
+    in_flight = {}
+
+    def collect(done):
+        nonlocal written, failed
+        for future in done:
+            tag = in_flight.pop(future)
             try:
-                future.result()
+                count, result = future.result()
+                written += count
+                if stats is not None and result:
+                    stats.update(result)
             except Exception as e:
-                logger.error(f"Error during data ingestion: {e}")
+                failed += 1
+                logger.error(f"Error during {entity} ingestion: {e}")
+            else:
+                if on_done is not None:
+                    on_done(tag)
 
-def ingest_movies():
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for item in batches:
+            tag, rows = item if on_done is not None else (None, item)
+            if len(in_flight) >= max_in_flight:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                collect(done)
+            in_flight[executor.submit(write_batch, tx_function, rows)] = tag
+        done, _ = wait(list(in_flight))
+        collect(done)
+
+    elapsed = time.perf_counter() - start
+    rate = written / elapsed if elapsed > 0 else 0.0
+    logger.info(f"Ingested {written} {entity} in {elapsed:.1f}s ({rate:,.0f} rows/sec, {failed} failed batches).")
+    if failed:
+        raise RuntimeError(f"{failed} {entity} batches failed; rerun with --resume to continue from the checkpoint.")
+    return written, rate
+
+def ingest_file(entity, path, columns, tx_function, checkpoint, batcher=node_batches, manifest=None):
+    """
+    Stream one CSV into the graph, checkpointing after every fully written chunk.
+
+    When a manifest is given, the partition hashes of the file are recorded once it is
+    fully written, so that a later incremental run only has to look at what changed since
+    this load. A file resumed past its start was not hashed whole and is forgotten instead,
+    so the next incremental run applies all of it.
+    """
+    if entity in checkpoint["completed"]:
+        logger.info(f"Skipping {entity}: already ingested.")
+        return 0, 0.0
+    checkpointer = Checkpointer(checkpoint, entity)
+    if checkpointer.offset:
+        logger.info(f"Resuming {entity} at row {checkpointer.offset}.")
+    digests = {} if manifest is not None and not checkpointer.offset else None
+
+    def batches():
+        for chunk_start, chunk_end, frame in read_chunks(path, columns, checkpointer.offset):
+            chunk_batches = list(batcher(frame))
+            if digests is not None:
+                manifest.accumulate(digests, manifest.partition_ids(entity, frame), frame)
+            checkpointer.chunk_started(chunk_start, chunk_end, len(chunk_batches))
+            for rows in chunk_batches:
+                yield chunk_start, rows
+
+    result = ingest_batches(entity, batches(), tx_function, on_done=checkpointer.batch_done)
+    if manifest is not None:
+        manifest.replace(entity, digests)
+    checkpointer.complete()
+    return result
+
+def ingest_movies(checkpoint, manifest=None):
     logger.info("Ingesting movies...")
-    def ingest_movie_row(row):
-        with driver.session(database=database) as session:
-            session.write_transaction(create_movie, row.movieId, row.title, row.genres)
-    ingest_data(movies.itertuples(index=False, name=None), ingest_movie_row)
+    return ingest_file('movies', movies_path, COLUMNS['movies'], create_movies, checkpoint, manifest=manifest)
 
-def ingest_users():
+def ingest_users(checkpoint):
     logger.info("Ingesting users...")
-    unique_user_ids = set(pd.concat([tags['userId'], ratings['userId']]).unique())
-    def ingest_user_row(user_id):
-        with driver.session(database=database) as session:
-            session.write_transaction(create_user, user_id)
-    ingest_data(pd.DataFrame(unique_user_ids, columns=['userId']).itertuples(index=False, name=None), ingest_user_row)
+    if 'users' in checkpoint["completed"]:
+        logger.info("Skipping users: already ingested.")
+        return 0, 0.0
+    # Only the userId column is read, so even the largest dumps need memory per user, not per rating.
+    user_ids = set()
+    for path in (tags_path, ratings_path):
+        for _, _, frame in read_chunks(path, ['userId']):
+            user_ids.update(frame['userId'].tolist())
+    frame = pd.DataFrame(sorted(user_ids), columns=['userId'])
+    result = ingest_batches('users', node_batches(frame), create_users)
+    Checkpointer(checkpoint, 'users').complete()
+    return result
 
-def ingest_tags():
+def relationship_writer(create_function, merge_function, checkpoint, entity, resume):
+    # On resume, an unfinished file may have rows past its checkpoint, even in its very first
+    # chunk, that were already written by the interrupted run, so it is written with
+    # idempotent MERGEs instead of CREATEs.
+    return merge_function if resume and entity not in checkpoint["completed"] else create_function
+
+def ingest_tags(checkpoint, manifest=None, resume=False):
     logger.info("Ingesting tags...")
-    def ingest_tag_row(row):
-        with driver.session(database=database) as session:
-            session.write_transaction(create_tag, row.userId, row.movieId, row.tag, row.timestamp)
-    ingest_data(tags.itertuples(index=False, name=None), ingest_tag_row)
+    writer = relationship_writer(create_tags, merge_tags, checkpoint, 'tags', resume)
+    return ingest_file('tags', tags_path, COLUMNS['tags'], writer,
+                       checkpoint, relationship_batches, manifest)
 
-def ingest_links():
+def ingest_links(checkpoint, manifest=None):
     logger.info("Ingesting links...")
-    def ingest_link_row(row):
-        with driver.session(database=database) as session:
-            session.write_transaction(create_link, row.movieId, row.imdbId, row.tmdbId)
-    ingest_data(links.itertuples(index=False, name=None), ingest_link_row)
+    return ingest_file('links', links_path, COLUMNS['links'], create_links, checkpoint, manifest=manifest)
 
-def ingest_ratings():
+def ingest_ratings(checkpoint, manifest=None, resume=False):
     logger.info("Ingesting ratings...")
-    def ingest_rating_row(row):
-        with driver.session(database=database) as session:
-            session.write_transaction(create_rating, row.userId, row.movieId, row.rating, row.timestamp)
-    ingest_data(ratings.iloc[:500000].itertuples(index=False, name=None), ingest_rating_row)
+    writer = relationship_writer(create_ratings, merge_ratings, checkpoint, 'ratings', resume)
+    return ingest_file('ratings', ratings_path, COLUMNS['ratings'], writer,
+                       checkpoint, relationship_batches, manifest)
+
+def changed_partitions(entity, path, columns, manifest, stats, late):
+    """
+    Stream the partitions of a file whose content changed since the last run, reading the
+    file once.
+
+    A partition is buffered until a row of a higher partition is read, so a file sorted by
+    its key, as the MovieLens dumps are, needs memory for about one partition at a time.
+    Rows of a partition that show up after it was closed (an unsorted file) are always
+    yielded, as upserts are idempotent, and the partition's final hash is left in `late`.
+
+    :param late: Dictionary receiving partition -> hash of the partitions that reappeared,
+                 to be recorded once all writes succeeded
+    :return: Iterator of tuples (partition, hash, frame); the partition and hash are None
+             for late rows. Rows of unchanged partitions are counted as skipped in `stats`.
+    """
+    digests, buffers, closed = {}, {}, set()
+    highest = -1
+
+    def close(partition):
+        closed.add(partition)
+        frame = pd.concat(buffers.pop(partition))
+        digest = manifest.format(digests[partition])
+        if manifest.changed(entity, partition, digest):
+            return partition, digest, frame
+        stats['skipped'] += len(frame)
+        return None
+
+    for _, _, frame in read_chunks(path, columns):
+        partition_ids = manifest.partition_ids(entity, frame)
+        manifest.accumulate(digests, partition_ids, frame)
+        is_late = np.isin(partition_ids, list(closed))
+        if is_late.any():
+            late.update(dict.fromkeys(np.unique(partition_ids[is_late]).tolist()))
+            yield None, None, frame[is_late]
+            frame, partition_ids = frame[~is_late], partition_ids[~is_late]
+        for partition, rows in frame.groupby(partition_ids, sort=False):
+            buffers.setdefault(partition, []).append(rows)
+        if len(partition_ids):
+            highest = max(highest, int(partition_ids.max()))
+        for partition in sorted(partition for partition in buffers if partition < highest):
+            changed = close(partition)
+            if changed:
+                yield changed
+    for partition in sorted(buffers):
+        changed = close(partition)
+        if changed:
+            yield changed
+    for partition in late:
+        late[partition] = manifest.format(digests[partition])
+
+def upsert_file(entity, path, columns, tx_function, manifest, batcher=node_batches, users=None):
+    """
+    Apply the changed partitions of one file as idempotent upserts.
+
+    A partition is recorded in the manifest only once all of its batches are written, so
+    a failed run retries it next time.
+
+    :param users: Optional Counter; when given, the users referenced by the changed rows
+                  are upserted, and counted there, before the rows themselves are written
+    :return: Counter of inserted, updated and skipped rows
+    """
+    logger.info(f"Upserting changed {entity}...")
+    stats = Counter()
+    remaining = {}
+    late = {}
+    lock = threading.Lock()
+    seen_users = set()
+
+    def batches():
+        for sequence, (partition, digest, frame) in enumerate(
+                changed_partitions(entity, path, columns, manifest, stats, late)):
+            if users is not None:
+                new_users = set(frame['userId'].tolist()) - seen_users
+                seen_users.update(new_users)
+                # Written synchronously, so every user exists before its relationships are queued.
+                for rows in node_batches(pd.DataFrame(sorted(new_users), columns=['userId'])):
+                    users.update(write_batch(upsert_users, rows)[1])
+            partition_batches = list(batcher(frame))
+            with lock:
+                remaining[sequence] = [partition, digest, len(partition_batches)]
+            for rows in partition_batches:
+                yield sequence, rows
+
+    def batch_done(sequence):
+        with lock:
+            remaining[sequence][2] -= 1
+            if remaining[sequence][2] == 0:
+                partition, digest, _ = remaining.pop(sequence)
+                if partition is not None and partition not in late:
+                    manifest.record(entity, partition, digest)
+
+    ingest_batches(entity, batches(), tx_function, on_done=batch_done, stats=stats)
+    for partition, digest in late.items():
+        manifest.record(entity, partition, digest)
+    logger.info(f"{entity}: {stats['inserted']} inserted, {stats['updated']} updated, {stats['skipped']} skipped.")
+    return stats
+
+def ingest_incremental(manifest):
+    """
+    Refresh the graph from the CSVs without wiping it, writing only new or changed rows.
+
+    Users are derived from the changed tags and ratings as they are read. Rows removed from
+    the CSVs are not deleted from the graph.
+    """
+    report = {'movies': upsert_file('movies', movies_path, COLUMNS['movies'], upsert_movies, manifest)}
+    users = report['users'] = Counter()
+    report['tags'] = upsert_file('tags', tags_path, COLUMNS['tags'], upsert_tags,
+                                 manifest, relationship_batches, users)
+    report['links'] = upsert_file('links', links_path, COLUMNS['links'], upsert_links, manifest)
+    # The catalogue covers titles and the tag vocabulary served to the preferences page.
+    if any(report[entity]['inserted'] or report[entity]['updated'] for entity in ('movies', 'tags')):
+        bump_catalogue_version()
+    report['ratings'] = upsert_file('ratings', ratings_path, COLUMNS['ratings'],
+                                    upsert_ratings, manifest, relationship_batches, users)
+    return report
+
+def run_full_ingestion(resume):
+    if resume:
+        checkpoint = read_checkpoint()
+        logger.info(f"Resuming from checkpoint: {checkpoint}")
+    else:
+        clear_existing_data()
+        checkpoint = {"offsets": {}, "completed": []}
+        write_checkpoint(checkpoint)
+        if os.path.exists(manifest_file):
+            os.remove(manifest_file)
+    manifest = PartitionManifest()
+    report = {
+        'movies': ingest_movies(checkpoint, manifest),
+        'users': ingest_users(checkpoint),
+        'tags': ingest_tags(checkpoint, manifest, resume),
+        'links': ingest_links(checkpoint, manifest),
+    }
+    bump_catalogue_version()
+    report['ratings'] = ingest_ratings(checkpoint, manifest, resume)
+    # Bulk loads skip the per-row aggregate updates and rebuild them once at the end.
+    rebuild_movie_stats(get_connection())
+    close_connection()
+    for entity, (written, rate) in report.items():
+        logger.info(f"{entity}: {written} rows at {rate:,.0f} rows/sec")
+    logger.info("Data ingestion completed.")
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Load the MovieLens CSVs into Neo4j.")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--resume', action='store_true',
+                      help=f"continue from {checkpoint_file} instead of clearing the graph and starting over")
+    mode.add_argument('--incremental', action='store_true',
+                      help=f"keep the graph and upsert only partitions that changed since the last run ({manifest_file})")
+    args = parser.parse_args()
+
     logger.info("Starting data ingestion...")
-    clear_existing_data()
-    ingest_movies()
-    ingest_users()
-    ingest_tags()
-    ingest_links()
-    ingest_ratings()
-    driver.close()
-    logger.info("Data ingestion completed.")
+    create_indexes()
+    if args.incremental:
+        report = ingest_incremental(PartitionManifest())
+        close_connection()
+        for entity, stats in report.items():
+            logger.info(f"{entity}: {stats['inserted']} inserted, {stats['updated']} updated, {stats['skipped']} skipped")
+        logger.info("Incremental ingestion completed.")
+    else:
+        run_full_ingestion(args.resume)
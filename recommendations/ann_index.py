@@ -0,0 +1,288 @@
+import logging
+import threading
+import time
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_INDEX_PATH = './models/user_ann_index.npz'
+
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return np.divide(vectors, norms, out=np.zeros_like(vectors), where=norms > 0)
+
+
+class UserLSHIndex:
+    """
+    Approximate nearest-neighbour index over user latent vectors.
+
+    Uses random-hyperplane LSH for cosine similarity: each of `n_tables` tables hashes a
+    vector to an `n_bits` signature and keeps the signatures sorted, so a bucket is a
+    searchsorted range. Queries also probe every signature one bit away, then re-rank
+    the candidates by exact cosine. More tables or fewer bits raise recall at the cost
+    of latency; `recall_at_k` measures the tradeoff against exact search.
+
+    Inserted users are buffered and searched exhaustively until the buffer is merged
+    into the tables.
+    """
+
+    def __init__(self, n_tables=8, n_bits=16, dim=None, seed=0, merge_threshold=1024):
+        """
+        :param n_tables: Number of hash tables
+        :param n_bits: Number of hyperplanes per table (at most 64)
+        :param dim: Dimension of the indexed vectors
+        :param seed: Seed for the random hyperplanes
+        :param merge_threshold: Number of buffered inserts that triggers a merge
+        """
+        if not 0 < n_bits <= 64:
+            raise ValueError("n_bits must be between 1 and 64")
+        self.n_tables = n_tables
+        self.n_bits = n_bits
+        self.merge_threshold = merge_threshold
+        self.planes = None
+        if dim is not None:
+            rng = np.random.default_rng(seed)
+            self.planes = rng.standard_normal((n_tables, n_bits, dim)).astype(np.float32)
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._set_rows(np.empty(0, dtype=np.int64), np.empty((0, dim or 0), dtype=np.float32))
+
+    @classmethod
+    def build(cls, user_ids, vectors, **kwargs):
+        """
+        Build an index from user IDs and their latent vectors.
+
+        :param user_ids: Sequence of raw user IDs
+        :param vectors: Array of shape (n_users, n_factors)
+        :return: UserLSHIndex instance
+        """
+        vectors = np.asarray(vectors)
+        index = cls(dim=vectors.shape[1], **kwargs)
+        index._set_rows(np.asarray(user_ids, dtype=np.int64), _normalize(vectors))
+        return index
+
+    def _signatures(self, vectors):
+        bits = np.einsum('tbd,nd->tnb', self.planes, vectors) > 0
+        weights = np.left_shift(np.uint64(1), np.arange(self.n_bits, dtype=np.uint64))
+        return (bits.astype(np.uint64) * weights).sum(axis=2, dtype=np.uint64)
+
+    def _set_rows(self, user_ids, vectors):
+        self.ids = user_ids
+        self.vectors = vectors
+        self._removed = np.zeros(len(user_ids), dtype=bool)
+        self._positions = {user_id: row for row, user_id in enumerate(user_ids.tolist())}
+        if self.planes is None or not len(user_ids):
+            self.orders = np.empty((self.n_tables, 0), dtype=np.int64)
+            self.signatures = np.empty((self.n_tables, 0), dtype=np.uint64)
+            return
+        signatures = self._signatures(vectors)
+        self.orders = np.argsort(signatures, axis=1, kind="stable")
+        self.signatures = np.take_along_axis(signatures, self.orders, axis=1)
+
+    def __len__(self):
+        return int((~self._removed).sum()) + len(self._pending)
+
+    def __contains__(self, user_id):
+        return user_id in self._pending or (user_id in self._positions and not self._removed[self._positions[user_id]])
+
+    def get_vector(self, user_id):
+        """
+        Normalized vector of an indexed user, or None.
+        """
+        with self._lock:
+            if user_id in self._pending:
+                return self._pending[user_id]
+            row = self._positions.get(user_id)
+            if row is None or self._removed[row]:
+                return None
+            return self.vectors[row]
+
+    def insert(self, user_id, vector):
+        """
+        Add or replace a user, e.g. a newly registered user whose vector was folded in.
+
+        :param user_id: Raw user ID
+        :param vector: Latent vector of the user
+        """
+        with self._lock:
+            if self.planes is None:
+                self.planes = np.random.default_rng(0).standard_normal(
+                    (self.n_tables, self.n_bits, len(vector))).astype(np.float32)
+                self.vectors = self.vectors.reshape(0, len(vector))
+            row = self._positions.get(user_id)
+            if row is not None:
+                self._removed[row] = True
+            self._pending[user_id] = _normalize(vector)
+            if len(self._pending) >= self.merge_threshold:
+                self._merge()
+
+    def _merge(self):
+        keep = ~self._removed
+        pending_ids = np.fromiter(self._pending.keys(), dtype=np.int64, count=len(self._pending))
+        pending_vectors = np.stack(list(self._pending.values())).astype(np.float32)
+        self._pending = {}
+        self._set_rows(
+            np.concatenate([self.ids[keep], pending_ids]),
+            np.concatenate([self.vectors[keep], pending_vectors]),
+        )
+        logger.info(f"User ANN index merged: {len(self.ids)} users.")
+
+    def _candidates(self, query):
+        signatures = self._signatures(query[None, :])[:, 0]
+        flips = np.left_shift(np.uint64(1), np.arange(self.n_bits, dtype=np.uint64))
+        probes = np.concatenate([signatures[:, None], signatures[:, None] ^ flips[None, :]], axis=1)
+
+        rows = []
+        for table in range(self.n_tables):
+            table_signatures = self.signatures[table]
+            starts = np.searchsorted(table_signatures, probes[table], side='left')
+            lengths = np.searchsorted(table_signatures, probes[table], side='right') - starts
+            total = int(lengths.sum())
+            if total:
+                offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(total)
+                rows.append(self.orders[table][offsets])
+        if not rows:
+            return np.empty(0, dtype=np.int64)
+        candidates = np.unique(np.concatenate(rows))
+        return candidates[~self._removed[candidates]]
+
+    def query(self, vector, top_n=10, exclude=None):
+        """
+        Find the users whose vectors are most similar to `vector`.
+
+        :param vector: Query latent vector
+        :param top_n: Number of users to return
+        :param exclude: Optional user ID to leave out, usually the querying user
+        :return: List of tuples (user_id, cosine_similarity)
+        """
+        query = _normalize(vector)
+        with self._lock:
+            pending = dict(self._pending)
+            candidates = self._candidates(query) if len(self.ids) else np.empty(0, dtype=np.int64)
+            ids = self.ids[candidates]
+            scores = self.vectors[candidates] @ query
+
+        if pending:
+            ids = np.concatenate([ids, np.fromiter(pending.keys(), dtype=np.int64, count=len(pending))])
+            scores = np.concatenate([scores, np.stack(list(pending.values())) @ query])
+        if exclude is not None:
+            keep = ids != exclude
+            ids, scores = ids[keep], scores[keep]
+        return self._top(ids, scores, top_n)
+
+    def exact_query(self, vector, top_n=10, exclude=None):
+        """
+        Exhaustive counterpart of `query`, used as the reference for recall.
+        """
+        query = _normalize(vector)
+        with self._lock:
+            keep = ~self._removed
+            ids, scores = self.ids[keep], self.vectors[keep] @ query
+            if self._pending:
+                ids = np.concatenate([ids, np.fromiter(self._pending.keys(), dtype=np.int64, count=len(self._pending))])
+                scores = np.concatenate([scores, np.stack(list(self._pending.values())) @ query])
+        if exclude is not None:
+            keep = ids != exclude
+            ids, scores = ids[keep], scores[keep]
+        return self._top(ids, scores, top_n)
+
+    @staticmethod
+    def _top(ids, scores, top_n):
+        if not len(ids) or top_n <= 0:
+            return []
+        k = min(top_n, len(ids))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [(int(ids[i]), float(scores[i])) for i in top]
+
+    def recall_at_k(self, k=10, sample_size=200, seed=0):
+        """
+        Compare approximate and exact search on a sample of indexed users.
+
+        :param k: Number of neighbours per query
+        :param sample_size: Number of users to query
+        :param seed: Seed for the sample
+        :return: Dictionary with mean recall@k and mean latencies in milliseconds
+        """
+        live = np.flatnonzero(~self._removed)
+        if not len(live):
+            return {"k": k, "queries": 0, "recall": 0.0, "approx_ms": 0.0, "exact_ms": 0.0}
+        sample = np.random.default_rng(seed).choice(live, size=min(sample_size, len(live)), replace=False)
+
+        recalls, approx_time, exact_time = [], 0.0, 0.0
+        for row in sample:
+            user_id, vector = int(self.ids[row]), self.vectors[row]
+            start = time.perf_counter()
+            approx = self.query(vector, k, exclude=user_id)
+            approx_time += time.perf_counter() - start
+            start = time.perf_counter()
+            exact = self.exact_query(vector, k, exclude=user_id)
+            exact_time += time.perf_counter() - start
+            if exact:
+                recalls.append(len({u for u, _ in approx} & {u for u, _ in exact}) / len(exact))
+
+        return {
+            "k": k,
+            "queries": len(sample),
+            "recall": float(np.mean(recalls)) if recalls else 0.0,
+            "approx_ms": 1000 * approx_time / len(sample),
+            "exact_ms": 1000 * exact_time / len(sample),
+        }
+
+    def save(self, path=DEFAULT_INDEX_PATH):
+        """
+        Persist the index, including buffered inserts, to a `.npz` file.
+        """
+        with self._lock:
+            if self._pending:
+                self._merge()
+            keep = ~self._removed
+            if not keep.all():
+                self._set_rows(self.ids[keep], self.vectors[keep])
+            np.savez(path, ids=self.ids, vectors=self.vectors, planes=self.planes,
+                     orders=self.orders, signatures=self.signatures,
+                     config=np.array([self.n_tables, self.n_bits, self.merge_threshold]))
+        logger.info(f"User ANN index saved to {path}.")
+
+    @classmethod
+    def load(cls, path=DEFAULT_INDEX_PATH):
+        """
+        Load an index written by `save`.
+        """
+        with np.load(path) as data:
+            n_tables, n_bits, merge_threshold = (int(value) for value in data["config"])
+            index = cls(n_tables=n_tables, n_bits=n_bits, merge_threshold=merge_threshold)
+            index.planes = data["planes"]
+            index.ids = data["ids"]
+            index.vectors = data["vectors"]
+            index.orders = data["orders"]
+            index.signatures = data["signatures"]
+        index._removed = np.zeros(len(index.ids), dtype=bool)
+        index._positions = {user_id: row for row, user_id in enumerate(index.ids.tolist())}
+        logger.info(f"User ANN index loaded from {path}: {len(index.ids)} users.")
+        return index
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from .factor_model import load_serving_model
+
+    parser = argparse.ArgumentParser(description="Build the user ANN index from the trained model and report recall@k.")
+    parser.add_argument('--output', default=DEFAULT_INDEX_PATH)
+    parser.add_argument('--tables', type=int, default=8)
+    parser.add_argument('--bits', type=int, default=16)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--sample', type=int, default=200)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    factors = load_serving_model()
+    start = time.perf_counter()
+    ann_index = UserLSHIndex.build(factors.user_ids, factors.user_factors, n_tables=args.tables, n_bits=args.bits)
+    logger.info(f"Built index over {len(ann_index)} users in {time.perf_counter() - start:.2f}s.")
+    logger.info(f"Recall check: {ann_index.recall_at_k(k=args.k, sample_size=args.sample)}")
+    ann_index.save(args.output)
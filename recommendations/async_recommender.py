@@ -0,0 +1,102 @@
+from .context import UserContext
+from .metrics import STAGE_SECONDS, stage
+from .utils import get_user_ratings_async
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+class AsyncHybridRecommender:
+    """
+    Serves a HybridRecommender from an asyncio event loop.
+
+    The trained model, rating matrix, ANN index and genre index are shared with the wrapped
+    recommender. Graph reads go through an AsyncNeo4jConnection, with independent reads
+    issued concurrently, and CPU-bound steps run in worker threads so the loop stays free.
+    """
+
+    def __init__(self, recommender, connection, latency_budget=None):
+        """
+        :param recommender: HybridRecommender instance
+        :param connection: AsyncNeo4jConnection instance
+        :param latency_budget: Default seconds a request waits for its branches, None to wait for all
+        """
+        self.recommender = recommender
+        self.collaborative_filtering = recommender.collaborative_filtering
+        self.content_based_filtering = recommender.content_based_filtering
+        self.connection = connection
+        self.latency_budget = latency_budget
+
+    async def generate(self, generator, user_id, user_ratings):
+        """
+        Candidates of one generator, read through the async connection if the generator
+        supports it, else from a UserContext on the wrapped recommender's connection in a
+        worker thread.
+        """
+        if hasattr(generator, "generate_async"):
+            return await generator.generate_async(self.connection, user_id, user_ratings)
+        context = UserContext(self.recommender.connection, user_id)
+        return await asyncio.to_thread(generator.generate, user_id, context)
+
+    async def recommend_within_budget(self, user_id, limit=12, latency_budget=None):
+        """
+        Async counterpart of HybridRecommender.recommend_within_budget.
+
+        The user's ratings are read once and shared by the candidate generators. Generators
+        missing the deadline are cancelled and the result is flagged as degraded; the
+        candidates of the others are ranked in a worker thread.
+
+        :param user_id: User ID
+        :param limit: Number of recommendations to return
+        :param latency_budget: Seconds to wait for the branches, defaults to the recommender's budget
+        :return: Dictionary with recommendations, degraded, and per-branch status and elapsed milliseconds
+        """
+        budget = latency_budget if latency_budget is not None else self.latency_budget
+
+        start = time.perf_counter()
+        with stage("collaborative.user_ratings"):
+            user_ratings = await get_user_ratings_async(self.connection, user_id)
+        tasks = [
+            (generator.name, asyncio.create_task(self._timed(generator, user_id, user_ratings)))
+            for generator in self.recommender.generators
+        ]
+        remaining = None if budget is None else max(0.0, budget - (time.perf_counter() - start))
+        await asyncio.wait([task for _, task in tasks], timeout=remaining)
+
+        results = {}
+        timings = {}
+        for name, task in tasks:
+            if not task.done():
+                task.cancel()
+                timings[name] = {"status": "timeout", "ms": round((time.perf_counter() - start) * 1000, 1)}
+                logger.warning(f"{name} branch missed the {budget}s budget for user {user_id}")
+                continue
+            if task.exception() is not None:
+                timings[name] = {"status": "error", "ms": round((time.perf_counter() - start) * 1000, 1)}
+                logger.error(f"{name} branch failed for user {user_id}: {task.exception()}")
+                continue
+            candidates, elapsed = task.result()
+            timings[name] = {"status": "ok", "ms": round(elapsed * 1000, 1)}
+            results[name] = candidates
+
+        combined_recs = await asyncio.to_thread(self.recommender.rank, user_id, results, limit)
+        degraded = len(results) < len(tasks)
+        logger.debug(f"Combined {len(combined_recs)} recommendations for user {user_id} (degraded={degraded}): {timings}")
+        STAGE_SECONDS.observe(time.perf_counter() - start, "hybrid.recommend")
+        return {"recommendations": combined_recs, "degraded": degraded, "timings": timings}
+
+    async def _timed(self, generator, user_id, user_ratings):
+        start = time.perf_counter()
+        candidates = await self.generate(generator, user_id, user_ratings)
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, f"hybrid.{generator.name}")
+        logger.debug(f"{generator.name} branch for user {user_id}: {len(candidates)} candidates in {elapsed * 1000:.1f} ms")
+        return candidates, elapsed
+
+    async def refresh_user(self, user_id):
+        """
+        Async counterpart of CollaborativeFiltering.refresh_user.
+        """
+        user_ratings = await get_user_ratings_async(self.connection, user_id)
+        await asyncio.to_thread(self.collaborative_filtering.apply_user_ratings, user_id, user_ratings)
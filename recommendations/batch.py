@@ -0,0 +1,416 @@
+import logging
+import os
+import time
+
+import numpy as np
+
+from backend.user_check import find_new_users
+from .context import UserContext
+from .pipeline import GenreCandidates, NeighbourCandidates
+from .utils import get_users_ratings, get_users_top_ratings
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PRECOMPUTED_PATH = './models/precomputed_recommendations.npz'
+
+# Users whose predicted ratings are held in memory at once while ranking a batch.
+PREDICT_BLOCK_ROWS = 256
+
+# Replaces a user's RECOMMENDED edges with a freshly computed list.
+WRITE_RECOMMENDED = """
+UNWIND $rows AS row
+MATCH (u:User {userId: row.userId})
+OPTIONAL MATCH (u)-[old:RECOMMENDED]->()
+DELETE old
+WITH DISTINCT u, row
+UNWIND range(0, size(row.movieIds) - 1) AS rank
+MATCH (m:Movie {movieId: row.movieIds[rank]})
+CREATE (u)-[:RECOMMENDED {rank: rank, score: row.scores[rank], computedAt: $computed_at}]->(m)
+"""
+
+
+class BatchRecommender:
+    """
+    Hybrid recommendations for many users at once, ranked as HybridRecommender ranks a
+    single request: the candidates of its generators fused by its Ranker.
+
+    Graph reads are shared across the batch: one query for the ratings of all requested
+    users and one for the top ratings of all their neighbours. Predicted ratings come from
+    one prediction matrix per block of users over the union of their candidates.
+    Neighbours are found in the rating matrix or ANN index; SIMILAR edges are not read.
+    """
+
+    def __init__(self, hybrid_recommender, cold_start_recommender=None, connection=None):
+        """
+        :param hybrid_recommender: HybridRecommender whose generators and ranker are batched
+        :param cold_start_recommender: ColdStartRecommender used for new users
+        :param connection: Neo4jConnection instance, defaults to the collaborative filter's
+        """
+        self.hybrid_recommender = hybrid_recommender
+        self.collaborative_filtering = hybrid_recommender.collaborative_filtering
+        self.content_based_filtering = hybrid_recommender.content_based_filtering
+        self.cold_start_recommender = cold_start_recommender
+        self.connection = connection if connection is not None else self.collaborative_filtering.connection
+
+    def recommend_many(self, user_ids, limit=12):
+        """
+        Recommendations for every user of a batch, in the format of `compute_recommendations`.
+
+        :param user_ids: User IDs; duplicates are answered once
+        :param limit: Number of recommendations per user
+        :return: List of dictionaries with userId, is_new_user and recommendations, in request order
+        """
+        user_ids = list(dict.fromkeys(int(user_id) for user_id in user_ids))
+        ratings = get_users_ratings(self.connection, user_ids)
+        rated = [user_id for user_id in user_ids if ratings.get(user_id)]
+        new_users = find_new_users(self.connection, [user_id for user_id in user_ids if not ratings.get(user_id)])
+
+        ranked = self.rank_hybrid(
+            rated, ratings, lambda neighbours, per_user: get_users_top_ratings(self.connection, neighbours, per_user),
+            limit)
+        cold_start_recs = (
+            self.cold_start_recommender.recommend_for_new_user()
+            if new_users and self.cold_start_recommender is not None else []
+        )
+
+        results = []
+        for user_id in user_ids:
+            if user_id in new_users:
+                results.append({"userId": user_id, "is_new_user": True, "recommendations": cold_start_recs})
+                continue
+            results.append({
+                "userId": user_id,
+                "is_new_user": False,
+                "recommendations": self.hybrid_recommender.with_details(ranked.get(user_id, [])),
+            })
+        logger.info(f"Batch of {len(user_ids)} users: {len(rated)} rated, {len(new_users)} new.")
+        return results
+
+    def rank_hybrid(self, user_ids, user_ratings, fetch_top_ratings, limit):
+        """
+        Hybrid ranking for a batch of users with shared neighbour reads and predictions.
+
+        :param user_ids: Users to rank for, each with ratings in `user_ratings`
+        :param user_ratings: Dictionary of userId -> list of tuples (movieId, rating)
+        :param fetch_top_ratings: Callable taking neighbour IDs and a number of ratings per
+            neighbour, returning a dictionary of userId -> their highest ratings, as
+            `get_users_top_ratings` does
+        :param limit: Number of movies per user
+        :return: Dictionary of userId -> list of tuples (movieId, fused score, predicted rating)
+        """
+        if not user_ids:
+            return {}
+        # The whole batch is ranked with one model version, even across a reload.
+        model = self.collaborative_filtering.model
+        factors = model[0]
+        neighbour_candidates = self.neighbour_candidates(user_ids, user_ratings, fetch_top_ratings, model)
+        ranker = self.hybrid_recommender.ranker
+
+        ranked = {}
+        # Predictions are made a block of users at a time, so memory stays at
+        # PREDICT_BLOCK_ROWS x the block's candidates however large the batch is.
+        for block_start in range(0, len(user_ids), PREDICT_BLOCK_ROWS):
+            block = user_ids[block_start:block_start + PREDICT_BLOCK_ROWS]
+            candidate_sets = {user_id: self.candidate_sets(user_id, user_ratings[user_id], neighbour_candidates)
+                              for user_id in block}
+            movie_ids = np.unique(np.concatenate(
+                [np.zeros(0, dtype=np.int64)]
+                + [candidates.movie_ids for sets in candidate_sets.values() for candidates in sets.values()]))
+            predicted = factors.predict_many(block, movie_ids)
+            for row, user_id in enumerate(block):
+                ranked[user_id] = ranker.rank(
+                    candidate_sets[user_id],
+                    lambda candidate_ids, row=row: predicted[row, np.searchsorted(movie_ids, candidate_ids)],
+                    factors.rating_scale, limit)
+        return ranked
+
+    def neighbour_candidates(self, user_ids, user_ratings, fetch_top_ratings, model):
+        """
+        Candidates of the hybrid's NeighbourCandidates generators for a batch, with one read
+        of the top ratings of all neighbours per generator.
+
+        :return: Dictionary of generator name -> dictionary of userId -> Candidates
+        """
+        cf = self.collaborative_filtering
+        candidates = {}
+        for generator in self.hybrid_recommender.generators:
+            if not isinstance(generator, NeighbourCandidates):
+                continue
+            similar = {user_id: cf.find_similar_users(user_id, user_ratings[user_id], generator.neighbours, model=model)
+                       for user_id in user_ids}
+            neighbours = sorted({neighbour for users in similar.values() for neighbour, _ in users})
+            top_ratings = fetch_top_ratings(neighbours, generator.neighbour_ratings)
+            candidates[generator.name] = {
+                user_id: generator.score(user_ratings[user_id], users,
+                                         [top_ratings.get(neighbour, []) for neighbour, _ in users])
+                for user_id, users in similar.items()
+            }
+        return candidates
+
+    def candidate_sets(self, user_id, user_ratings, neighbour_candidates):
+        """
+        Candidates of every generator of the hybrid recommender for one user of a batch.
+        Generators other than the built-in ones read the graph through a UserContext.
+
+        :return: Dictionary of generator name -> Candidates
+        """
+        candidate_sets = {}
+        for generator in self.hybrid_recommender.generators:
+            if isinstance(generator, NeighbourCandidates):
+                candidate_sets[generator.name] = neighbour_candidates[generator.name][user_id]
+            elif isinstance(generator, GenreCandidates):
+                candidate_sets[generator.name] = generator.score(user_ratings)
+            else:
+                candidate_sets[generator.name] = generator.generate(user_id, UserContext(self.connection, user_id))
+        return candidate_sets
+
+
+class PrecomputedRecommendations:
+    """
+    Top-N lists computed offline, stored in CSR layout: the list of `user_ids[i]` is
+    `movie_ids[offsets[i]:offsets[i + 1]]` with matching fused `scores` and `predicted`
+    ratings, as HybridRecommender.rank returns them.
+
+    `versions[i]` is the user's RecommendationCache version when the job started. A user
+    whose version moved on since, because their ratings changed in any worker sharing the
+    cache, is answered online again. Lists older than `ttl` seconds are not served at all.
+    """
+
+    def __init__(self, user_ids, offsets, movie_ids, scores, predicted, created_at=None, versions=None, ttl=None):
+        self.user_ids = np.asarray(user_ids, dtype=np.int64)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.movie_ids = np.asarray(movie_ids, dtype=np.int64)
+        self.scores = np.asarray(scores, dtype=np.float32)
+        self.predicted = np.asarray(predicted, dtype=np.float32)
+        self.created_at = created_at if created_at is not None else time.time()
+        self.versions = (np.asarray(versions, dtype=np.int64) if versions is not None
+                         else np.zeros(len(self.user_ids), dtype=np.int64))
+        self.ttl = ttl
+
+    def __len__(self):
+        return len(self.user_ids)
+
+    def expired(self):
+        return self.ttl is not None and time.time() > self.created_at + self.ttl
+
+    def get(self, user_id, version=None):
+        """
+        Precomputed list of a user.
+
+        :param user_id: User ID
+        :param version: The user's current RecommendationCache version, or None to skip the check
+        :return: List of tuples (movieId, fused score, predicted rating or None), or None if the
+            user has no current list
+        """
+        if self.expired():
+            return None
+        position = np.searchsorted(self.user_ids, user_id)
+        if position >= len(self.user_ids) or self.user_ids[position] != user_id:
+            return None
+        if version is not None and self.versions[position] != version:
+            return None
+        start, end = self.offsets[position], self.offsets[position + 1]
+        return [
+            (int(movie_id), float(score), None if np.isnan(predicted) else float(predicted))
+            for movie_id, score, predicted
+            in zip(self.movie_ids[start:end], self.scores[start:end], self.predicted[start:end])
+        ]
+
+    def save(self, path=DEFAULT_PRECOMPUTED_PATH):
+        temp_path = path + '.tmp.npz'
+        np.savez(temp_path, user_ids=self.user_ids, offsets=self.offsets, movie_ids=self.movie_ids,
+                 scores=self.scores, predicted=self.predicted, created_at=np.array(self.created_at), versions=self.versions)
+        os.replace(temp_path, path)
+        logger.info(f"Precomputed recommendations of {len(self)} users saved to {path}.")
+
+    @classmethod
+    def load(cls, path=DEFAULT_PRECOMPUTED_PATH, ttl=None):
+        """
+        :param ttl: Seconds after the lists were computed during which they are served, or None for no expiry
+        """
+        with np.load(path) as data:
+            if "predicted" not in data.files:
+                raise ValueError(f"{path} was written before lists were fused; rerun `python -m recommendations.batch`")
+            precomputed = cls(data["user_ids"], data["offsets"], data["movie_ids"], data["scores"], data["predicted"],
+                              float(data["created_at"]), data["versions"] if "versions" in data.files else None, ttl)
+        logger.info(f"Precomputed recommendations of {len(precomputed)} users loaded from {path}.")
+        return precomputed
+
+    @classmethod
+    def from_lists(cls, lists, created_at=None, versions=None):
+        """
+        :param lists: Dictionary of userId -> list of tuples (movieId, fused score, predicted rating or None)
+        :param versions: Optional dictionary of userId -> RecommendationCache version; missing users get 0
+        """
+        user_ids = np.array(sorted(lists), dtype=np.int64)
+        lengths = [len(lists[user_id]) for user_id in user_ids.tolist()]
+        offsets = np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)])
+        entries = [entry for user_id in user_ids.tolist() for entry in lists[user_id]]
+        movie_ids = np.array([movie_id for movie_id, _, _ in entries], dtype=np.int64)
+        scores = np.array([score for _, score, _ in entries], dtype=np.float32)
+        predicted = np.array([np.nan if rating is None else rating for _, _, rating in entries], dtype=np.float32)
+        versions = [(versions or {}).get(user_id, 0) for user_id in user_ids.tolist()]
+        return cls(user_ids, offsets, movie_ids, scores, predicted, created_at, versions)
+
+    def with_details(self, user_id, genre_index, version=None):
+        """
+        A user's precomputed list in the response format of the online recommenders.
+
+        :param user_id: User ID
+        :param genre_index: GenreIndex providing titles and genres
+        :param version: The user's current RecommendationCache version, or None to skip the check
+        :return: List of recommended movies, or None if the user has no current list
+        """
+        entries = self.get(user_id, version)
+        if entries is None:
+            return None
+        details = genre_index.movie_details([movie_id for movie_id, _, _ in entries])
+        return [
+            {"movieId": movie_id, **details[movie_id], "predictedRating": predicted, "score": score}
+            for movie_id, score, predicted in entries if movie_id in details
+        ]
+
+
+# State inherited by the forked workers of `precompute_all`.
+_worker_batch = None
+_worker_limit = None
+
+
+def _precompute_chunk(user_ids):
+    batch = _worker_batch
+    matrix = batch.collaborative_filtering.rating_matrix
+    ratings = {user_id: matrix.get_user_ratings(user_id) for user_id in user_ids}
+    rated = [user_id for user_id in user_ids if ratings[user_id]]
+    ranked = batch.rank_hybrid(rated, ratings, lambda neighbours, per_user: _top_ratings(matrix, neighbours, per_user),
+                               _worker_limit)
+    return {user_id: ranked.get(user_id, []) for user_id in user_ids}
+
+
+def _top_ratings(matrix, user_ids, per_user):
+    # Same order and cap as USERS_TOP_RATINGS, read from the rating matrix.
+    top_ratings = {}
+    for user_id in user_ids:
+        ratings = matrix.get_user_ratings(user_id)
+        if ratings:
+            top_ratings[user_id] = sorted(ratings, key=lambda entry: (-entry[1], entry[0]))[:per_user]
+    return top_ratings
+
+
+def precompute_all(batch_recommender, user_ids, limit=12, workers=None, chunk_size=256, versions=None):
+    """
+    Compute the hybrid list of every user across all CPU cores, from the in-memory rating
+    matrix and genre index only.
+
+    Workers are forked after the recommender is loaded, so the model, matrix and index are
+    shared copy-on-write instead of being pickled to each process.
+
+    :param batch_recommender: BatchRecommender whose rating matrix and genre index are loaded
+    :param user_ids: Users to compute lists for
+    :param limit: Number of recommendations per user
+    :param workers: Number of processes, defaults to the CPU count
+    :param chunk_size: Users per task
+    :param versions: Optional dictionary of userId -> RecommendationCache version, read
+                     before the job loaded its ratings
+    :return: PrecomputedRecommendations instance
+    """
+    import multiprocessing
+
+    global _worker_batch, _worker_limit
+    _worker_batch, _worker_limit = batch_recommender, limit
+    chunks = [list(user_ids[start:start + chunk_size]) for start in range(0, len(user_ids), chunk_size)]
+    workers = workers or os.cpu_count()
+
+    start = time.perf_counter()
+    lists = {}
+    if workers == 1:
+        for chunk in chunks:
+            lists.update(_precompute_chunk(chunk))
+    else:
+        with multiprocessing.get_context("fork").Pool(workers) as pool:
+            for done, chunk_lists in enumerate(pool.imap_unordered(_precompute_chunk, chunks), start=1):
+                lists.update(chunk_lists)
+                if done % 20 == 0 or done == len(chunks):
+                    logger.info(f"Precomputed {len(lists)}/{len(user_ids)} users.")
+    elapsed = time.perf_counter() - start
+    logger.info(f"Precomputed {len(lists)} users with {workers} workers in {elapsed:.1f}s "
+                f"({len(lists) / max(elapsed, 1e-9):,.0f} users/sec).")
+    return PrecomputedRecommendations.from_lists(lists, versions=versions)
+
+
+def write_recommended_edges(connection, precomputed, batch_size=500):
+    """
+    Store precomputed lists as (:User)-[:RECOMMENDED {rank, score, computedAt}]->(:Movie) edges.
+
+    :param connection: Neo4jConnection instance
+    :param precomputed: PrecomputedRecommendations instance
+    :param batch_size: Users per write transaction
+    """
+    user_ids = precomputed.user_ids.tolist()
+    with connection.session() as session:
+        for start in range(0, len(user_ids), batch_size):
+            rows = []
+            for user_id in user_ids[start:start + batch_size]:
+                entries = precomputed.get(user_id)
+                rows.append({
+                    "userId": user_id,
+                    "movieIds": [movie_id for movie_id, _, _ in entries],
+                    "scores": [score for _, score, _ in entries],
+                })
+            session.execute_write(lambda tx: tx.run(WRITE_RECOMMENDED, rows=rows, computed_at=precomputed.created_at).consume())
+    logger.info(f"RECOMMENDED edges written for {len(user_ids)} users.")
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from .utils import get_connection, close_connection
+    from .cache import create_recommendation_cache
+    from .snapshot import EXPORT_USERS
+    from .hybrid import HybridRecommender
+    from .collaborative_filtering import CollaborativeFiltering
+    from .content_based import ContentBasedFiltering
+    from .genre_index import GenreIndex
+
+    parser = argparse.ArgumentParser(description="Precompute hybrid recommendations for every user.")
+    parser.add_argument('--output', default=DEFAULT_PRECOMPUTED_PATH)
+    parser.add_argument('--limit', type=int, default=12)
+    parser.add_argument('--workers', type=int, default=None, help="processes, defaults to the CPU count")
+    parser.add_argument('--chunk-size', type=int, default=256)
+    parser.add_argument('--edges', action='store_true', help="also write the lists as RECOMMENDED edges")
+    parser.add_argument('--snapshot', default=None,
+                        help="read users, movies and ratings from a snapshot root instead of the graph")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    # Per-user logs of the content branch would flood the job output.
+    logging.getLogger('recommendations.content_based').setLevel(logging.WARNING)
+
+    if args.snapshot:
+        from .snapshot import SnapshotConnection
+        from .utils import set_connection
+
+        if args.edges:
+            parser.error("--edges writes to the graph and cannot be used with --snapshot")
+        set_connection(SnapshotConnection.load(args.snapshot))
+    connection = get_connection()
+    # Cache versions are read before any rating, so a change made while the job runs makes
+    # the user's list stale instead of being silently missed. They only carry over to the
+    # app when RECOMMENDATION_CACHE_URL points both at the same shared store.
+    cache = create_recommendation_cache()
+    versions = {record["userId"]: cache.version(record["userId"]) for record in connection.query(EXPORT_USERS)}
+    collaborative_filtering = CollaborativeFiltering(connection)
+    # The catalogue is frozen for the job so workers never query the graph.
+    genre_index = GenreIndex.from_connection(connection, check_interval=float('inf'))
+    hybrid = HybridRecommender(
+        connection,
+        collaborative_filtering=collaborative_filtering,
+        content_based_filtering=ContentBasedFiltering(connection, genre_index=genre_index),
+    )
+    batch = BatchRecommender(hybrid)
+    matrix = collaborative_filtering.rating_matrix
+
+    precomputed = precompute_all(batch, matrix.user_ids, args.limit, args.workers, args.chunk_size, versions)
+    precomputed.save(args.output)
+    if args.edges:
+        write_recommended_edges(connection, precomputed)
+    close_connection()
@@ -0,0 +1,253 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class InProcessBackend:
+    """
+    LRU cache held in the worker process, bounded by entry count and approximate size.
+
+    Values must be JSON-serializable; their encoded length is used as their size.
+    Counters (used for per-user versions) are kept in their own LRU of `max_counters`. An
+    evicted counter raises a floor that missing counters start from, so a counter never
+    goes back to a value it had before and stale entries are never served again.
+    """
+
+    def __init__(self, max_entries=10000, max_bytes=64 * 1024 * 1024, max_counters=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_counters = max_counters if max_counters is not None else max_entries
+        self._entries = OrderedDict()
+        self._counters = OrderedDict()
+        self._counter_floor = 0
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, size, expires_at = entry
+            if expires_at <= time.monotonic():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        size = len(json.dumps(value))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, size, time.monotonic() + ttl)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def incr(self, key):
+        with self._lock:
+            self._counters[key] = self._counters.get(key, self._counter_floor) + 1
+            self._counters.move_to_end(key)
+            while len(self._counters) > self.max_counters:
+                _, value = self._counters.popitem(last=False)
+                self._counter_floor = max(self._counter_floor, value)
+            return self._counters[key]
+
+    def get_counter(self, key):
+        with self._lock:
+            if key not in self._counters:
+                return self._counter_floor
+            self._counters.move_to_end(key)
+            return self._counters[key]
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._bytes, "evictions": self.evictions,
+                    "counters": len(self._counters)}
+
+
+class SharedStoreBackend:
+    """
+    Cache stored in a shared key-value store so that several workers share hits.
+
+    `client` needs the Redis subset `get`, `set(key, value, ex=seconds)`, `delete` and
+    `incr`; a `redis.Redis` instance or `LocalStore` both work.
+    """
+
+    def __init__(self, client, prefix="recs:"):
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return json.loads(value) if value is not None else None
+
+    def set(self, key, value, ttl):
+        self.client.set(self.prefix + key, json.dumps(value), ex=max(1, int(ttl)))
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def incr(self, key):
+        return int(self.client.incr(self.prefix + key))
+
+    def get_counter(self, key):
+        value = self.client.get(self.prefix + key)
+        return int(value) if value is not None else 0
+
+    def stats(self):
+        return {}
+
+
+class LocalStore:
+    """
+    In-memory stand-in for a Redis client, implementing what SharedStoreBackend uses.
+    Several SharedStoreBackend instances over one LocalStore behave like workers sharing a store.
+    """
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value, expires_at = self._data.get(key, (None, None))
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._data[key]
+                return None
+            return value
+
+    def set(self, key, value, ex=None):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ex if ex else None)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def incr(self, key):
+        with self._lock:
+            value, expires_at = self._data.get(key, (0, None))
+            self._data[key] = (str(int(value) + 1), expires_at)
+            return int(value) + 1
+
+
+class RecommendationCache:
+    """
+    Per-user cache of recommendation results.
+
+    Entries are keyed by a per-user version; `invalidate` bumps the version, so every
+    entry of that user is bypassed at once and then ages out.
+    """
+
+    def __init__(self, backend=None, ttl=300.0):
+        """
+        :param backend: InProcessBackend (default) or SharedStoreBackend
+        :param ttl: Seconds an entry stays valid
+        """
+        self.backend = backend if backend is not None else InProcessBackend()
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def version(self, user_id):
+        """
+        Current version of a user's entries, bumped by every `invalidate`.
+        """
+        return self.backend.get_counter(f"version:{user_id}")
+
+    def _key(self, user_id, name):
+        return f"{name}:{user_id}:v{self.version(user_id)}"
+
+    def get_or_compute(self, user_id, name, compute, store_if=None):
+        """
+        Return the cached value for a user, computing and storing it on a miss.
+
+        :param user_id: User the value belongs to
+        :param name: Name of the cached value, e.g. the endpoint and its parameters
+        :param compute: Callable producing the value on a miss
+        :param store_if: Optional predicate; computed values failing it are returned but not stored
+        :return: Cached or freshly computed value
+        """
+        key, value = self._lookup(user_id, name)
+        if value is None:
+            value = compute()
+            self._store(key, value, store_if)
+        return value
+
+    async def get_or_compute_async(self, user_id, name, compute, store_if=None):
+        """
+        Same as `get_or_compute`, awaiting `compute` (a coroutine function) on a miss.
+        """
+        key, value = self._lookup(user_id, name)
+        if value is None:
+            value = await compute()
+            self._store(key, value, store_if)
+        return value
+
+    def _lookup(self, user_id, name):
+        key = self._key(user_id, name)
+        value = self.backend.get(key)
+        with self._lock:
+            if value is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return key, value
+
+    def _store(self, key, value, store_if):
+        if store_if is None or store_if(value):
+            self.backend.set(key, value, self.ttl)
+
+    def invalidate(self, user_id):
+        """
+        Drop every cached value of a user, e.g. after their ratings changed.
+        """
+        self.backend.incr(f"version:{user_id}")
+
+    def stats(self):
+        with self._lock:
+            stats = {"hits": self.hits, "misses": self.misses}
+        stats.update(self.backend.stats())
+        return stats
+
+
+def create_recommendation_cache():
+    """
+    Build the cache configured by the environment.
+
+    RECOMMENDATION_CACHE_URL selects a shared Redis store (requires the `redis` package);
+    otherwise the cache is in-process, bounded by RECOMMENDATION_CACHE_MAX_ENTRIES and
+    RECOMMENDATION_CACHE_MAX_BYTES. RECOMMENDATION_CACHE_TTL sets the entry lifetime.
+    """
+    ttl = float(os.getenv('RECOMMENDATION_CACHE_TTL', 300))
+    url = os.getenv('RECOMMENDATION_CACHE_URL')
+    if url:
+        import redis
+        logger.info("Using a shared recommendation cache.")
+        return RecommendationCache(SharedStoreBackend(redis.Redis.from_url(url)), ttl)
+    backend = InProcessBackend(
+        max_entries=int(os.getenv('RECOMMENDATION_CACHE_MAX_ENTRIES', 10000)),
+        max_bytes=int(os.getenv('RECOMMENDATION_CACHE_MAX_BYTES', 64 * 1024 * 1024)),
+    )
+    return RecommendationCache(backend, ttl)
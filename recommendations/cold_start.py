@@ -1,27 +1,135 @@
 import logging
 import random
+import threading
+import time
+
+from .metrics import timed
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+class CandidateSnapshot:
+    """
+    Popular, trending and diverse candidate lists materialized at one point in time.
+
+    Snapshots are never mutated after they are built; a refresh builds a new one and
+    swaps the reference.
+    """
+
+    def __init__(self, popular, trending, diverse, size):
+        self.popular = popular
+        self.trending = trending
+        self.diverse = diverse
+        self.size = size
+        self.built_at = time.monotonic()
+
+    @property
+    def age(self):
+        return time.monotonic() - self.built_at
+
+
 class ColdStartRecommender:
-    def __init__(self, connection):
+    def __init__(self, connection, ttl=300.0, candidate_count=70):
+        """
+        :param connection: Neo4jConnection instance
+        :param ttl: Seconds after which the candidate snapshot is rebuilt
+        :param candidate_count: Number of candidates kept per list in the snapshot
+        """
         self.connection = connection
+        self.ttl = ttl
+        self.candidate_count = candidate_count
+        self._snapshot = None
+        self._refresh_lock = threading.Lock()
+        self._refresher = None
+        self._stop = threading.Event()
+
+    @timed("cold_start.snapshot")
+    def build_snapshot(self, size=None):
+        """
+        Run the candidate queries and atomically swap in the new snapshot.
+
+        :param size: Number of candidates per list, defaults to `candidate_count`
+        :return: The new CandidateSnapshot
+        """
+        size = size or self.candidate_count
+        start = time.perf_counter()
+        snapshot = CandidateSnapshot(
+            self.get_popular_items(size),
+            self.get_trending_items(size),
+            self.get_diverse_items(size),
+            size,
+        )
+        self._snapshot = snapshot
+        logger.info(f"Cold-start snapshot built with {size} candidates per list in {time.perf_counter() - start:.2f}s")
+        return snapshot
+
+    def _refresh_in_background(self):
+        # Single flight: a refresh already running makes further triggers no-ops.
+        if not self._refresh_lock.acquire(blocking=False):
+            return
+
+        def refresh():
+            try:
+                self.build_snapshot(max(self.candidate_count, self._snapshot.size if self._snapshot else 0))
+            except Exception as e:
+                logger.error(f"Error refreshing cold-start snapshot: {e}")
+            finally:
+                self._refresh_lock.release()
 
+        threading.Thread(target=refresh, name="cold-start-refresh", daemon=True).start()
+
+    def get_snapshot(self, size):
+        """
+        Current candidate snapshot with at least `size` candidates per list.
+
+        Only the first request, or one asking for more candidates than the snapshot holds,
+        waits for the queries. A stale snapshot is still served while a rebuild runs in
+        the background.
+        """
+        snapshot = self._snapshot
+        if snapshot is None or snapshot.size < size:
+            with self._refresh_lock:
+                snapshot = self._snapshot
+                if snapshot is None or snapshot.size < size:
+                    snapshot = self.build_snapshot(max(size, self.candidate_count))
+        elif snapshot.age > self.ttl:
+            self._refresh_in_background()
+        return snapshot
+
+    def start_refresher(self):
+        """
+        Rebuild the snapshot every `ttl` seconds on a daemon thread, so requests never
+        find it stale.
+        """
+        if self._refresher is not None:
+            return
+
+        def run():
+            while not self._stop.wait(self.ttl):
+                with self._refresh_lock:
+                    try:
+                        self.build_snapshot(max(self.candidate_count, self._snapshot.size if self._snapshot else 0))
+                    except Exception as e:
+                        logger.error(f"Error refreshing cold-start snapshot: {e}")
+
+        self._refresher = threading.Thread(target=run, name="cold-start-refresher", daemon=True)
+        self._refresher.start()
+
+    def stop_refresher(self):
+        self._stop.set()
+
+    @timed("cold_start.recommend")
     def recommend_for_new_user(self, limit=10):
-        logger.info("Generating recommendations for a new user")
-        
-        popular_recs = self.get_popular_items(limit * 7)
-        trending_recs = self.get_trending_items(limit * 7)
-        diverse_recs = self.get_diverse_items(limit * 7)
-        
-        logger.debug(f"Popular recommendations: {popular_recs}")
-        logger.debug(f"Trending recommendations: {trending_recs}")
-        logger.debug(f"Diverse recommendations: {diverse_recs}")
+        snapshot = self.get_snapshot(limit * 7)
+        # Copies, because combine_recommendations shuffles the lists in place.
+        popular_recs = snapshot.popular[:limit * 7]
+        trending_recs = snapshot.trending[:limit * 7]
+        diverse_recs = snapshot.diverse[:limit * 7]
 
         combined_recs = self.combine_recommendations(popular_recs, trending_recs, diverse_recs, limit=limit)
-        logger.info(f"Combined recommendations for new user: {combined_recs}")
+        logger.debug(f"Combined {len(combined_recs)} cold-start recommendations from {len(popular_recs)} popular, "
+                     f"{len(trending_recs)} trending and {len(diverse_recs)} diverse candidates")
         return combined_recs
 
     def combine_recommendations(self, *rec_lists, limit):
@@ -40,13 +148,24 @@ class ColdStartRecommender:
         return combined[:limit]  # Ensure the combined list respects the limit
 
     def get_popular_items(self, limit=70):
+        # Reads the aggregates maintained on Movie nodes, in avgRating index order.
         query = """
-        MATCH (m:Movie)<-[r:RATED]-()
-        RETURN m.movieId AS movieId, m.title AS title, m.genres AS genres, AVG(r.rating) AS avgRating, COUNT(r) AS ratingCount
+        MATCH (m:Movie)
+        WHERE m.avgRating IS NOT NULL
+        RETURN m.movieId AS movieId, m.title AS title, m.genres AS genres, m.avgRating AS avgRating, m.ratingCount AS ratingCount
         ORDER BY avgRating DESC, ratingCount DESC
         LIMIT $limit
         """
         result = self.connection.query(query, parameters={"limit": limit})
+        if not result:
+            logger.warning("No movie rating aggregates found; run `python -m recommendations.movie_stats` to build them.")
+            query = """
+            MATCH (m:Movie)<-[r:RATED]-()
+            RETURN m.movieId AS movieId, m.title AS title, m.genres AS genres, AVG(r.rating) AS avgRating, COUNT(r) AS ratingCount
+            ORDER BY avgRating DESC, ratingCount DESC
+            LIMIT $limit
+            """
+            result = self.connection.query(query, parameters={"limit": limit})
         return [{"movieId": record["movieId"], "title": record["title"], "genres": record["genres"]} for record in result]
 
     def get_trending_items(self, limit=70):
@@ -1,106 +1,309 @@
-from .utils import get_user_ratings, calculate_similarity
+from .utils import get_user_ratings
+from .context import MOVIE_DETAILS, UserContext
+from .metrics import stage
+from .rating_matrix import RatingMatrix
+from .factor_model import current_version, load_serving_model
+from .ann_index import UserLSHIndex, DEFAULT_INDEX_PATH
 import logging
-import pickle
 import os
+import threading
+
+import numpy as np
 
 logger = logging.getLogger(__name__)
 
 class CollaborativeFiltering:
-    def __init__(self, connection):
+    def __init__(self, connection, rating_matrix=None, ann_index=None, similar_edges=None):
+        """
+        :param connection: Neo4jConnection instance
+        :param rating_matrix: RatingMatrix instance, loaded from the graph on first use if omitted
+        :param ann_index: UserLSHIndex instance, loaded as configured by USER_ANN_INDEX if omitted
+        :param similar_edges: Read neighbours from SIMILAR edges when the user has current ones,
+            defaults to the SIMILAR_EDGES environment variable
+        """
         self.connection = connection
-        self.model = self.load_model()
+        if similar_edges is None:
+            similar_edges = os.getenv('SIMILAR_EDGES', '0').lower() in ('1', 'true', 'yes')
+        self.similar_edges = similar_edges
+        # CURRENT as of the last load; the watcher reloads only when it moves, so a version
+        # pinned through reload_model stays until a new one is trained.
+        self._current_version = current_version()
+        factors = self.load_model()
+        # The factor model and the ANN index built from it are swapped together on reload;
+        # methods read both from one tuple so a request never mixes two model versions.
+        self._model = (factors, ann_index if ann_index is not None else self.load_ann_index(factors))
+        self._reload_lock = threading.Lock()
+        self._watcher = None
+        self._stop_watching = threading.Event()
+        self._rating_matrix = rating_matrix
+        self._rating_matrix_lock = threading.Lock()
+
+    @property
+    def model(self):
+        """
+        Tuple (factors, ann_index) of the serving model, to be read once per request.
+        """
+        return self._model
+
+    @property
+    def factors(self):
+        return self._model[0]
+
+    @property
+    def ann_index(self):
+        return self._model[1]
+
+    def load_model(self, version=None):
+        """
+        Load the factor model: a version trained by `python -m recommendations.train`
+        (the current one by default), or the pickled SVD model if none was trained.
+
+        :return: FactorModel instance
+        """
+        return load_serving_model(version=version)
+
+    def load_ann_index(self, factors):
+        """
+        Load the user ANN index when USER_ANN_INDEX is enabled, building and saving it
+        from the model's user factors if it does not exist yet.
+
+        The index is kept next to the model version it was built from, unless
+        USER_ANN_INDEX_PATH names a fixed file.
+
+        :param factors: FactorModel the index is built from
+        :return: UserLSHIndex instance, or None when the index is disabled
+        """
+        if os.getenv('USER_ANN_INDEX', '0').lower() not in ('1', 'true', 'yes'):
+            return None
+        default_path = os.path.join(factors.directory, 'user_ann_index.npz') if factors.directory else DEFAULT_INDEX_PATH
+        index_path = os.getenv('USER_ANN_INDEX_PATH', default_path)
+        if os.path.exists(index_path):
+            return UserLSHIndex.load(index_path)
+        ann_index = UserLSHIndex.build(
+            factors.user_ids, factors.user_factors,
+            n_tables=int(os.getenv('USER_ANN_INDEX_TABLES', 8)),
+            n_bits=int(os.getenv('USER_ANN_INDEX_BITS', 16)),
+        )
+        ann_index.save(index_path)
+        return ann_index
+
+    def reload_model(self, version=None):
+        """
+        Load a model version and swap it in, together with an ANN index built from it.
+
+        The new model is fully loaded before the swap; requests already running finish on
+        the model they started with. A given version stays pinned until `CURRENT` is moved
+        or the model is reloaded without one.
+
+        :param version: Version to pin, defaults to the one `CURRENT` points at
+        :return: True if a different version was swapped in
+        """
+        with self._reload_lock:
+            self._current_version = current_version()
+            target = version or self._current_version
+            if target is not None and target == self.factors.version:
+                return False
+            factors = self.load_model(version)
+            if factors.version == self.factors.version:
+                return False
+            self._model = (factors, self.load_ann_index(factors))
+        logger.info(f"Swapped in factor model version {factors.version}.")
+        return True
+
+    def reload_if_current_changed(self):
+        """
+        Reload the model if `CURRENT` was moved since the model was last loaded.
+
+        :return: True if a different version was swapped in
+        """
+        if current_version() == self._current_version:
+            return False
+        return self.reload_model()
+
+    def start_model_watcher(self, interval=30.0):
+        """
+        Reload the model whenever `CURRENT` is moved to a new version, checking every
+        `interval` seconds on a daemon thread.
+        """
+        if self._watcher is not None:
+            return
+
+        def run():
+            while not self._stop_watching.wait(interval):
+                try:
+                    self.reload_if_current_changed()
+                except Exception as e:
+                    logger.error(f"Error reloading the factor model: {e}")
+
+        self._watcher = threading.Thread(target=run, name="model-watcher", daemon=True)
+        self._watcher.start()
 
-    def load_model(self):
-        model_path = './models/svd_model.pkl'
-        with open(model_path, 'rb') as f:
-            model = pickle.load(f)
-        logger.info("Trained SVD model loaded.")
-        return model
+    def stop_model_watcher(self):
+        self._stop_watching.set()
 
-    def user_based_recommendations(self, user_id, limit=20):
+    def user_vector(self, user_id, user_ratings, model=None):
+        """
+        Latent vector of a user: the trained factors if the model knows the user,
+        otherwise the vector indexed for them or one folded in from their ratings.
+        """
+        factors, ann_index = model or self._model
+        index = factors.user_index(user_id)
+        if index >= 0:
+            return factors.user_factors[index]
+        vector = ann_index.get_vector(user_id) if ann_index is not None else None
+        if vector is None:
+            vector = factors.fold_in_user(user_ratings)
+        return vector
+
+    @property
+    def rating_matrix(self):
+        """
+        In-memory rating matrix, loaded from the graph on first use.
+        """
+        if self._rating_matrix is None:
+            with self._rating_matrix_lock:
+                if self._rating_matrix is None:
+                    self._rating_matrix = RatingMatrix.from_connection(self.connection)
+        return self._rating_matrix
+
+    def refresh_user(self, user_id):
+        """
+        Reload a user's ratings from the graph into the rating matrix.
+
+        :param user_id: User ID whose ratings changed
+        """
+        self.apply_user_ratings(user_id, get_user_ratings(self.connection, user_id))
+
+    def apply_user_ratings(self, user_id, user_ratings):
+        """
+        Update the rating matrix and ANN index with a user's current ratings.
+
+        :param user_id: User ID whose ratings changed
+        :param user_ratings: List of tuples (movieId, rating)
+        """
+        if self._rating_matrix is not None:
+            self._rating_matrix.set_user_ratings(user_id, user_ratings)
+        factors, ann_index = self._model
+        if ann_index is not None and factors.user_index(user_id) < 0:
+            vector = factors.fold_in_user(user_ratings)
+            if vector is not None:
+                ann_index.insert(user_id, vector)
+
+    def user_based_recommendations(self, user_id, limit=20, context=None):
         """
         Generate movie recommendations for a user based on user-based collaborative filtering.
         
         :param user_id: Target user ID
         :param limit: Number of recommendations to return
+        :param context: UserContext of the request, whose reads are shared with other branches
         :return: List of recommended movies with details and predicted ratings
         """
-        user_ratings = get_user_ratings(self.connection, user_id)
+        context = context or UserContext(self.connection, user_id)
+        with stage("collaborative.user_ratings"):
+            user_ratings = context.ratings
         if not user_ratings:
             return []
         
-        similar_users = self.find_similar_users(user_id, user_ratings)
-        recommendations = self.aggregate_user_recommendations(similar_users, user_id, limit)
+        # Neighbours and predictions come from the same model version, even across a reload.
+        model = self._model
+        with stage("collaborative.find_similar_users"):
+            similar_users = self.find_similar_users(user_id, user_ratings, context=context, model=model)
+        recommendations = self.aggregate_user_recommendations(similar_users, user_id, limit, context, model)
         return recommendations
 
-    def find_similar_users(self, user_id, user_ratings, top_n=10):
+    def find_similar_users(self, user_id, user_ratings, top_n=10, context=None, model=None):
         """
         Find users similar to the target user based on rating profiles.
+
+        With SIMILAR edges enabled, the neighbours materialized by
+        `python -m recommendations.similarity` are used when they are newer than the
+        user's ratings. When the user ANN index is enabled, similarity is the cosine of the
+        users' latent vectors and the search is approximate.
         
         :param user_id: Target user ID
         :param user_ratings: Ratings of the target user
         :param top_n: Number of similar users to find
+        :param context: UserContext of the request, which reads the SIMILAR edges with the user
+        :param model: Tuple (factors, ann_index) read by the request, defaults to the serving model
         :return: List of tuples (similar_user_id, similarity_score)
         """
-        query = """
-        MATCH (u:User)-[r:RATED]->(m:Movie)
-        WHERE u.userId <> $user_id
-        RETURN u.userId AS userId, collect(m.movieId) AS movieIds, collect(r.rating) AS ratings
-        """
-        result = self.connection.query(query, parameters={"user_id": user_id})
-
-        similarities = []
-        for record in result:
-            other_user_id = record["userId"]
-            other_user_ratings = list(zip(record["movieIds"], record["ratings"]))
-            similarity = calculate_similarity(user_ratings, other_user_ratings)
-            similarities.append((other_user_id, similarity))
+        if self.similar_edges and context is not None:
+            similar_users = context.similar_users(top_n)
+            if similar_users:
+                return similar_users
+        model = model or self._model
+        ann_index = model[1]
+        if ann_index is not None:
+            vector = self.user_vector(user_id, user_ratings, model)
+            if vector is not None:
+                return ann_index.query(vector, top_n, exclude=user_id)
+        return self.rating_matrix.most_similar(user_id, user_ratings, top_n)
 
-        similarities.sort(key=lambda x: x[1], reverse=True)
-        return similarities[:top_n]
-
-    def aggregate_user_recommendations(self, similar_users, user_id, limit=10):
+    def aggregate_user_recommendations(self, similar_users, user_id, limit=10, context=None, model=None):
         """
         Aggregate recommendations from similar users.
         
         :param similar_users: List of tuples (similar_user_id, similarity_score)
         :param user_id: Target user ID
         :param limit: Number of recommendations to return
+        :param context: UserContext of the request
+        :param model: Tuple (factors, ann_index) read by the request, defaults to the serving model
         :return: List of recommended movies with details
         """
-        recommended_movies = {}
+        context = context or UserContext(self.connection, user_id)
+        # The ratings of all similar users are read in one query.
+        with stage("collaborative.similar_ratings"):
+            users_ratings = context.users_ratings([similar_user_id for similar_user_id, _ in similar_users])
+        similar_ratings = [users_ratings[similar_user_id] for similar_user_id, _ in similar_users]
+        with stage("collaborative.predict"):
+            top_recommendations = self.rank_candidates(similar_users, similar_ratings, user_id, limit, model=model)
+        if not top_recommendations:
+            return []
 
-        for similar_user_id, similarity in similar_users:
-            user_ratings = get_user_ratings(self.connection, similar_user_id)
-            
-            for movie_id, rating in user_ratings:
-                try:
-                    # Use the trained model to predict ratings
-                    prediction = self.model.predict(int(user_id), int(movie_id))
-                    predicted_rating = prediction.est
-                    logger.debug(f"User: {user_id}, Movie: {movie_id}, Predicted: {predicted_rating}, Actual: {rating}")
-                except Exception as e:
-                    logger.error(f"Error predicting rating for user {user_id} and movie {movie_id}: {e}")
-                    predicted_rating = None
+        # Fetch movie details for the top recommendations
+        with stage("collaborative.movie_details"):
+            movie_details = context.movie_details([movie_id for movie_id, _ in top_recommendations])
+        return self.with_details(top_recommendations, movie_details)
+
+    def rank_candidates(self, similar_users, similar_ratings, user_id, limit=10, predict=None, model=None):
+        """
+        Rank the movies rated by similar users by their predicted rating for the target user.
 
-                if predicted_rating is not None:
-                    if movie_id not in recommended_movies:
-                        recommended_movies[movie_id] = (predicted_rating * similarity, similarity)
-                    else:
-                        current_rating, current_similarity = recommended_movies[movie_id]
-                        recommended_movies[movie_id] = (current_rating + predicted_rating * similarity, current_similarity + similarity)
+        :param similar_users: List of tuples (similar_user_id, similarity_score)
+        :param similar_ratings: Ratings of each similar user, in the same order
+        :param user_id: Target user ID
+        :param limit: Number of movies to return
+        :param predict: Optional callable mapping sorted movie IDs to the user's predicted
+            ratings, e.g. a row of predictions shared by a batch of users
+        :param model: Tuple (factors, ann_index) read by the request, defaults to the serving model
+        :return: List of tuples (movieId, predicted_rating)
+        """
+        movie_ids = []
+        weights = []
+        for (_, similarity), user_ratings in zip(similar_users, similar_ratings):
+            movie_ids.extend(movie_id for movie_id, _ in user_ratings)
+            weights.extend([similarity] * len(user_ratings))
 
-        for movie_id in recommended_movies:
-            total_rating, total_similarity = recommended_movies[movie_id]
-            recommended_movies[movie_id] = total_rating / total_similarity
+        if not movie_ids:
+            return []
 
-        sorted_recommendations = sorted(recommended_movies.items(), key=lambda x: x[1], reverse=True)
-        top_recommendations = sorted_recommendations[:limit]
+        # Score every candidate movie once; the similarity-weighted average of a
+        # per-(user, movie) prediction is the prediction itself.
+        candidates, first_seen, inverse = np.unique(np.asarray(movie_ids, dtype=np.int64), return_index=True, return_inverse=True)
+        total_similarity = np.bincount(inverse, weights=np.asarray(weights, dtype=np.float64), minlength=len(candidates))
+        factors = (model or self._model)[0]
+        predicted = predict(candidates) if predict is not None else factors.predict(int(user_id), candidates)
 
-        # Fetch movie details for the top recommendations
-        movie_details = self.get_movie_details([movie_id for movie_id, _ in top_recommendations])
+        scored = total_similarity != 0
+        candidates, first_seen, predicted = candidates[scored], first_seen[scored], predicted[scored]
+        order = np.lexsort((first_seen, -predicted))[:limit]
+        return [(int(candidates[i]), float(predicted[i])) for i in order]
 
-        recommendations_with_details = [
+    def with_details(self, top_recommendations, movie_details):
+        """
+        Attach title and genres to ranked (movieId, predicted_rating) tuples.
+        """
+        return [
             {
                 "movieId": movie_id,
                 "title": movie_details[movie_id]["title"],
@@ -110,8 +313,6 @@ class CollaborativeFiltering:
             for movie_id, rating in top_recommendations
         ]
 
-        return recommendations_with_details
-
     def get_movie_details(self, movie_ids):
         """
         Fetch movie details for the given movie IDs.
@@ -119,12 +320,7 @@ class CollaborativeFiltering:
         :param movie_ids: List of movie IDs
         :return: Dictionary of movie details keyed by movie ID
         """
-        query = """
-        MATCH (m:Movie)
-        WHERE m.movieId IN $movie_ids
-        RETURN m.movieId AS movieId, m.title AS title, m.genres AS genres
-        """
-        result = self.connection.query(query, parameters={"movie_ids": movie_ids})
+        result = self.connection.query(MOVIE_DETAILS, parameters={"movie_ids": movie_ids})
 
         movie_details = {record["movieId"]: {"title": record["title"], "genres": record["genres"]} for record in result}
         return movie_details
\ No newline at end of file
@@ -1,5 +1,8 @@
 import logging
+import threading
 from recommendations.utils import get_user_ratings
+from recommendations.genre_index import GenreIndex
+from recommendations.metrics import stage
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)  # Set to INFO to suppress debug logs
@@ -9,59 +12,75 @@ logger = logging.getLogger(__name__)
 logging.getLogger("neo4j").setLevel(logging.INFO)
 
 class ContentBasedFiltering:
-    def __init__(self, connection, high_rating_threshold=4.0):
+    def __init__(self, connection, high_rating_threshold=4.0, genre_index=None):
         self.connection = connection
         self.high_rating_threshold = high_rating_threshold
+        self._genre_index = genre_index
+        self._genre_index_lock = threading.Lock()
 
-    def content_based_recommendations(self, user_id, limit=10):
+    @property
+    def genre_index(self):
+        """
+        In-process genre index, loaded on first use and reloaded when the catalogue changes.
+        """
+        if self._genre_index is None:
+            with self._genre_index_lock:
+                if self._genre_index is None:
+                    self._genre_index = GenreIndex.from_connection(self.connection)
+        self._genre_index.refresh_if_stale(self.connection)
+        return self._genre_index
+
+    def content_based_recommendations(self, user_id, limit=10, context=None):
         """
         Generate movie recommendations for a user based on content-based filtering.
         
         :param user_id: Target user ID
         :param limit: Number of recommendations to return
+        :param context: UserContext of the request, whose reads are shared with other branches
+        :return: List of recommended movies with details
+        """
+        with stage("content.user_ratings"):
+            user_ratings = context.ratings if context is not None else get_user_ratings(self.connection, user_id)
+        return self.recommend_from_ratings(user_id, user_ratings, limit)
+
+    def recommend_from_ratings(self, user_id, user_ratings, limit=10):
+        """
+        Content-based recommendations from ratings already fetched for the user.
+
+        :param user_id: Target user ID
+        :param user_ratings: List of tuples (movieId, rating)
+        :param limit: Number of recommendations to return
         :return: List of recommended movies with details
         """
-        user_ratings = get_user_ratings(self.connection, user_id)
-        logger.info(f"User {user_id} ratings: {user_ratings}")
-        
         # Extract raw ratings
         high_rated_movies = [
             movie_id for movie_id, rating in user_ratings
             if rating >= self.high_rating_threshold
         ]
-        logger.info(f"High-rated movie IDs: {high_rated_movies}")
         
         if not high_rated_movies:
-            logger.info("No high-rated movies found.")
+            logger.debug(f"User {user_id} has no high-rated movies.")
             return []
         
-        similar_movies = self.find_similar_movies(high_rated_movies, user_id)
-        logger.info(f"Similar movies for user {user_id}: {similar_movies}")
+        rated_movies = [movie_id for movie_id, _ in user_ratings]
+        with stage("content.similar_movies"):
+            similar_movies = self.find_similar_movies(high_rated_movies, user_id, rated_movies, limit)
+        logger.debug(f"User {user_id}: {len(similar_movies)} similar movies from {len(high_rated_movies)} "
+                     f"of {len(user_ratings)} rated movies")
         
         return similar_movies[:limit]
 
-    def find_similar_movies(self, high_rated_movies, user_id):
-        query = """
-        MATCH (m:Movie)
-        WHERE m.movieId IN $rated_movie_ids
-        RETURN m.genres AS genres
+    def find_similar_movies(self, high_rated_movies, user_id, rated_movies=None, limit=50):
         """
-        genres_result = self.connection.query(query, parameters={"rated_movie_ids": high_rated_movies})
-        logger.info(f"Genres result: {genres_result}")
-        
-        genres = set()
-        for record in genres_result:
-            genres.update(record["genres"].split("|"))
-        logger.info(f"Extracted genres: {genres}")
+        Find unrated movies sharing genres with the user's high-rated movies, ranked by
+        the number of shared genres.
 
-        query = """
-        MATCH (similar:Movie)
-        WHERE any(genre IN $genres WHERE genre IN split(similar.genres, '|'))
-        AND NOT EXISTS((:User {userId: $user_id})-[:RATED]->(similar))
-        RETURN similar.movieId AS movieId, similar.title AS title, similar.genres AS genres
-        LIMIT 50
+        :param high_rated_movies: Movie IDs the user rated highly
+        :param user_id: Target user ID
+        :param rated_movies: Movie IDs the user rated, fetched from the graph if omitted
+        :param limit: Number of movies to return
+        :return: List of similar movies with details
         """
-        result = self.connection.query(query, parameters={"genres": list(genres), "user_id": user_id})
-        logger.info(f"Similar movies result: {result}")
-
-        return [{"movieId": record["movieId"], "title": record["title"], "genres": record["genres"]} for record in result]
\ No newline at end of file
+        if rated_movies is None:
+            rated_movies = [movie_id for movie_id, _ in get_user_ratings(self.connection, user_id)]
+        return self.genre_index.similar_movies(high_rated_movies, exclude_ids=rated_movies, limit=limit)
@@ -0,0 +1,143 @@
+from .metrics import stage
+from .utils import READ_ACCESS, get_users_ratings, get_users_top_ratings
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+MOVIE_DETAILS = """
+MATCH (m:Movie)
+WHERE m.movieId IN $movie_ids
+RETURN m.movieId AS movieId, m.title AS title, m.genres AS genres
+"""
+
+# Everything a request needs to know about its user, in one round trip. SIMILAR edges
+# written by `python -m recommendations.similarity` are returned only if they are newer
+# than the user's ratings.
+USER_CONTEXT = """
+MATCH (u:User {userId: $user_id})
+RETURN [(u)-[r:RATED]->(m:Movie) | [m.movieId, r.rating]] AS ratings,
+       size([(u)-[:LIKES]->(:Genre) | 1]) AS genre_count,
+       size([(u)-[:TAGGED]->(:Tag) | 1]) AS tag_count,
+       CASE WHEN u.similarComputedAt IS NOT NULL AND coalesce(u.ratingsChangedAt, 0) < u.similarComputedAt
+            THEN [(u)-[s:SIMILAR]->(v:User) | [v.userId, s.score]] ELSE [] END AS similar
+"""
+
+class UserContext:
+    """
+    Request-scoped loader for the graph reads of one recommendation request.
+
+    The target user's counts and ratings are read together on first use; ratings of other
+    users and movie details are read in batches, and every read is memoized so the branches
+    of a request never fetch the same data twice. One instance may be shared by branches
+    running on different threads.
+    """
+
+    def __init__(self, connection, user_id):
+        """
+        :param connection: Neo4jConnection instance
+        :param user_id: Target user ID
+        """
+        self.connection = connection
+        self.user_id = user_id
+        self._lock = threading.Lock()
+        self._counts = None
+        self._similar = []
+        self._ratings = {}
+        self._top_ratings = {}
+        self._movie_details = {}
+
+    def counts(self):
+        """
+        :return: Dictionary with the user's rating_count, genre_count and tag_count
+        """
+        with self._lock:
+            if self._counts is None:
+                with stage("user_context.load"):
+                    result = self.connection.query(USER_CONTEXT, parameters={"user_id": self.user_id},
+                                                   access_mode=READ_ACCESS)
+                record = result[0] if result else None
+                ratings = [(movie_id, rating) for movie_id, rating in record["ratings"]] if record else []
+                self._ratings[self.user_id] = ratings
+                similar = [(user_id, score) for user_id, score in record["similar"]] if record else []
+                self._similar = sorted(similar, key=lambda neighbour: neighbour[1], reverse=True)
+                self._counts = {
+                    "rating_count": len(ratings),
+                    "genre_count": record["genre_count"] if record else 0,
+                    "tag_count": record["tag_count"] if record else 0,
+                }
+            return self._counts
+
+    def is_new_user(self):
+        """
+        :return: True if the user has no ratings, liked genres or tags
+        """
+        return not any(self.counts().values())
+
+    @property
+    def ratings(self):
+        """
+        Ratings of the target user, as a list of tuples (movieId, rating).
+        """
+        self.counts()
+        return self._ratings[self.user_id]
+
+    def similar_users(self, top_n=10):
+        """
+        Materialized neighbours of the target user, read with their ratings.
+
+        :param top_n: Number of neighbours to return
+        :return: List of tuples (similar_user_id, similarity_score); empty if they were never
+            computed or are older than the user's ratings
+        """
+        self.counts()
+        return self._similar[:top_n]
+
+    def users_ratings(self, user_ids):
+        """
+        Ratings of many users; the ones not read yet by this request are fetched in one query.
+
+        :param user_ids: User IDs
+        :return: Dictionary of userId -> list of tuples (movieId, rating)
+        """
+        with self._lock:
+            missing = list(dict.fromkeys(user_id for user_id in user_ids if user_id not in self._ratings))
+            if missing:
+                fetched = get_users_ratings(self.connection, missing)
+                for user_id in missing:
+                    self._ratings[user_id] = fetched.get(user_id, [])
+            return {user_id: self._ratings[user_id] for user_id in user_ids}
+
+    def users_top_ratings(self, user_ids, per_user):
+        """
+        Highest ratings of many users, at most `per_user` each; the ones not read yet by
+        this request are fetched in one query.
+
+        :param user_ids: User IDs
+        :param per_user: Most ratings per user
+        :return: Dictionary of userId -> list of tuples (movieId, rating), highest rating first
+        """
+        with self._lock:
+            missing = list(dict.fromkeys(
+                user_id for user_id in user_ids if (user_id, per_user) not in self._top_ratings))
+            if missing:
+                fetched = get_users_top_ratings(self.connection, missing, per_user)
+                for user_id in missing:
+                    self._top_ratings[user_id, per_user] = fetched.get(user_id, [])
+            return {user_id: self._top_ratings[user_id, per_user] for user_id in user_ids}
+
+    def movie_details(self, movie_ids):
+        """
+        Title and genres of movies; the ones not read yet by this request are fetched in one query.
+
+        :param movie_ids: Movie IDs
+        :return: Dictionary of movie details keyed by movie ID
+        """
+        with self._lock:
+            missing = list(dict.fromkeys(movie_id for movie_id in movie_ids if movie_id not in self._movie_details))
+            if missing:
+                result = self.connection.query(MOVIE_DETAILS, parameters={"movie_ids": missing},
+                                               access_mode=READ_ACCESS)
+                for record in result:
+                    self._movie_details[record["movieId"]] = {"title": record["title"], "genres": record["genres"]}
+            return {movie_id: self._movie_details[movie_id] for movie_id in movie_ids if movie_id in self._movie_details}
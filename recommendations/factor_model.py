@@ -0,0 +1,314 @@
+import json
+import logging
+import os
+import re
+import time
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MODEL_ROOT = './models/mf'
+DEFAULT_PICKLE_PATH = './models/svd_model.pkl'
+
+# Names `save` accepts for a version; anything else could step outside the model root.
+VERSION_PATTERN = re.compile(r"[A-Za-z0-9][A-Za-z0-9._-]{0,63}")
+
+# Arrays of a saved model, one .npy file each.
+_ARRAYS = ("user_ids", "item_ids", "user_factors", "item_factors", "user_bias", "item_bias")
+
+
+class FactorModel:
+    """
+    Matrix factorization model held as plain NumPy arrays.
+
+    Predictions follow the SVD estimate `mean + b_u + b_i + q_i . p_u`, dropping the
+    terms of an unknown user or item, and are clipped to the rating scale.
+    """
+
+    def __init__(self, user_ids, item_ids, user_factors, item_factors, user_bias, item_bias,
+                 global_mean, rating_scale=(0.5, 5.0), biased=True):
+        """
+        :param user_ids: Raw user IDs, one per row of `user_factors`
+        :param item_ids: Raw movie IDs, one per row of `item_factors`
+        :param user_factors: Array of shape (n_users, n_factors)
+        :param item_factors: Array of shape (n_items, n_factors)
+        :param user_bias: Array of shape (n_users,)
+        :param item_bias: Array of shape (n_items,)
+        :param global_mean: Mean rating of the training set
+        :param rating_scale: Tuple (lowest, highest) rating used for clipping
+        :param biased: Whether the biases take part in the estimate
+        """
+        # Rows are kept sorted by raw ID so lookups are a single searchsorted. Arrays that are
+        # already sorted and of the right dtype (e.g. memory-mapped from `save`) are not copied.
+        self.user_ids, self.user_factors, self.user_bias = _sorted_rows(user_ids, user_factors, user_bias)
+        self.item_ids, self.item_factors, self.item_bias = _sorted_rows(item_ids, item_factors, item_bias)
+        self.global_mean = float(global_mean)
+        self.rating_scale = (float(rating_scale[0]), float(rating_scale[1]))
+        self.biased = biased
+        self.version = None
+        self.directory = None
+
+    @classmethod
+    def from_surprise(cls, model):
+        """
+        Extract the factors and biases of a trained `surprise.SVD` model.
+
+        :param model: Trained SVD model
+        :return: FactorModel instance
+        """
+        trainset = model.trainset
+        user_ids = np.empty(trainset.n_users, dtype=np.int64)
+        for raw_id, inner_id in trainset._raw2inner_id_users.items():
+            user_ids[inner_id] = int(raw_id)
+        item_ids = np.empty(trainset.n_items, dtype=np.int64)
+        for raw_id, inner_id in trainset._raw2inner_id_items.items():
+            item_ids[inner_id] = int(raw_id)
+
+        biased = getattr(model, "biased", True)
+        return cls(
+            user_ids, item_ids, model.pu, model.qi,
+            model.bu if biased else np.zeros(trainset.n_users),
+            model.bi if biased else np.zeros(trainset.n_items),
+            trainset.global_mean, trainset.rating_scale, biased,
+        )
+
+    def save(self, root=DEFAULT_MODEL_ROOT, version=None, metadata=None):
+        """
+        Write the model as a new version of plain .npy arrays plus `meta.json`, then point
+        `CURRENT` at it.
+
+        :param root: Directory holding one sub-directory per version
+        :param version: Version name, defaults to the current UTC timestamp
+        :param metadata: Extra JSON-serializable fields stored in `meta.json`, e.g. a training report
+        :return: Path of the version directory
+        """
+        version = version or time.strftime("%Y%m%dT%H%M%SZ", time.gmtime())
+        if not VERSION_PATTERN.fullmatch(version):
+            raise ValueError(f"Invalid model version name: {version!r}")
+        directory = os.path.join(root, version)
+        os.makedirs(directory, exist_ok=True)
+        for name in _ARRAYS:
+            np.save(os.path.join(directory, f"{name}.npy"), getattr(self, name))
+        meta = {
+            "version": version,
+            "global_mean": self.global_mean,
+            "rating_scale": list(self.rating_scale),
+            "biased": self.biased,
+            "n_users": len(self.user_ids),
+            "n_items": len(self.item_ids),
+            "n_factors": self.n_factors,
+        }
+        meta.update(metadata or {})
+        with open(os.path.join(directory, "meta.json"), "w") as f:
+            json.dump(meta, f, indent=2)
+
+        temp_file = os.path.join(root, "CURRENT.tmp")
+        with open(temp_file, "w") as f:
+            f.write(version)
+        os.replace(temp_file, os.path.join(root, "CURRENT"))
+        logger.info(f"Factor model version {version} saved to {directory}.")
+        return directory
+
+    @classmethod
+    def load(cls, root=DEFAULT_MODEL_ROOT, version=None, mmap=True):
+        """
+        Load a version written by `save`, by default the one `CURRENT` points at.
+
+        With `mmap`, the arrays are memory-mapped read-only instead of read into memory, so
+        loading is nearly instant and every process serving the same version shares the
+        physical pages through the page cache.
+
+        :param root: Directory holding one sub-directory per version
+        :param version: Version name
+        :param mmap: Whether to memory-map the arrays
+        :return: FactorModel instance
+        :raises ValueError: If the version is not a valid version name
+        """
+        if version is None:
+            version = current_version(root)
+        if not VERSION_PATTERN.fullmatch(version):
+            raise ValueError(f"Invalid model version name: {version!r}")
+        directory = os.path.join(root, version)
+        with open(os.path.join(directory, "meta.json")) as f:
+            meta = json.load(f)
+        mmap_mode = "r" if mmap else None
+        arrays = {name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode=mmap_mode) for name in _ARRAYS}
+        model = cls(**arrays, global_mean=meta["global_mean"], rating_scale=meta["rating_scale"], biased=meta["biased"])
+        model.version = version
+        model.directory = directory
+        logger.info(f"Factor model version {version} loaded{' (memory-mapped)' if mmap else ''}: "
+                    f"{meta['n_users']} users, {meta['n_items']} items.")
+        return model
+
+    @property
+    def n_factors(self):
+        return self.user_factors.shape[1]
+
+    def user_index(self, user_id):
+        """
+        Row of a raw user ID, or -1 if the user is unknown to the model.
+        """
+        position = np.searchsorted(self.user_ids, user_id)
+        if position < len(self.user_ids) and self.user_ids[position] == user_id:
+            return int(position)
+        return -1
+
+    def user_indices(self, user_ids):
+        """
+        Rows of raw user IDs, with -1 for users unknown to the model.
+        """
+        user_ids = np.asarray(user_ids, dtype=np.int64)
+        if not len(self.user_ids):
+            return np.full(len(user_ids), -1, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.user_ids, user_ids), len(self.user_ids) - 1)
+        return np.where(self.user_ids[positions] == user_ids, positions, -1)
+
+    def item_indices(self, movie_ids):
+        """
+        Rows of raw movie IDs, with -1 for movies unknown to the model.
+        """
+        movie_ids = np.asarray(movie_ids, dtype=np.int64)
+        if not len(self.item_ids):
+            return np.full(len(movie_ids), -1, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.item_ids, movie_ids), len(self.item_ids) - 1)
+        return np.where(self.item_ids[positions] == movie_ids, positions, -1)
+
+    def predict(self, user_id, movie_ids):
+        """
+        Predict the ratings of one user for many movies in a single product.
+
+        :param user_id: Raw user ID
+        :param movie_ids: Sequence of raw movie IDs
+        :return: Array of predicted ratings, aligned with `movie_ids`
+        """
+        items = self.item_indices(movie_ids)
+        known_items = items >= 0
+        user = self.user_index(user_id)
+
+        if self.biased:
+            estimates = np.full(len(items), self.global_mean)
+            estimates[known_items] += self.item_bias[items[known_items]]
+            if user >= 0:
+                estimates += self.user_bias[user]
+                estimates[known_items] += self.item_factors[items[known_items]] @ self.user_factors[user]
+        else:
+            # An unbiased SVD cannot estimate unknown pairs and falls back to the mean.
+            estimates = np.full(len(items), self.global_mean)
+            if user >= 0:
+                estimates[known_items] = self.item_factors[items[known_items]] @ self.user_factors[user]
+
+        return np.clip(estimates, *self.rating_scale)
+
+    def predict_many(self, user_ids, movie_ids):
+        """
+        Predict the ratings of many users for many movies in a single matrix product.
+
+        :param user_ids: Sequence of raw user IDs
+        :param movie_ids: Sequence of raw movie IDs
+        :return: Array of shape (len(user_ids), len(movie_ids)); row i equals `predict(user_ids[i], movie_ids)`
+        """
+        users = self.user_indices(user_ids)
+        items = self.item_indices(movie_ids)
+        known_users = users >= 0
+        known_items = items >= 0
+        known_pairs = np.ix_(known_users, known_items)
+        products = self.user_factors[users[known_users]] @ self.item_factors[items[known_items]].T
+
+        estimates = np.full((len(users), len(items)), self.global_mean)
+        if self.biased:
+            estimates[:, known_items] += self.item_bias[items[known_items]]
+            estimates[known_users] += self.user_bias[users[known_users]][:, None]
+            estimates[known_pairs] += products
+        else:
+            estimates[known_pairs] = products
+
+        return np.clip(estimates, *self.rating_scale)
+
+    def fold_in_user(self, ratings, regularization=0.02):
+        """
+        Estimate a latent vector for a user the model was not trained on.
+
+        Solves the regularized least-squares problem for the user's factors with the
+        item factors and biases held fixed.
+
+        :param ratings: List of tuples (movieId, rating)
+        :param regularization: L2 penalty on the user factors
+        :return: Array of shape (n_factors,), or None if no rated movie is known
+        """
+        if not ratings:
+            return None
+        movie_ids, values = zip(*ratings)
+        items = self.item_indices(movie_ids)
+        known = items >= 0
+        if not known.any():
+            return None
+        items = items[known]
+        residuals = np.asarray(values, dtype=np.float64)[known]
+        if self.biased:
+            residuals = residuals - self.global_mean - self.item_bias[items]
+
+        factors = self.item_factors[items]
+        gram = factors.T @ factors + regularization * len(items) * np.eye(self.n_factors)
+        return np.linalg.solve(gram, factors.T @ residuals)
+
+
+def _sorted_rows(ids, *arrays):
+    ids = np.asarray(ids, dtype=np.int64)
+    arrays = [np.asarray(array, dtype=np.float64) for array in arrays]
+    if len(ids) < 2 or bool(np.all(ids[:-1] <= ids[1:])):
+        return (ids, *arrays)
+    order = np.argsort(ids, kind="stable")
+    return (ids[order], *(array[order] for array in arrays))
+
+
+def model_root():
+    """
+    Directory of the trained model versions, MF_MODEL_DIR or ./models/mf.
+    """
+    return os.getenv('MF_MODEL_DIR', DEFAULT_MODEL_ROOT)
+
+
+def current_version(root=None):
+    """
+    Version `CURRENT` points at, or None if no version was trained.
+    """
+    try:
+        with open(os.path.join(root or model_root(), "CURRENT")) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+def list_versions(root=None):
+    """
+    Names of the versions saved under `root`, oldest first by name.
+    """
+    root = root or model_root()
+    if not os.path.isdir(root):
+        return []
+    return sorted(
+        name for name in os.listdir(root)
+        if VERSION_PATTERN.fullmatch(name) and os.path.isfile(os.path.join(root, name, "meta.json"))
+    )
+
+
+def load_serving_model(root=None, version=None, pickle_path=DEFAULT_PICKLE_PATH):
+    """
+    Model used for serving: a version under `root` (by default the current one under
+    `model_root()`), memory-mapped unless MF_MODEL_MMAP is off; otherwise the pickled
+    surprise SVD model.
+
+    :return: FactorModel instance
+    """
+    root = root or model_root()
+    if version is not None or current_version(root) is not None:
+        mmap = os.getenv('MF_MODEL_MMAP', '1').lower() not in ('0', 'false', 'no')
+        return FactorModel.load(root, version, mmap=mmap)
+
+    import pickle
+
+    with open(pickle_path, 'rb') as f:
+        model = FactorModel.from_surprise(pickle.load(f))
+    logger.info("Trained SVD model loaded.")
+    return model
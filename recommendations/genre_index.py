@@ -0,0 +1,205 @@
+import logging
+import threading
+import time
+
+import numpy as np
+
+from .utils import get_catalogue_version
+
+logger = logging.getLogger(__name__)
+
+# Number of set bits in every byte value, for popcounts on NumPy versions without bitwise_count.
+_POPCOUNT_TABLE = np.array([bin(value).count("1") for value in range(256)], dtype=np.uint8)
+
+
+def _popcount(masks):
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(masks).sum(axis=-1, dtype=np.int64)
+    as_bytes = masks.view(np.uint8).reshape(masks.shape[0], -1)
+    return _POPCOUNT_TABLE[as_bytes].sum(axis=-1, dtype=np.int64)
+
+
+class GenreIndex:
+    """
+    In-process genre index over the movie catalogue.
+
+    Each movie's genres are encoded as a bitmask (one uint64 word per 64 genres) and each
+    genre keeps a posting list of the movies carrying it, so finding movies that share
+    genres with a set of movies is a union of posting lists followed by vectorized
+    AND/popcount overlap scoring.
+
+    The index reloads itself when the catalogue version in the graph changes.
+    """
+
+    def __init__(self, movies=(), check_interval=30.0):
+        """
+        :param movies: Iterable of tuples (movieId, title, genres)
+        :param check_interval: Minimum seconds between catalogue version checks
+        """
+        self.check_interval = check_interval
+        self.version = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        self._movies = {}
+        self._built = None
+        self._dirty = True
+        for movie_id, title, genres in movies:
+            self._movies[int(movie_id)] = (title, genres)
+
+    @classmethod
+    def from_connection(cls, connection, **kwargs):
+        """
+        Load the whole movie catalogue from the graph.
+
+        :param connection: Neo4jConnection instance
+        :return: GenreIndex instance
+        """
+        index = cls(**kwargs)
+        index.reload(connection)
+        return index
+
+    def reload(self, connection):
+        """
+        Replace the indexed catalogue with the movies currently in the graph.
+        """
+        version = get_catalogue_version(connection)
+        query = """
+        MATCH (m:Movie)
+        RETURN m.movieId AS movieId, m.title AS title, m.genres AS genres
+        """
+        result = connection.query(query) or []
+        with self._lock:
+            self._movies = {record["movieId"]: (record["title"], record["genres"]) for record in result}
+            self._dirty = True
+            self.version = version
+            self._checked_at = time.monotonic()
+        logger.info(f"Genre index loaded: {len(result)} movies, catalogue version {version}.")
+
+    def refresh_if_stale(self, connection):
+        """
+        Reload the catalogue if its version changed, checking at most every `check_interval` seconds.
+        """
+        if time.monotonic() - self._checked_at < self.check_interval:
+            return
+        self._checked_at = time.monotonic()
+        if get_catalogue_version(connection) != self.version:
+            self.reload(connection)
+
+    def upsert(self, movie_id, title, genres):
+        """
+        Add or update a single movie.
+        """
+        with self._lock:
+            self._movies[int(movie_id)] = (title, genres)
+            self._dirty = True
+
+    def _snapshot(self):
+        """
+        Current arrays, rebuilt from the movie table if it changed since the last build.
+        """
+        with self._lock:
+            if self._dirty:
+                self._built = _GenreArrays(self._movies)
+                self._dirty = False
+            return self._built
+
+    def __len__(self):
+        return len(self._movies)
+
+    def movie_details(self, movie_ids):
+        """
+        Title and genres of indexed movies.
+
+        :param movie_ids: Movie IDs
+        :return: Dictionary of movieId -> {"title", "genres"}; unknown movies are left out
+        """
+        details = {}
+        with self._lock:
+            for movie_id in movie_ids:
+                movie = self._movies.get(int(movie_id))
+                if movie is not None:
+                    details[int(movie_id)] = {"title": movie[0], "genres": movie[1]}
+        return details
+
+    def similar_movies(self, movie_ids, exclude_ids=(), limit=50):
+        """
+        Find movies sharing genres with a set of movies, ranked by genre overlap.
+
+        :param movie_ids: Movie IDs whose genres define the target profile
+        :param exclude_ids: Movie IDs to leave out, e.g. everything the user rated
+        :param limit: Number of movies to return
+        :return: List of dictionaries with movieId, title and genres
+        """
+        arrays = self._snapshot()
+        rows, _ = self._similar_rows(arrays, movie_ids, exclude_ids, limit)
+        return [
+            {"movieId": int(arrays.movie_ids[row]), "title": arrays.titles[row], "genres": arrays.genres[row]}
+            for row in rows
+        ]
+
+    def similar_movie_scores(self, movie_ids, exclude_ids=(), limit=50):
+        """
+        Like similar_movies, without details.
+
+        :return: Tuple of arrays (movie IDs, number of shared genres), best first
+        """
+        arrays = self._snapshot()
+        rows, overlap = self._similar_rows(arrays, movie_ids, exclude_ids, limit)
+        return arrays.movie_ids[rows], overlap
+
+    @staticmethod
+    def _similar_rows(arrays, movie_ids, exclude_ids, limit):
+        empty = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        if not len(arrays.movie_ids):
+            return empty
+
+        movie_ids = np.asarray(list(movie_ids), dtype=np.int64)
+        positions = np.minimum(np.searchsorted(arrays.movie_ids, movie_ids), len(arrays.movie_ids) - 1)
+        rows = positions[arrays.movie_ids[positions] == movie_ids]
+        if not len(rows):
+            return empty
+        profile = np.bitwise_or.reduce(arrays.masks[rows], axis=0)
+
+        bits = np.arange(len(arrays.vocabulary), dtype=np.uint64)
+        present = (profile[(bits // np.uint64(64)).astype(np.int64)] >> (bits % np.uint64(64))) & np.uint64(1)
+        postings = [arrays.postings[bit] for bit in np.flatnonzero(present)]
+        if not postings:
+            return empty
+        candidates = np.unique(np.concatenate(postings))
+        excluded = np.isin(arrays.movie_ids[candidates], np.asarray(list(exclude_ids), dtype=np.int64))
+        candidates = candidates[~excluded]
+
+        overlap = _popcount(arrays.masks[candidates] & profile)
+        order = np.lexsort((arrays.movie_ids[candidates], -overlap))[:limit]
+        return candidates[order], overlap[order]
+
+
+class _GenreArrays:
+    """
+    Immutable arrays built from a movie table, swapped in as a whole on rebuild.
+    """
+
+    def __init__(self, movies):
+        movie_ids = np.fromiter(movies.keys(), dtype=np.int64, count=len(movies))
+        order = np.argsort(movie_ids)
+        items = list(movies.values())
+        self.movie_ids = movie_ids[order]
+        self.titles = [items[i][0] for i in order]
+        self.genres = [items[i][1] for i in order]
+
+        genre_lists = [(genres or "").split("|") for genres in self.genres]
+        self.vocabulary = sorted({genre for genre_list in genre_lists for genre in genre_list if genre})
+        genre_bits = {genre: bit for bit, genre in enumerate(self.vocabulary)}
+
+        pairs = [(row, genre_bits[genre]) for row, genre_list in enumerate(genre_lists) for genre in genre_list if genre]
+        pairs = np.asarray(pairs, dtype=np.int64).reshape(-1, 2)
+        rows, bits = pairs[:, 0], pairs[:, 1]
+
+        words = max(1, -(-len(self.vocabulary) // 64))
+        self.masks = np.zeros((len(self.movie_ids), words), dtype=np.uint64)
+        np.bitwise_or.at(self.masks, (rows, bits // 64), np.left_shift(np.uint64(1), (bits % 64).astype(np.uint64)))
+
+        # Posting lists: rows of the movies carrying each genre bit.
+        order = np.argsort(bits, kind="stable")
+        boundaries = np.searchsorted(bits[order], np.arange(len(self.vocabulary) + 1))
+        self.postings = [rows[order][boundaries[bit]:boundaries[bit + 1]] for bit in range(len(self.vocabulary))]
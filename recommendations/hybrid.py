@@ -1,39 +1,153 @@
 from .collaborative_filtering import CollaborativeFiltering
 from .content_based import ContentBasedFiltering
+from .context import UserContext
+from .metrics import STAGE_SECONDS, stage, timed
+from .pipeline import Ranker, default_generators
+from concurrent.futures import ThreadPoolExecutor, wait
 import logging
+import os
+import time
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Requests expected to run at once, e.g. the server's worker threads. The default executor
+# has a thread for every branch of that many requests, so branches do not queue behind a
+# slow branch of another request.
+DEFAULT_CONCURRENCY = int(os.getenv('HYBRID_CONCURRENCY', 8))
+
 class HybridRecommender:
-    def __init__(self, connection):
-        self.collaborative_filtering = CollaborativeFiltering(connection)
-        self.content_based_filtering = ContentBasedFiltering(connection)
+    def __init__(self, connection, max_workers=None, latency_budget=None, collaborative_filtering=None,
+                 content_based_filtering=None, generators=None, ranker=None):
+        """
+        :param connection: Neo4jConnection instance
+        :param max_workers: Threads shared by the branches of all requests, defaults to one per
+            generator for each of HYBRID_CONCURRENCY concurrent requests
+        :param latency_budget: Default seconds a request waits for its branches, None to wait for all
+        :param collaborative_filtering: Prebuilt CollaborativeFiltering, created from `connection` if omitted
+        :param content_based_filtering: Prebuilt ContentBasedFiltering, created from `connection` if omitted
+        :param generators: CandidateGenerator instances, defaults to the collaborative and content generators
+        :param ranker: Ranker fusing the candidates' signals, configured from the environment if omitted
+        """
+        self.connection = connection
+        self.collaborative_filtering = collaborative_filtering or CollaborativeFiltering(connection)
+        self.content_based_filtering = content_based_filtering or ContentBasedFiltering(connection)
+        self.generators = generators if generators is not None else default_generators(
+            self.collaborative_filtering, self.content_based_filtering)
+        self.ranker = ranker or Ranker()
+        self.latency_budget = latency_budget
+        max_workers = max_workers or len(self.generators) * DEFAULT_CONCURRENCY
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="hybrid")
+
+    def branches(self):
+        """
+        Independent candidate generation branches, run concurrently.
+        """
+        return [(generator.name, generator.generate) for generator in self.generators]
 
     def recommend_for_existing_user(self, user_id, limit=12):
-        logger.info(f"Generating recommendations for user {user_id} with limit {limit}")
-        
-        user_recs = self.collaborative_filtering.user_based_recommendations(user_id, limit)
-        content_recs = self.content_based_filtering.content_based_recommendations(user_id, limit)
-        
-        logger.debug(f"User-based recommendations: {user_recs}")
-        logger.debug(f"Content-based recommendations: {content_recs}")
-
-        combined_recs = self.combine_recommendations(user_recs, content_recs, limit=limit)
-        logger.info(f"Combined recommendations for user {user_id}: {combined_recs}")
-        return combined_recs
-
-    def combine_recommendations(self, user_recs, content_recs, *, limit):
-        seen = set()
-        combined = []
-
-        for rec_list in (user_recs, content_recs):
-            for rec in rec_list:
-                if rec['movieId'] not in seen:
-                    seen.add(rec['movieId'])
-                    combined.append(rec)
-                    if len(combined) >= limit:
-                        return combined  # Return early if limit is reached
-
-        return combined[:limit]  # Ensure the combined list respects the limit
\ No newline at end of file
+        return self.recommend_within_budget(user_id, limit)["recommendations"]
+
+    @timed("hybrid.recommend")
+    def recommend_within_budget(self, user_id, limit=12, latency_budget=None, context=None):
+        """
+        Run all candidate generators concurrently and rank whatever they proposed within the
+        latency budget.
+
+        A branch that misses the deadline or fails is left out and the result is flagged as
+        degraded; a late branch keeps running on the executor but its result is discarded.
+        Each branch's timing splits the wait for an executor thread (`queue_ms`) from its
+        own run time (`ms`), so a saturated executor shows up apart from slow branches.
+        The branches share one UserContext, so the user's ratings are read once per request.
+        Every generator returns at most its cap of candidates, so the ranking stage's cost
+        is bounded by the caps whatever the activity of the user's neighbours.
+
+        :param user_id: User ID
+        :param limit: Number of recommendations to return
+        :param latency_budget: Seconds to wait for the branches, defaults to the recommender's budget
+        :param context: UserContext of the request, e.g. one already used to check for a new user
+        :return: Dictionary with recommendations, degraded, and per-branch status and elapsed milliseconds
+        """
+        budget = latency_budget if latency_budget is not None else self.latency_budget
+
+        context = context or UserContext(self.connection, user_id)
+        start = time.perf_counter()
+        started = {}
+        futures = [
+            (name, self.executor.submit(self._timed, name, branch, user_id, context, start, started))
+            for name, branch in self.branches()
+        ]
+        wait([future for _, future in futures], timeout=budget)
+
+        results = {}
+        timings = {}
+        for name, future in futures:
+            now = time.perf_counter()
+            branch_start = started.get(name, now)
+            queue_ms = round((branch_start - start) * 1000, 1)
+            if not future.done():
+                future.cancel()
+                timings[name] = {"status": "timeout", "queue_ms": queue_ms, "ms": round((now - branch_start) * 1000, 1)}
+                logger.warning(f"{name} branch missed the {budget}s budget for user {user_id} "
+                               f"after {queue_ms} ms in the executor queue")
+                continue
+            try:
+                candidates, elapsed = future.result()
+            except Exception as e:
+                timings[name] = {"status": "error", "queue_ms": queue_ms, "ms": round((now - branch_start) * 1000, 1)}
+                logger.error(f"{name} branch failed for user {user_id}: {e}")
+                continue
+            timings[name] = {"status": "ok", "queue_ms": queue_ms, "ms": round(elapsed * 1000, 1)}
+            results[name] = candidates
+
+        combined_recs = self.rank(user_id, results, limit)
+        degraded = len(results) < len(futures)
+        logger.debug(f"Combined {len(combined_recs)} recommendations for user {user_id} (degraded={degraded}): {timings}")
+        return {"recommendations": combined_recs, "degraded": degraded, "timings": timings}
+
+    def _timed(self, name, branch, user_id, context, submitted, started):
+        start = started[name] = time.perf_counter()
+        STAGE_SECONDS.observe(start - submitted, f"hybrid.{name}.queue")
+        candidates = branch(user_id, context)
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, f"hybrid.{name}")
+        logger.debug(f"{name} branch for user {user_id}: {len(candidates)} candidates in {elapsed * 1000:.1f} ms")
+        return candidates, elapsed
+
+    def rank(self, user_id, candidate_sets, limit):
+        """
+        Rank the merged candidates of the generators and attach movie details.
+
+        :param user_id: Target user ID
+        :param candidate_sets: Dictionary of generator name -> Candidates
+        :param limit: Number of recommendations to return
+        :return: List of recommended movies with details, predicted ratings and fused scores
+        """
+        factors = self.collaborative_filtering.factors
+        with stage("hybrid.rank"):
+            ranked = self.ranker.rank(
+                candidate_sets, lambda movie_ids: factors.predict(int(user_id), movie_ids),
+                factors.rating_scale, limit)
+        return self.with_details(ranked)
+
+    def with_details(self, ranked):
+        """
+        Attach title and genres to ranked movies; movies missing from the catalogue are left out.
+
+        :param ranked: List of tuples (movieId, fused score, predicted rating or None), as Ranker.rank returns
+        :return: List of recommended movies with details, predicted ratings and fused scores
+        """
+        with stage("hybrid.movie_details"):
+            movie_details = self.content_based_filtering.genre_index.movie_details(
+                [movie_id for movie_id, _, _ in ranked])
+        return [
+            {
+                "movieId": movie_id,
+                "title": movie_details[movie_id]["title"],
+                "genres": movie_details[movie_id]["genres"],
+                "predictedRating": predicted,
+                "score": score,
+            }
+            for movie_id, score, predicted in ranked if movie_id in movie_details
+        ]
@@ -0,0 +1,262 @@
+import bisect
+import hashlib
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import lru_cache, wraps
+
+logger = logging.getLogger(__name__)
+slow_query_logger = logging.getLogger(__name__ + ".slow_queries")
+
+# Queries slower than this, measured by the client, are logged with their text.
+SLOW_QUERY_MS = float(os.getenv('SLOW_QUERY_MS', 250))
+
+# Latency buckets in seconds, from sub-millisecond in-memory steps to multi-second queries.
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=""):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted((labels, self._copy(value)) for labels, value in self._values.items())
+        lines.extend(self._render_value(labels, value) for labels, value in items)
+        return "\n".join(lines)
+
+    def _copy(self, value):
+        return value
+
+    def _render_value(self, labels, value):
+        return f"{self.name}{_labels(self.labelnames, labels)} {value}"
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, *labels):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        return self._values.get(labels, 0)
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(_Metric):
+    """
+    Cumulative-bucket histogram; an observation is one bisect and a few additions under a lock.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def _copy(self, state):
+        return [list(state[0]), state[1], state[2]]
+
+    def count(self, *labels):
+        state = self._values.get(labels)
+        return state[2] if state else 0
+
+    def _render_value(self, labels, state):
+        counts, total, count = state
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += bucket_count
+            le = 'le="+Inf"' if bound == float("inf") else f'le="{bound!r}"'
+            lines.append(f"{self.name}_bucket{_labels(self.labelnames, labels, le)} {cumulative}")
+        lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {total}")
+        lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {count}")
+        return "\n".join(lines)
+
+
+class Registry:
+    """
+    Process-wide metrics, rendered in the Prometheus text exposition format.
+
+    Collectors are callables run before every render, for values that are cheaper to read
+    on scrape than to track on every change, such as connection pool statistics.
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self._add(Counter(name, help, labelnames))
+
+    def gauge(self, name, help, labelnames=()):
+        return self._add(Gauge(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(name, help, labelnames, buckets))
+
+    def add_collector(self, collector):
+        self._collectors.append(collector)
+
+    def render(self):
+        for collector in self._collectors:
+            try:
+                collector()
+            except Exception as e:
+                logger.error(f"Metrics collector failed: {e}")
+        return "\n".join(metric.render() for metric in self._metrics) + "\n"
+
+
+REGISTRY = Registry()
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+STAGE_SECONDS = REGISTRY.histogram(
+    "recommendation_stage_seconds", "Time spent in each step of the recommenders.", ("stage",))
+QUERIES = REGISTRY.counter(
+    "neo4j_queries_total", "Query round trips, by query.", ("query",))
+QUERY_ERRORS = REGISTRY.counter(
+    "neo4j_query_errors_total", "Queries that raised an error, by query.", ("query",))
+QUERY_ROWS = REGISTRY.counter(
+    "neo4j_query_rows_total", "Records returned, by query.", ("query",))
+QUERY_SECONDS = REGISTRY.histogram(
+    "neo4j_query_seconds", "Query time seen by the client, including the round trip, by query.", ("query",))
+QUERY_SERVER_SECONDS = REGISTRY.counter(
+    "neo4j_query_server_seconds_total", "Server time from result summaries (available plus consumed after).",
+    ("query",))
+SLOW_QUERIES = REGISTRY.counter(
+    "neo4j_slow_queries_total", "Queries slower than the slow-query threshold, by query.", ("query",))
+QUERY_INFO = REGISTRY.gauge(
+    "neo4j_query_info", "Start of the text of every labelled query.", ("query", "text"))
+SESSIONS = REGISTRY.gauge(
+    "neo4j_connection_sessions", "Session counters of a shared connection, from its session_stats.",
+    ("connection", "stat"))
+HTTP_SECONDS = REGISTRY.histogram(
+    "http_request_duration_seconds", "Request latency, by endpoint, method and status.",
+    ("endpoint", "method", "status"))
+
+
+@contextmanager
+def stage(name):
+    """
+    Time a block as one recommender step.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - start, name)
+
+
+def timed(name):
+    """
+    Decorator timing every call of a function as one recommender step.
+    """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                STAGE_SECONDS.observe(time.perf_counter() - start, name)
+        return wrapper
+    return decorator
+
+
+@lru_cache(maxsize=4096)
+def query_label(query):
+    """
+    Short, stable label of a query: a digest of its whitespace-normalized text. The text
+    itself is published once per label as `neo4j_query_info`.
+    """
+    text = " ".join(query.split())
+    label = hashlib.blake2b(text.encode(), digest_size=4).hexdigest()
+    QUERY_INFO.set(1, label, text[:160])
+    return label
+
+
+def record_query(query, elapsed, rows=None, summary=None, parameters=None):
+    """
+    Count one query round trip and log it if it was slow.
+
+    :param query: Cypher query text
+    :param elapsed: Seconds measured by the client
+    :param rows: Records returned, or None if the query failed
+    :param summary: Result summary from the driver, if available
+    :param parameters: Query parameters; only their names are logged
+    """
+    label = query_label(query)
+    QUERIES.inc(1, label)
+    QUERY_SECONDS.observe(elapsed, label)
+    if rows is None:
+        QUERY_ERRORS.inc(1, label)
+    else:
+        QUERY_ROWS.inc(len(rows), label)
+    server_ms = None
+    if summary is not None:
+        available = getattr(summary, "result_available_after", None)
+        consumed = getattr(summary, "result_consumed_after", None)
+        if available is not None or consumed is not None:
+            server_ms = (available or 0) + (consumed or 0)
+            QUERY_SERVER_SECONDS.inc(server_ms / 1000, label)
+    if elapsed * 1000 >= SLOW_QUERY_MS:
+        SLOW_QUERIES.inc(1, label)
+        slow_query_logger.warning(
+            f"Slow query {label}: {elapsed * 1000:.1f} ms (server {server_ms} ms), "
+            f"{'failed' if rows is None else f'{len(rows)} rows'}, parameters {sorted(parameters or {})}: "
+            f"{' '.join(query.split())[:500]}"
+        )
+
+
+def track_connection(connection, name="default"):
+    """
+    Publish a connection's `session_stats` counters on every scrape.
+    """
+    def collect():
+        stats = connection.session_stats()
+        for stat in ("sessions_opened", "active_sessions", "peak_active_sessions", "queries", "failed_queries"):
+            SESSIONS.set(stats[stat], name, stat)
+
+    REGISTRY.add_collector(collect)
@@ -0,0 +1,87 @@
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# Every Movie carries ratingSum, ratingCount, avgRating and ratingHist, a list of ten counts
+# for the half-star buckets 0.5 to 5.0. Writes that add or overwrite a single rating apply a
+# delta with `rating_delta`; bulk loads rebuild the aggregates with `rebuild_movie_stats`.
+
+# Half-star histogram bucket of a rating expression: 0.5 -> 0, ..., 5.0 -> 9.
+_BUCKET = "CASE WHEN toInteger(round({rating} * 2)) - 1 < 0 THEN 0 WHEN toInteger(round({rating} * 2)) - 1 > 9 THEN 9 ELSE toInteger(round({rating} * 2)) - 1 END"
+
+
+def rating_delta(movie, old_rating, new_rating):
+    """
+    Cypher SET clauses folding one rating change into a movie's aggregates.
+
+    The aggregates are read and written in the same SET so Cypher holds the write lock
+    on the movie while reading them, and concurrent updates are not lost.
+
+    :param movie: Variable bound to the Movie node
+    :param old_rating: Expression for the previous rating, null if the rating is new
+    :param new_rating: Expression for the rating being written
+    :return: Cypher fragment
+    """
+    old_bucket = _BUCKET.format(rating=old_rating)
+    new_bucket = _BUCKET.format(rating=new_rating)
+    return f"""
+    SET {movie}.ratingSum = coalesce({movie}.ratingSum, 0.0) + {new_rating} - coalesce({old_rating}, 0.0),
+        {movie}.ratingCount = coalesce({movie}.ratingCount, 0) + CASE WHEN {old_rating} IS NULL THEN 1 ELSE 0 END,
+        {movie}.ratingHist = [i IN range(0, 9) | coalesce({movie}.ratingHist[i], 0)
+            + CASE WHEN i = {new_bucket} THEN 1 ELSE 0 END
+            - CASE WHEN {old_rating} IS NOT NULL AND i = {old_bucket} THEN 1 ELSE 0 END]
+    SET {movie}.avgRating = {movie}.ratingSum / {movie}.ratingCount
+    """
+
+
+REBUILD_MOVIE_STATS = f"""
+MATCH (m:Movie)
+WHERE m.movieId >= $from_id AND m.movieId < $to_id
+OPTIONAL MATCH (m)<-[r:RATED]-()
+WITH m, collect(r.rating) AS ratings
+WITH m, ratings, reduce(total = 0.0, rating IN ratings | total + rating) AS total
+SET m.ratingSum = total,
+    m.ratingCount = size(ratings),
+    m.ratingHist = [i IN range(0, 9) | size([rating IN ratings WHERE {_BUCKET.format(rating='rating')} = i])],
+    m.avgRating = CASE WHEN size(ratings) > 0 THEN total / size(ratings) ELSE null END
+RETURN count(m) AS movies
+"""
+
+
+def rebuild_movie_stats(connection, batch_size=1000):
+    """
+    Recompute the aggregates of every movie from its RATED relationships.
+
+    Movies are processed in movieId ranges of `batch_size`, one transaction per range.
+
+    :param connection: Neo4jConnection instance
+    :param batch_size: Width of each movieId range
+    :return: Number of movies updated
+    """
+    start = time.perf_counter()
+    with connection.session() as session:
+        bounds = session.run("MATCH (m:Movie) RETURN min(m.movieId) AS low, max(m.movieId) AS high").single()
+        if bounds is None or bounds["low"] is None:
+            return 0
+        updated = 0
+        for from_id in range(bounds["low"], bounds["high"] + 1, batch_size):
+            updated += session.execute_write(
+                lambda tx: tx.run(REBUILD_MOVIE_STATS, from_id=from_id, to_id=from_id + batch_size).single()["movies"]
+            )
+    logger.info(f"Rebuilt rating aggregates of {updated} movies in {time.perf_counter() - start:.1f}s.")
+    return updated
+
+
+if __name__ == '__main__':
+    import argparse
+    from .utils import get_connection, close_connection
+
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Rebuild the per-movie rating aggregates from the RATED relationships.")
+    parser.add_argument('--batch-size', type=int, default=1000)
+    args = parser.parse_args()
+
+    rebuild_movie_stats(get_connection(), args.batch_size)
+    close_connection()
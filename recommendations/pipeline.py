@@ -0,0 +1,305 @@
+from .metrics import stage
+from .similarity import get_similar_users_async
+from .utils import get_users_top_ratings_async
+import asyncio
+import logging
+import os
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Most candidates a generator may hand to the ranking stage.
+DEFAULT_CANDIDATE_CAP = int(os.getenv('HYBRID_CANDIDATE_CAP', 200))
+
+# Most ratings read of each neighbour, highest first.
+DEFAULT_NEIGHBOUR_RATINGS = int(os.getenv('HYBRID_NEIGHBOUR_RATINGS', 100))
+
+FUSIONS = ("weighted", "rrf")
+
+# Weight of every signal in the fused score; "predicted" is the factor model's rating.
+DEFAULT_WEIGHTS = {"predicted": 1.0, "collaborative": 0.5, "content": 0.5}
+
+# Constant of reciprocal rank fusion, damping the lead of the very first ranks.
+RRF_K = 60
+
+
+class Candidates:
+    """
+    Movies proposed by one generator, with the generator's own score of each (higher is better).
+    """
+
+    def __init__(self, movie_ids, scores):
+        self.movie_ids = np.asarray(movie_ids, dtype=np.int64)
+        self.scores = np.asarray(scores, dtype=np.float64)
+
+    @classmethod
+    def empty(cls):
+        return cls(np.zeros(0, dtype=np.int64), np.zeros(0))
+
+    def __len__(self):
+        return len(self.movie_ids)
+
+
+def top_candidates(movie_ids, scores, cap):
+    """
+    Keep the `cap` best-scored movies, ties broken by movie ID.
+
+    :param movie_ids: Array of distinct movie IDs
+    :param scores: Array of scores, aligned with `movie_ids`
+    :param cap: Number of candidates to keep
+    :return: Candidates, best first
+    """
+    if len(movie_ids) > cap:
+        # Partition first, so only the kept candidates are sorted.
+        kept = np.argpartition(-scores, cap - 1)[:cap]
+        movie_ids, scores = movie_ids[kept], scores[kept]
+    order = np.lexsort((movie_ids, -scores))
+    return Candidates(movie_ids[order], scores[order])
+
+
+class CandidateGenerator:
+    """
+    First stage of the hybrid pipeline: propose at most `cap` movies for a user.
+
+    Generators run concurrently within the request's latency budget and share its
+    UserContext. Subclasses set `name`, which is also the name of their signal in the
+    fused score, and implement `generate`. An async-native generator may also implement
+    `generate_async(connection, user_id, user_ratings)`; otherwise the async recommender
+    runs `generate` in a worker thread.
+    """
+
+    name = None
+
+    def __init__(self, cap=DEFAULT_CANDIDATE_CAP):
+        """
+        :param cap: Most candidates to return
+        """
+        self.cap = cap
+
+    def generate(self, user_id, context):
+        """
+        :param user_id: Target user ID
+        :param context: UserContext of the request
+        :return: Candidates, never more than `cap`, excluding movies the user rated
+        """
+        raise NotImplementedError
+
+
+class NeighbourCandidates(CandidateGenerator):
+    """
+    Movies rated by the user's nearest neighbours, scored by the similarity-weighted sum of
+    the neighbours' ratings.
+
+    Only the `neighbour_ratings` highest ratings of each neighbour are read, capped in the
+    query, so the cost of a request does not grow with how much its neighbours rated.
+    """
+
+    name = "collaborative"
+
+    def __init__(self, collaborative_filtering, cap=DEFAULT_CANDIDATE_CAP, neighbours=10,
+                 neighbour_ratings=DEFAULT_NEIGHBOUR_RATINGS):
+        """
+        :param collaborative_filtering: CollaborativeFiltering instance
+        :param cap: Most candidates to return
+        :param neighbours: Number of similar users to read
+        :param neighbour_ratings: Most ratings read of each neighbour
+        """
+        super().__init__(cap)
+        self.collaborative_filtering = collaborative_filtering
+        self.neighbours = neighbours
+        self.neighbour_ratings = neighbour_ratings
+
+    def generate(self, user_id, context):
+        user_ratings = context.ratings
+        if not user_ratings:
+            return Candidates.empty()
+        with stage("collaborative.find_similar_users"):
+            similar_users = self.collaborative_filtering.find_similar_users(
+                user_id, user_ratings, self.neighbours, context=context)
+        with stage("collaborative.similar_ratings"):
+            users_ratings = context.users_top_ratings(
+                [similar_user_id for similar_user_id, _ in similar_users], self.neighbour_ratings)
+        return self.score(user_ratings, similar_users, [users_ratings[similar_user_id] for similar_user_id, _ in similar_users])
+
+    async def generate_async(self, connection, user_id, user_ratings):
+        """
+        Async counterpart of generate, reading neighbours and their ratings through an AsyncNeo4jConnection.
+        """
+        if not user_ratings:
+            return Candidates.empty()
+        cf = self.collaborative_filtering
+        with stage("collaborative.find_similar_users"):
+            similar_users = await get_similar_users_async(connection, user_id, self.neighbours) if cf.similar_edges else []
+            if not similar_users:
+                similar_users = await asyncio.to_thread(cf.find_similar_users, user_id, user_ratings, self.neighbours)
+        with stage("collaborative.similar_ratings"):
+            users_ratings = await get_users_top_ratings_async(
+                connection, [similar_user_id for similar_user_id, _ in similar_users], self.neighbour_ratings)
+        similar_ratings = [users_ratings.get(similar_user_id, []) for similar_user_id, _ in similar_users]
+        return await asyncio.to_thread(self.score, user_ratings, similar_users, similar_ratings)
+
+    def score(self, user_ratings, similar_users, similar_ratings):
+        """
+        :param user_ratings: Ratings of the target user, whose movies are excluded
+        :param similar_users: List of tuples (similar_user_id, similarity_score)
+        :param similar_ratings: Ratings of each similar user, in the same order
+        :return: Candidates
+        """
+        with stage("collaborative.candidates"):
+            sizes = [len(ratings) for ratings in similar_ratings]
+            if not sum(sizes):
+                return Candidates.empty()
+            movie_ids = np.fromiter((movie_id for ratings in similar_ratings for movie_id, _ in ratings),
+                                    dtype=np.int64, count=sum(sizes))
+            ratings = np.fromiter((rating for ratings in similar_ratings for _, rating in ratings),
+                                  dtype=np.float64, count=sum(sizes))
+            similarity = np.repeat(np.asarray([score for _, score in similar_users], dtype=np.float64), sizes)
+
+            candidates, inverse = np.unique(movie_ids, return_inverse=True)
+            support = np.bincount(inverse, weights=similarity * ratings, minlength=len(candidates))
+            keep = (support > 0) & ~np.isin(candidates, [movie_id for movie_id, _ in user_ratings])
+            return top_candidates(candidates[keep], support[keep], self.cap)
+
+
+class GenreCandidates(CandidateGenerator):
+    """
+    Unrated movies sharing genres with the user's high-rated movies, scored by the number
+    of shared genres.
+    """
+
+    name = "content"
+
+    def __init__(self, content_based_filtering, cap=DEFAULT_CANDIDATE_CAP):
+        """
+        :param content_based_filtering: ContentBasedFiltering instance
+        :param cap: Most candidates to return
+        """
+        super().__init__(cap)
+        self.content_based_filtering = content_based_filtering
+
+    def generate(self, user_id, context):
+        return self.score(context.ratings)
+
+    async def generate_async(self, connection, user_id, user_ratings):
+        return await asyncio.to_thread(self.score, user_ratings)
+
+    def score(self, user_ratings):
+        """
+        :param user_ratings: Ratings of the target user
+        :return: Candidates
+        """
+        threshold = self.content_based_filtering.high_rating_threshold
+        high_rated_movies = [movie_id for movie_id, rating in user_ratings if rating >= threshold]
+        if not high_rated_movies:
+            return Candidates.empty()
+        with stage("content.candidates"):
+            movie_ids, overlap = self.content_based_filtering.genre_index.similar_movie_scores(
+                high_rated_movies, exclude_ids=[movie_id for movie_id, _ in user_ratings], limit=self.cap)
+        return Candidates(movie_ids, overlap)
+
+
+def parse_weights(text):
+    """
+    Parse signal weights such as "predicted=1,collaborative=0.5,content=0.5".
+
+    :return: Dictionary of signal name -> weight
+    :raises ValueError: On a malformed entry
+    """
+    weights = {}
+    for entry in filter(None, (part.strip() for part in text.split(","))):
+        name, separator, value = entry.partition("=")
+        if not separator or not name.strip():
+            raise ValueError(f"Invalid fusion weight: {entry!r}")
+        weights[name.strip()] = float(value)
+    return weights
+
+
+class Ranker:
+    """
+    Second stage of the hybrid pipeline: score the merged candidates of all generators in
+    one pass.
+
+    The candidates are merged into one sorted ID array, every signal (each generator's
+    score, plus the factor model's predicted rating of every candidate, computed in a single
+    product) becomes a row of a signal matrix, and the rows are fused into one score:
+
+    - `weighted`: the weighted sum of the signals, each scaled to [0, 1]; a generator that
+      did not propose a movie contributes 0
+    - `rrf`: reciprocal rank fusion, the weighted sum of 1 / (RRF_K + rank) over the
+      signals ranking the movie, which needs no score calibration
+    """
+
+    def __init__(self, fusion=None, weights=None):
+        """
+        :param fusion: "weighted" or "rrf", defaults to HYBRID_FUSION or "weighted"
+        :param weights: Dictionary of signal name -> weight, defaults to HYBRID_FUSION_WEIGHTS
+            merged over DEFAULT_WEIGHTS; signals without a weight get 1.0
+        """
+        fusion = fusion or os.getenv('HYBRID_FUSION', 'weighted')
+        if fusion not in FUSIONS:
+            raise ValueError(f"Unknown fusion {fusion!r}, expected one of {', '.join(FUSIONS)}")
+        self.fusion = fusion
+        if weights is None:
+            weights = {**DEFAULT_WEIGHTS, **parse_weights(os.getenv('HYBRID_FUSION_WEIGHTS', ''))}
+        self.weights = weights
+
+    def rank(self, candidate_sets, predict=None, rating_scale=(0.5, 5.0), limit=12):
+        """
+        :param candidate_sets: Dictionary of generator name -> Candidates
+        :param predict: Callable mapping sorted movie IDs to the user's predicted ratings,
+            or None to rank by the generators' scores only
+        :param rating_scale: Tuple (lowest, highest) rating, to scale predicted ratings
+        :param limit: Number of movies to return
+        :return: List of tuples (movieId, fused score, predicted rating or None), best first
+        """
+        candidate_sets = {name: candidates for name, candidates in candidate_sets.items() if len(candidates)}
+        if not candidate_sets:
+            return []
+        movie_ids = np.unique(np.concatenate([candidates.movie_ids for candidates in candidate_sets.values()]))
+
+        names = list(candidate_sets)
+        signals = np.full((len(names) + 1, len(movie_ids)), np.nan)
+        for row, name in enumerate(names):
+            candidates = candidate_sets[name]
+            signals[row, np.searchsorted(movie_ids, candidates.movie_ids)] = candidates.scores
+        predicted = None
+        if predict is not None:
+            names.append("predicted")
+            predicted = np.asarray(predict(movie_ids), dtype=np.float64)
+            signals[-1] = predicted
+        else:
+            signals = signals[:-1]
+        weights = np.asarray([self.weights.get(name, 1.0) for name in names])
+
+        if self.fusion == "rrf":
+            # Rank of every movie within each signal, 1 for the best; missing scores sort last.
+            order = np.argsort(np.where(np.isnan(signals), np.inf, -signals), axis=1, kind="stable")
+            ranks = np.empty_like(order)
+            np.put_along_axis(ranks, order, np.arange(1, len(movie_ids) + 1), axis=1)
+            contributions = np.where(np.isnan(signals), 0.0, 1.0 / (RRF_K + ranks))
+        else:
+            low = np.zeros(len(names))
+            high = np.nanmax(signals, axis=1)
+            if predicted is not None:
+                low[-1], high[-1] = rating_scale
+            span = np.where(high > low, high - low, 1.0)
+            contributions = np.nan_to_num((signals - low[:, None]) / span[:, None], nan=0.0)
+        fused = weights @ contributions
+
+        top = np.lexsort((movie_ids, -fused))[:limit]
+        return [
+            (int(movie_ids[i]), float(fused[i]), float(predicted[i]) if predicted is not None else None)
+            for i in top
+        ]
+
+
+def default_generators(collaborative_filtering, content_based_filtering, cap=DEFAULT_CANDIDATE_CAP):
+    """
+    The collaborative and content generators, each capped at `cap` candidates.
+    """
+    return [
+        NeighbourCandidates(collaborative_filtering, cap),
+        GenreCandidates(content_based_filtering, cap),
+    ]
+
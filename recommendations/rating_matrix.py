@@ -0,0 +1,339 @@
+import logging
+import threading
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Ratings are stored as half-star steps so they fit in a uint8 (0.5 -> 1, 5.0 -> 10).
+RATING_STEPS = 2
+
+
+class RatingMatrix:
+    """
+    In-memory sparse user x item rating matrix.
+
+    Raw user and movie IDs are mapped to dense indices through sorted ID arrays, and
+    ratings are kept twice: row-major (by user) for reading a user's ratings and
+    column-major (by movie) for computing similarities to every user at once. The arrays
+    live in one immutable _RatingArrays, replaced as a whole, and every read takes it once.
+
+    Users whose ratings change after loading are kept in a small overlay and scored
+    separately. Once the overlay is large enough, it is folded back into new arrays on a
+    background thread, so saving ratings never waits on a rebuild.
+    """
+
+    def __init__(self, user_ids, movie_ids, ratings, compact_threshold=1000):
+        """
+        :param user_ids: Sequence of raw user IDs, one per rating
+        :param movie_ids: Sequence of raw movie IDs, one per rating
+        :param ratings: Sequence of ratings
+        :param compact_threshold: Number of overlaid users that triggers a rebuild
+        """
+        self.compact_threshold = compact_threshold
+        self._lock = threading.Lock()
+        self._overlay = {}
+        self._compaction = None
+        self._arrays = _RatingArrays(
+            np.asarray(user_ids, dtype=np.int64),
+            np.asarray(movie_ids, dtype=np.int64),
+            np.asarray(ratings, dtype=np.float64),
+        )
+
+    @classmethod
+    def from_connection(cls, connection, **kwargs):
+        """
+        Load every RATED relationship from the graph into a new matrix. A SnapshotConnection
+        hands over its rating columns directly instead of answering the query record by record.
+
+        :param connection: Neo4jConnection instance
+        :return: RatingMatrix instance
+        """
+        snapshot = getattr(connection, "snapshot", None)
+        if snapshot is not None:
+            ratings = snapshot.ratings
+            matrix = cls(ratings["userId"], ratings["movieId"], ratings["rating"], **kwargs)
+            logger.info(f"Rating matrix loaded from snapshot {snapshot.version}: {matrix.n_users} users, "
+                        f"{matrix.n_movies} movies, {matrix.nnz} ratings.")
+            return matrix
+        query = """
+        MATCH (u:User)-[r:RATED]->(m:Movie)
+        RETURN u.userId AS userId, m.movieId AS movieId, r.rating AS rating
+        """
+        result = connection.query(query) or []
+        user_ids = np.fromiter((record["userId"] for record in result), dtype=np.int64, count=len(result))
+        movie_ids = np.fromiter((record["movieId"] for record in result), dtype=np.int64, count=len(result))
+        ratings = np.fromiter((record["rating"] for record in result), dtype=np.float64, count=len(result))
+        matrix = cls(user_ids, movie_ids, ratings, **kwargs)
+        logger.info(f"Rating matrix loaded: {matrix.n_users} users, {matrix.n_movies} movies, {matrix.nnz} ratings.")
+        return matrix
+
+    @property
+    def arrays(self):
+        """
+        Current _RatingArrays; read it once per operation to see one consistent matrix.
+        """
+        return self._arrays
+
+    @property
+    def user_ids(self):
+        return self._arrays.user_ids
+
+    @property
+    def movie_ids(self):
+        return self._arrays.movie_ids
+
+    @property
+    def n_users(self):
+        return len(self._arrays.user_ids)
+
+    @property
+    def n_movies(self):
+        return len(self._arrays.movie_ids)
+
+    @property
+    def nnz(self):
+        return len(self._arrays.row_values)
+
+    def user_index(self, user_id):
+        """
+        Dense index of a raw user ID, or -1 if the user has no ratings in the matrix.
+        """
+        return self._arrays.user_index(user_id)
+
+    def movie_indices(self, movie_ids):
+        """
+        Dense indices of raw movie IDs, with -1 for movies not in the matrix.
+        """
+        return self._arrays.movie_indices(movie_ids)
+
+    def get_user_ratings(self, user_id):
+        """
+        Ratings of a user as held by the matrix.
+
+        :param user_id: Raw user ID
+        :return: List of tuples (movieId, rating)
+        """
+        with self._lock:
+            if user_id in self._overlay:
+                return list(self._overlay[user_id])
+            arrays = self._arrays
+        index = arrays.user_index(user_id)
+        if index < 0:
+            return []
+        start, end = arrays.user_ptr[index], arrays.user_ptr[index + 1]
+        movies = arrays.movie_ids[arrays.row_movies[start:end]]
+        values = arrays.row_values[start:end] / RATING_STEPS
+        return list(zip(movies.tolist(), values.tolist()))
+
+    def set_user_ratings(self, user_id, ratings):
+        """
+        Replace all ratings of a user, e.g. after their preferences were saved. Starts a
+        background compaction when the overlay reaches `compact_threshold` users.
+
+        :param user_id: Raw user ID
+        :param ratings: List of tuples (movieId, rating)
+        """
+        ratings = [(int(movie_id), float(rating)) for movie_id, rating in ratings]
+        with self._lock:
+            self._overlay[user_id] = ratings
+            if len(self._overlay) < self.compact_threshold or self._compaction is not None:
+                return
+            self._compaction = threading.Thread(target=self._compact_in_background, name="rating-matrix-compaction",
+                                                daemon=True)
+        self._compaction.start()
+
+    def _compact_in_background(self):
+        try:
+            self.compact()
+        except Exception as e:
+            logger.error(f"Rating matrix compaction failed: {e}")
+        finally:
+            with self._lock:
+                self._compaction = None
+
+    def compact(self):
+        """
+        Fold the overlay into new arrays. The rebuild runs on a copy of the overlay without
+        holding the lock; users whose ratings change meanwhile stay in the overlay.
+        """
+        with self._lock:
+            arrays, overlay = self._arrays, dict(self._overlay)
+        if not overlay:
+            return
+        compacted = arrays.merged(overlay)
+        with self._lock:
+            self._arrays = compacted
+            for user_id, ratings in overlay.items():
+                if self._overlay.get(user_id) is ratings:
+                    del self._overlay[user_id]
+        logger.info(f"Rating matrix compacted: {len(compacted.user_ids)} users, {len(compacted.row_values)} ratings.")
+
+    def similarities(self, user_ratings):
+        """
+        Cosine similarity between a rating profile and every user in the matrix.
+
+        Like `calculate_similarity`, both norms are taken over the co-rated movies only.
+
+        :param user_ratings: List of tuples (movieId, rating) of the target user
+        :return: Array of similarities indexed by dense user index
+        """
+        return self._arrays.similarities(user_ratings)
+
+    def most_similar(self, user_id, user_ratings, top_n=10):
+        """
+        Find the users most similar to a rating profile.
+
+        :param user_id: Target user ID, excluded from the result
+        :param user_ratings: List of tuples (movieId, rating) of the target user
+        :param top_n: Number of similar users to return
+        :return: List of tuples (similar_user_id, similarity_score)
+        """
+        from .utils import calculate_similarity
+
+        with self._lock:
+            arrays, overlay = self._arrays, dict(self._overlay)
+
+        similarity = arrays.similarities(user_ratings)
+        excluded = [user_id, *overlay.keys()]
+        for excluded_id in excluded:
+            index = arrays.user_index(excluded_id)
+            if index >= 0:
+                similarity[index] = -np.inf
+
+        candidates = []
+        n_users = len(arrays.user_ids)
+        if top_n > 0 and n_users:
+            k = min(top_n, n_users)
+            top = np.argpartition(-similarity, k - 1)[:k]
+            top = top[np.argsort(-similarity[top], kind="stable")]
+            candidates = [
+                (int(arrays.user_ids[index]), float(similarity[index]))
+                for index in top if np.isfinite(similarity[index])
+            ]
+
+        for other_id, other_ratings in overlay.items():
+            if other_id != user_id and other_ratings:
+                candidates.append((other_id, calculate_similarity(user_ratings, other_ratings)))
+
+        candidates.sort(key=lambda x: x[1], reverse=True)
+        return candidates[:top_n]
+
+
+class _RatingArrays:
+    """
+    Immutable CSR and CSC arrays of a RatingMatrix, swapped in as a whole on compaction.
+    """
+
+    def __init__(self, user_ids, movie_ids, ratings):
+        users, user_index = np.unique(user_ids, return_inverse=True)
+        movies, movie_index = np.unique(movie_ids, return_inverse=True)
+        values = np.clip(np.rint(ratings * RATING_STEPS), 0, 255).astype(np.uint8)
+
+        index_dtype = np.int32 if max(len(users), len(movies)) < 2 ** 31 else np.int64
+        user_index = user_index.astype(index_dtype)
+        movie_index = movie_index.astype(index_dtype)
+
+        # Row-major (CSR) layout, one row per user.
+        row_order = np.lexsort((movie_index, user_index))
+        user_ptr = np.zeros(len(users) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(user_index, minlength=len(users)), out=user_ptr[1:])
+
+        # Column-major (CSC) layout, one column per movie.
+        col_order = np.argsort(movie_index, kind="stable")
+        movie_ptr = np.zeros(len(movies) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(movie_index, minlength=len(movies)), out=movie_ptr[1:])
+
+        self.user_ids = users
+        self.movie_ids = movies
+        self.user_ptr = user_ptr
+        self.row_movies = movie_index[row_order]
+        self.row_values = values[row_order]
+        self.movie_ptr = movie_ptr
+        self.col_users = user_index[col_order]
+        self.col_values = values[col_order]
+
+    def user_index(self, user_id):
+        position = np.searchsorted(self.user_ids, user_id)
+        if position < len(self.user_ids) and self.user_ids[position] == user_id:
+            return int(position)
+        return -1
+
+    def movie_indices(self, movie_ids):
+        movie_ids = np.asarray(movie_ids, dtype=np.int64)
+        if not len(self.movie_ids):
+            return np.full(len(movie_ids), -1, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.movie_ids, movie_ids), len(self.movie_ids) - 1)
+        known = self.movie_ids[positions] == movie_ids
+        return np.where(known, positions, -1)
+
+    def similarities(self, user_ratings):
+        if not user_ratings:
+            return np.zeros(len(self.user_ids))
+        movie_ids, ratings = zip(*user_ratings)
+        positions = self.movie_indices(movie_ids)
+        known = positions >= 0
+        return co_rated_cosine(positions[known], np.asarray(ratings, dtype=np.float64)[known],
+                               self.movie_ptr, self.col_users, self.col_values, len(self.user_ids))
+
+    def merged(self, overlay):
+        """
+        New arrays with the ratings of the overlaid users replaced.
+
+        :param overlay: Dictionary of userId -> list of tuples (movieId, rating)
+        """
+        overlay_ids = np.fromiter(overlay.keys(), dtype=np.int64, count=len(overlay))
+        row_users = self.user_ids[np.repeat(np.arange(len(self.user_ids)), np.diff(self.user_ptr))]
+        keep = ~np.isin(row_users, overlay_ids)
+
+        extra = [(user_id, movie_id, rating) for user_id, ratings in overlay.items() for movie_id, rating in ratings]
+        extra = np.array(extra, dtype=np.float64).reshape(-1, 3)
+
+        return _RatingArrays(
+            np.concatenate([row_users[keep], extra[:, 0].astype(np.int64)]),
+            np.concatenate([self.movie_ids[self.row_movies[keep]], extra[:, 1].astype(np.int64)]),
+            np.concatenate([self.row_values[keep] / RATING_STEPS, extra[:, 2]]),
+        )
+
+
+def co_rated_cosine(positions, target, ptr, members, values, n, min_overlap=1):
+    """
+    Cosine similarity between one sparse vector and every row of a sparse matrix, both
+    norms taken over the co-rated entries only.
+
+    The matrix is given in compressed layout by the columns of the vector's entries:
+    `members[ptr[c]:ptr[c + 1]]` are the rows holding column `c`, with `values` in half-star
+    steps. With the CSC arrays of a RatingMatrix this compares a user to every user; with
+    its CSR arrays it compares a movie to every movie.
+
+    :param positions: Column indices of the vector's entries
+    :param target: Values of the vector's entries
+    :param ptr: Column pointers
+    :param members: Row index of every stored value
+    :param values: Stored values, in half-star steps
+    :param n: Number of rows
+    :param min_overlap: Rows sharing fewer columns with the vector get similarity 0
+    :return: Array of n similarities
+    """
+    starts = ptr[positions]
+    lengths = ptr[positions + 1] - starts
+    total = int(lengths.sum())
+    if total == 0:
+        return np.zeros(n)
+
+    # Gather every (row, value) entry of the vector's columns in one pass.
+    offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(total)
+    rows = members[offsets]
+    others = values[offsets] / RATING_STEPS
+    target = np.repeat(target, lengths)
+
+    numerator = np.bincount(rows, weights=target * others, minlength=n)
+    norm_target = np.bincount(rows, weights=target * target, minlength=n)
+    norm_other = np.bincount(rows, weights=others * others, minlength=n)
+    denominator = np.sqrt(norm_target * norm_other)
+    if min_overlap > 1:
+        denominator[np.bincount(rows, minlength=n) < min_overlap] = 0
+
+    similarity = np.zeros(n)
+    np.divide(numerator, denominator, out=similarity, where=denominator > 0)
+    return similarity
@@ -0,0 +1,353 @@
+import logging
+import os
+import time
+
+import numpy as np
+
+from .rating_matrix import RATING_STEPS, co_rated_cosine
+from .utils import READ_ACCESS
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_K = 20
+
+# Neighbours of a user, if they were computed after the user's ratings last changed.
+SIMILAR_USERS = """
+MATCH (u:User {userId: $user_id})
+WHERE u.similarComputedAt IS NOT NULL AND coalesce(u.ratingsChangedAt, 0) < u.similarComputedAt
+MATCH (u)-[s:SIMILAR]->(v:User)
+RETURN v.userId AS userId, s.score AS score
+ORDER BY score DESC
+LIMIT $top_n
+"""
+
+# Users whose neighbours are missing or older than their ratings.
+STALE_USERS = """
+MATCH (u:User)
+WHERE (u)-[:RATED]->() AND (u.similarComputedAt IS NULL OR coalesce(u.ratingsChangedAt, 0) >= u.similarComputedAt)
+RETURN u.userId AS userId
+"""
+
+# Unix seconds on the database clock, which also stamps rating changes.
+DATABASE_TIME = "RETURN timestamp() / 1000 AS now"
+
+# Replace the SIMILAR edges of a batch of users or movies with freshly computed neighbours.
+# `computedAt` is when the job read the ratings, so ratings changed while it ran stay stale.
+_WRITE_SIMILAR = """
+UNWIND $rows AS row
+MATCH (a:{label} {{{key}: row.id}})
+OPTIONAL MATCH (a)-[old:SIMILAR]->(:{label})
+DELETE old
+WITH DISTINCT a, row
+SET a.similarComputedAt = $computed_at
+WITH a, row
+UNWIND range(0, size(row.neighbours) - 1) AS rank
+MATCH (b:{label} {{{key}: row.neighbours[rank]}})
+CREATE (a)-[:SIMILAR {{score: row.scores[rank], rank: rank, computedAt: $computed_at}}]->(b)
+"""
+WRITE_SIMILAR_USERS = _WRITE_SIMILAR.format(label="User", key="userId")
+WRITE_SIMILAR_MOVIES = _WRITE_SIMILAR.format(label="Movie", key="movieId")
+
+
+def get_similar_users(connection, user_id, top_n=10):
+    """
+    Materialized neighbours of a user, read with one indexed 1-hop traversal.
+
+    :param connection: Neo4jConnection instance
+    :param user_id: User ID
+    :param top_n: Number of neighbours to return
+    :return: List of tuples (similar_user_id, similarity_score); empty if the user's
+        neighbours were never computed or their ratings changed since
+    """
+    result = connection.query(SIMILAR_USERS, parameters={"user_id": user_id, "top_n": top_n}, access_mode=READ_ACCESS)
+    return [(record["userId"], record["score"]) for record in result or []]
+
+
+async def get_similar_users_async(connection, user_id, top_n=10):
+    """
+    Async counterpart of get_similar_users.
+
+    :param connection: AsyncNeo4jConnection instance
+    """
+    result = await connection.query(SIMILAR_USERS, parameters={"user_id": user_id, "top_n": top_n},
+                                    access_mode=READ_ACCESS)
+    return [(record["userId"], record["score"]) for record in result or []]
+
+
+def get_stale_users(connection):
+    """
+    :param connection: Neo4jConnection instance
+    :return: IDs of the users with ratings whose neighbours are missing or out of date
+    """
+    result = connection.query(STALE_USERS, access_mode=READ_ACCESS)
+    return [record["userId"] for record in result]
+
+
+class SharedArrays:
+    """
+    NumPy arrays in shared memory segments, attachable by name from other processes.
+
+    Workers map the same pages instead of receiving pickled copies, whatever the start
+    method, and may write their results straight into output arrays.
+    """
+
+    def __init__(self, arrays):
+        """
+        :param arrays: Dictionary of name -> array (copied in) or (shape, dtype) (zero-filled)
+        """
+        from multiprocessing import shared_memory
+
+        self._segments = []
+        self.arrays = {}
+        self.spec = {}
+        for name, array in arrays.items():
+            shape, dtype = array if isinstance(array, tuple) else (array.shape, array.dtype)
+            dtype = np.dtype(dtype)
+            size = max(int(np.prod(shape)) * dtype.itemsize, 1)
+            segment = shared_memory.SharedMemory(create=True, size=size)
+            self._segments.append(segment)
+            view = np.ndarray(shape, dtype=dtype, buffer=segment.buf)
+            if isinstance(array, tuple):
+                view.fill(0)
+            else:
+                view[...] = array
+            self.arrays[name] = view
+            self.spec[name] = (segment.name, shape, dtype.str)
+
+    @staticmethod
+    def attach(spec):
+        """
+        Map arrays created by another process.
+
+        :param spec: The creator's `spec`
+        :return: Tuple (dictionary of name -> array, segments to keep open while in use)
+        """
+        from multiprocessing import shared_memory
+
+        arrays, segments = {}, []
+        for name, (segment_name, shape, dtype) in spec.items():
+            segment = shared_memory.SharedMemory(name=segment_name)
+            segments.append(segment)
+            arrays[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=segment.buf)
+        return arrays, segments
+
+    def close(self):
+        self.arrays = {}
+        for segment in self._segments:
+            segment.close()
+            segment.unlink()
+        self._segments = []
+
+
+def _matrix_arrays(matrix, kind):
+    """
+    Compressed arrays of a RatingMatrix oriented for the neighbours of `kind` rows:
+    each row's entries, and the transposed layout used to score it against every row.
+    """
+    arrays = matrix.arrays
+    if kind == "users":
+        return {"row_ptr": arrays.user_ptr, "row_columns": arrays.row_movies, "row_values": arrays.row_values,
+                "col_ptr": arrays.movie_ptr, "col_rows": arrays.col_users, "col_values": arrays.col_values}
+    return {"row_ptr": arrays.movie_ptr, "row_columns": arrays.col_users, "row_values": arrays.col_values,
+            "col_ptr": arrays.user_ptr, "col_rows": arrays.row_movies, "col_values": arrays.row_values}
+
+
+def top_neighbours(arrays, row, k, min_overlap=1):
+    """
+    The k rows most similar to one row, by co-rated cosine.
+
+    :param arrays: Arrays from _matrix_arrays
+    :param row: Dense index of the row
+    :param k: Number of neighbours
+    :param min_overlap: Minimum number of co-rated entries of a neighbour
+    :return: Tuple (dense indices, similarities), best first; rows with similarity 0 are left out
+    """
+    start, end = arrays["row_ptr"][row], arrays["row_ptr"][row + 1]
+    n = len(arrays["row_ptr"]) - 1
+    similarity = co_rated_cosine(
+        arrays["row_columns"][start:end].astype(np.int64), arrays["row_values"][start:end] / RATING_STEPS,
+        arrays["col_ptr"], arrays["col_rows"], arrays["col_values"], n, min_overlap,
+    )
+    similarity[row] = 0
+    k = min(k, n)
+    if k <= 0:
+        return np.empty(0, dtype=np.int64), np.empty(0)
+    top = np.argpartition(-similarity, k - 1)[:k]
+    top = top[np.lexsort((top, -similarity[top]))]
+    top = top[similarity[top] > 0]
+    return top, similarity[top]
+
+
+# Shared arrays of the current job, attached once per worker process.
+_worker_arrays = None
+_worker_segments = None
+_worker_options = None
+
+
+def _init_worker(spec, options):
+    global _worker_arrays, _worker_segments, _worker_options
+    _worker_arrays, _worker_segments = SharedArrays.attach(spec)
+    _worker_options = options
+
+
+def _compute_range(bounds):
+    """
+    Compute the neighbours of `rows[start:stop]` into the shared output arrays.
+    """
+    start, stop = bounds
+    arrays, (k, min_overlap) = _worker_arrays, _worker_options
+    for position in range(start, stop):
+        neighbours, scores = top_neighbours(arrays, int(arrays["rows"][position]), k, min_overlap)
+        arrays["neighbours"][position, :len(neighbours)] = neighbours
+        arrays["neighbours"][position, len(neighbours):] = -1
+        arrays["scores"][position, :len(scores)] = scores
+    return stop - start
+
+
+def compute_neighbours(matrix, kind="users", rows=None, k=DEFAULT_K, min_overlap=1, workers=None, chunk_size=512):
+    """
+    Top-k neighbours of many users or movies, sharded across CPU cores.
+
+    The rating matrix and the output arrays live in shared memory: workers attach to them
+    once, score their share of the rows, and write neighbours in place, so neither inputs
+    nor results are pickled.
+
+    :param matrix: RatingMatrix instance
+    :param kind: "users" or "movies"
+    :param rows: Dense indices of the rows to compute, defaults to every row
+    :param k: Neighbours per row
+    :param min_overlap: Minimum number of co-rated entries of a neighbour
+    :param workers: Number of processes, defaults to the CPU count
+    :param chunk_size: Rows per task
+    :return: Tuple (rows, neighbours, scores): neighbours are dense indices, -1 where a row
+        has fewer than k neighbours with a positive similarity
+    """
+    import multiprocessing
+
+    global _worker_arrays, _worker_segments
+    n = matrix.n_users if kind == "users" else matrix.n_movies
+    rows = np.arange(n, dtype=np.int64) if rows is None else np.asarray(rows, dtype=np.int64)
+    arrays = dict(_matrix_arrays(matrix, kind), rows=rows)
+    arrays["neighbours"] = ((len(rows), k), np.int64)
+    arrays["scores"] = ((len(rows), k), np.float32)
+    workers = workers or os.cpu_count()
+    chunks = [(start, min(start + chunk_size, len(rows))) for start in range(0, len(rows), chunk_size)]
+
+    start = time.perf_counter()
+    shared = SharedArrays(arrays)
+    try:
+        options = (k, min_overlap)
+        if workers == 1:
+            _init_worker(shared.spec, options)
+            for chunk in chunks:
+                _compute_range(chunk)
+        else:
+            with multiprocessing.get_context().Pool(workers, initializer=_init_worker,
+                                                    initargs=(shared.spec, options)) as pool:
+                done = 0
+                for count in pool.imap_unordered(_compute_range, chunks):
+                    done += count
+                    if done == len(rows) or done // chunk_size % 20 == 0:
+                        logger.info(f"Computed neighbours of {done}/{len(rows)} {kind}.")
+        neighbours = shared.arrays["neighbours"].copy()
+        scores = shared.arrays["scores"].copy()
+    finally:
+        _worker_arrays = None
+        if _worker_segments:
+            for segment in _worker_segments:
+                segment.close()
+            _worker_segments = None
+        shared.close()
+    elapsed = time.perf_counter() - start
+    logger.info(f"Neighbours of {len(rows)} {kind} computed with {workers} workers in {elapsed:.1f}s "
+                f"({len(rows) / max(elapsed, 1e-9):,.0f} {kind}/sec).")
+    return rows, neighbours, scores
+
+
+def write_similar_edges(connection, kind, ids, neighbour_ids, scores, computed_at, batch_size=500):
+    """
+    Store neighbours as (a)-[:SIMILAR {score, rank, computedAt}]->(b) edges, replacing the
+    previous ones of every written node, in UNWIND batches.
+
+    :param connection: Neo4jConnection instance
+    :param kind: "users" or "movies"
+    :param ids: Raw IDs of the nodes written
+    :param neighbour_ids: Raw IDs of their neighbours, one row per node, -1 for none
+    :param scores: Similarities, one row per node
+    :param computed_at: Unix seconds at which the ratings were read
+    :param batch_size: Nodes per write transaction
+    """
+    query = WRITE_SIMILAR_USERS if kind == "users" else WRITE_SIMILAR_MOVIES
+    ids = np.asarray(ids).tolist()
+    edges = 0
+    with connection.session() as session:
+        for start in range(0, len(ids), batch_size):
+            rows = []
+            for position in range(start, min(start + batch_size, len(ids))):
+                found = neighbour_ids[position] >= 0
+                rows.append({
+                    "id": ids[position],
+                    "neighbours": neighbour_ids[position][found].tolist(),
+                    "scores": [round(float(score), 6) for score in scores[position][found]],
+                })
+                edges += len(rows[-1]["neighbours"])
+            session.execute_write(lambda tx: tx.run(query, rows=rows, computed_at=computed_at).consume())
+    logger.info(f"SIMILAR edges written for {len(ids)} {kind}: {edges} edges.")
+
+
+def materialize(connection, matrix, kind="users", user_ids=None, k=DEFAULT_K, min_overlap=1, workers=None,
+                computed_at=None):
+    """
+    Compute and write the SIMILAR edges of users or movies.
+
+    :param connection: Neo4jConnection instance
+    :param matrix: RatingMatrix loaded from the graph
+    :param kind: "users" or "movies"
+    :param user_ids: For users, the raw IDs to recompute; every user by default
+    :param k: Neighbours per node
+    :param min_overlap: Minimum number of co-rated entries of a neighbour
+    :param workers: Number of processes, defaults to the CPU count
+    :param computed_at: Unix seconds at which the matrix was read, defaults to now
+    :return: Number of nodes written
+    """
+    computed_at = int(time.time()) if computed_at is None else computed_at
+    ids = matrix.user_ids if kind == "users" else matrix.movie_ids
+    rows = None
+    if user_ids is not None:
+        indices = np.array([matrix.user_index(user_id) for user_id in user_ids], dtype=np.int64)
+        rows = indices[indices >= 0]
+    rows, neighbours, scores = compute_neighbours(matrix, kind, rows, k, min_overlap, workers)
+    neighbour_ids = np.where(neighbours >= 0, ids[np.maximum(neighbours, 0)], -1)
+    write_similar_edges(connection, kind, ids[rows], neighbour_ids, scores, computed_at)
+    return len(rows)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from .rating_matrix import RatingMatrix
+    from .utils import close_connection, get_connection
+
+    parser = argparse.ArgumentParser(description="Materialize the top-k most similar users (and movies) as SIMILAR edges.")
+    parser.add_argument('--k', type=int, default=DEFAULT_K, help="neighbours per user or movie")
+    parser.add_argument('--min-overlap', type=int, default=1, help="co-rated movies (or users) required of a neighbour")
+    parser.add_argument('--workers', type=int, default=None, help="processes, defaults to the CPU count")
+    parser.add_argument('--movies', action='store_true', help="also compute movie-to-movie neighbours")
+    parser.add_argument('--incremental', action='store_true',
+                        help="recompute only users whose ratings changed since their neighbours were written")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    connection = get_connection()
+    stale = get_stale_users(connection) if args.incremental else None
+    if stale is not None and not stale:
+        logger.info("No user has stale neighbours.")
+    else:
+        # Read time of the ratings; changes made from here on leave their users stale.
+        computed_at = connection.query(DATABASE_TIME, access_mode=READ_ACCESS)[0]["now"]
+        matrix = RatingMatrix.from_connection(connection)
+        materialize(connection, matrix, "users", stale, args.k, args.min_overlap, args.workers, computed_at)
+        if args.movies:
+            materialize(connection, matrix, "movies", None, args.k, args.min_overlap, args.workers, computed_at)
+    close_connection()
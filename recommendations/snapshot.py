@@ -0,0 +1,497 @@
+import json
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+
+from .factor_model import current_version
+from .stand_in import GraphStandIn
+from .utils import Neo4jConnection, get_catalogue_version
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SNAPSHOT_ROOT = './data/snapshot'
+SNAPSHOT_FORMAT = 1
+
+EXPORT_USERS = """
+MATCH (u:User)
+WHERE u.userId IS NOT NULL
+RETURN u.userId AS userId
+ORDER BY userId
+"""
+
+EXPORT_MOVIES = """
+MATCH (m:Movie)
+WHERE m.movieId IS NOT NULL
+RETURN m.movieId AS movieId, m.title AS title, m.genres AS genres
+ORDER BY movieId
+"""
+
+# Ratings and tags are read in userId ranges and sorted within each range, so the exported
+# columns come out sorted by user without sorting them as a whole.
+EXPORT_RATINGS = """
+MATCH (u:User)-[r:RATED]->(m:Movie)
+WHERE u.userId >= $from_id AND u.userId < $to_id
+RETURN u.userId AS userId, m.movieId AS movieId, r.rating AS rating, coalesce(r.timestamp, 0) AS timestamp
+ORDER BY userId, movieId
+"""
+
+EXPORT_TAGS = """
+MATCH (u:User)-[t:TAGGED]->(m:Movie)
+WHERE u.userId >= $from_id AND u.userId < $to_id AND t.tag IS NOT NULL
+RETURN u.userId AS userId, m.movieId AS movieId, t.tag AS tag, coalesce(t.timestamp, 0) AS timestamp
+ORDER BY userId, movieId, tag
+"""
+
+# Columns of every table, with their little-endian dtype; None marks a UTF-8 string column.
+TABLES = {
+    "users": {"userId": "<i8"},
+    "movies": {"movieId": "<i8", "title": None, "genres": None},
+    "ratings": {"userId": "<i8", "movieId": "<i8", "rating": "<f4", "timestamp": "<i8"},
+    "tags": {"userId": "<i8", "movieId": "<i8", "tag": None, "timestamp": "<i8"},
+}
+
+
+def _read_array(path, dtype, length, mmap):
+    if not length:
+        # An empty file cannot be memory-mapped.
+        return np.zeros(0, dtype=dtype)
+    if mmap:
+        return np.memmap(path, dtype=dtype, mode="r", shape=(length,))
+    return np.fromfile(path, dtype=dtype, count=length)
+
+
+class StringColumn:
+    """
+    Strings stored end to end as UTF-8 bytes, with the offset of each one, as in Arrow's
+    string arrays; both parts can be memory-mapped and a row is decoded only when read.
+    """
+
+    def __init__(self, data, offsets):
+        """
+        :param data: uint8 array of the concatenated UTF-8 bytes
+        :param offsets: int64 array of len(column) + 1 byte offsets, starting at 0
+        """
+        self.data = data
+        self.offsets = offsets
+
+    def __len__(self):
+        return max(len(self.offsets) - 1, 0)
+
+    def __getitem__(self, row):
+        return self.data[self.offsets[row]:self.offsets[row + 1]].tobytes().decode()
+
+    def take(self, rows):
+        return [self[row] for row in rows]
+
+    def tolist(self):
+        data = self.data.tobytes()
+        offsets = self.offsets.tolist()
+        return [data[start:end].decode() for start, end in zip(offsets, offsets[1:])]
+
+
+class _TableWriter:
+    """
+    Appends batches of records to the column files of one table.
+    """
+
+    def __init__(self, directory, table):
+        self.columns = TABLES[table]
+        self.length = 0
+        self._files = {}
+        self._string_ends = {}
+        for name, dtype in self.columns.items():
+            prefix = os.path.join(directory, f"{table}.{name}")
+            if dtype is None:
+                self._files[name] = (open(prefix + ".data", "wb"), open(prefix + ".offsets", "wb"))
+                np.zeros(1, dtype="<i8").tofile(self._files[name][1])
+                self._string_ends[name] = 0
+            else:
+                self._files[name] = open(prefix + ".bin", "wb")
+
+    def append(self, records):
+        for name, dtype in self.columns.items():
+            if dtype is None:
+                encoded = [(record[name] or "").encode() for record in records]
+                data, offsets = self._files[name]
+                ends = self._string_ends[name] + np.cumsum([len(value) for value in encoded], dtype=np.int64)
+                data.write(b"".join(encoded))
+                ends.astype("<i8").tofile(offsets)
+                if len(ends):
+                    self._string_ends[name] = int(ends[-1])
+            else:
+                np.asarray([record[name] for record in records], dtype=dtype).tofile(self._files[name])
+        self.length += len(records)
+
+    def close(self):
+        for files in self._files.values():
+            for file in (files if isinstance(files, tuple) else (files,)):
+                file.close()
+        return self.length
+
+
+def export_snapshot(connection, root=DEFAULT_SNAPSHOT_ROOT, version=None, batch_size=1000):
+    """
+    Export users, movies, ratings and tags as a new snapshot version under `root`, then
+    point `CURRENT` at it.
+
+    Ratings and tags are read in userId ranges of `batch_size` users and appended to the
+    column files as they arrive, so neither side holds all of them at once. Genre likes,
+    SIMILAR edges and movie aggregates are not exported; aggregates are recomputed from the
+    ratings when needed.
+
+    :param connection: Neo4jConnection instance
+    :param root: Directory holding one sub-directory per version
+    :param version: Version name, defaults to the current UTC timestamp
+    :param batch_size: Users per ratings and tags query
+    :return: Path of the version directory
+    """
+    start = time.perf_counter()
+    version = version or time.strftime("%Y%m%dT%H%M%SZ", time.gmtime())
+    directory = os.path.join(root, version)
+    os.makedirs(directory, exist_ok=True)
+    catalogue_version = get_catalogue_version(connection)
+
+    writers = {table: _TableWriter(directory, table) for table in TABLES}
+    try:
+        user_ids = sorted({record["userId"] for record in connection.query(EXPORT_USERS)})
+        writers["users"].append([{"userId": user_id} for user_id in user_ids])
+        writers["movies"].append(connection.query(EXPORT_MOVIES))
+        for offset in range(0, len(user_ids), batch_size):
+            following = offset + batch_size
+            parameters = {
+                "from_id": user_ids[offset],
+                "to_id": user_ids[following] if following < len(user_ids) else user_ids[-1] + 1,
+            }
+            writers["ratings"].append(connection.query(EXPORT_RATINGS, parameters))
+            writers["tags"].append(connection.query(EXPORT_TAGS, parameters))
+            logger.debug(f"Exported ratings and tags of {min(following, len(user_ids))}/{len(user_ids)} users")
+    finally:
+        lengths = {table: writer.close() for table, writer in writers.items()}
+
+    manifest = {
+        "format": SNAPSHOT_FORMAT,
+        "version": version,
+        "exported_at": int(time.time()),
+        "catalogue_version": catalogue_version,
+        "lengths": lengths,
+        "tables": TABLES,
+    }
+    with open(os.path.join(directory, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=2)
+
+    temp_file = os.path.join(root, "CURRENT.tmp")
+    with open(temp_file, "w") as f:
+        f.write(version)
+    os.replace(temp_file, os.path.join(root, "CURRENT"))
+    logger.info(f"Snapshot version {version} exported to {directory} in {time.perf_counter() - start:.1f}s: "
+                f"{lengths['users']} users, {lengths['movies']} movies, {lengths['ratings']} ratings, "
+                f"{lengths['tags']} tags.")
+    return directory
+
+
+class Snapshot:
+    """
+    Users, movies, ratings and tags exported from the graph, one file per column.
+
+    Users and movies are sorted by ID and ratings and tags by user, so a user's rows or a
+    movie's row are found by binary search on a column, which is memory-mapped by default:
+    loading is nearly instant, pages are read from disk on first use, and every process
+    reading the same version shares them through the page cache.
+    """
+
+    def __init__(self, tables, manifest):
+        """
+        :param tables: Dictionary of table name -> dictionary of column name -> array or StringColumn
+        :param manifest: Contents of the version's manifest.json
+        """
+        self.users = tables["users"]
+        self.movies = tables["movies"]
+        self.ratings = tables["ratings"]
+        self.tags = tables["tags"]
+        self.manifest = manifest
+        self._lock = threading.Lock()
+        self._rating_rows = None
+        self._movie_stats = None
+        self._genre_order = None
+
+    @classmethod
+    def load(cls, root=DEFAULT_SNAPSHOT_ROOT, version=None, mmap=True):
+        """
+        Load a version written by `export_snapshot`, by default the one `CURRENT` points at.
+
+        :param root: Directory holding one sub-directory per version
+        :param version: Version name
+        :param mmap: Whether to memory-map the columns instead of reading them into memory
+        :return: Snapshot instance
+        :raises FileNotFoundError: If no snapshot was exported under `root`
+        """
+        version = version or current_version(root)
+        if version is None:
+            raise FileNotFoundError(f"No snapshot under {root}; export one with `python -m recommendations.snapshot`.")
+        directory = os.path.join(root, version)
+        with open(os.path.join(directory, "manifest.json")) as f:
+            manifest = json.load(f)
+        if manifest["format"] != SNAPSHOT_FORMAT:
+            raise ValueError(f"Unsupported snapshot format {manifest['format']} in {directory}")
+
+        tables = {}
+        for table, columns in manifest["tables"].items():
+            length = manifest["lengths"][table]
+            tables[table] = {}
+            for name, dtype in columns.items():
+                prefix = os.path.join(directory, f"{table}.{name}")
+                if dtype is None:
+                    offsets = _read_array(prefix + ".offsets", "<i8", length + 1, mmap)
+                    data = _read_array(prefix + ".data", np.uint8, int(offsets[-1]) if len(offsets) else 0, mmap)
+                    tables[table][name] = StringColumn(data, offsets)
+                else:
+                    tables[table][name] = _read_array(prefix + ".bin", dtype, length, mmap)
+        snapshot = cls(tables, manifest)
+        logger.info(f"Snapshot version {version} loaded{' (memory-mapped)' if mmap else ''}: "
+                    f"{manifest['lengths']['users']} users, {manifest['lengths']['movies']} movies, "
+                    f"{manifest['lengths']['ratings']} ratings.")
+        return snapshot
+
+    @property
+    def version(self):
+        return self.manifest["version"]
+
+    @property
+    def catalogue_version(self):
+        return self.manifest["catalogue_version"]
+
+    def has_user(self, user_id):
+        user_ids = self.users["userId"]
+        position = np.searchsorted(user_ids, user_id)
+        return position < len(user_ids) and user_ids[position] == user_id
+
+    @staticmethod
+    def _user_slice(table, user_id):
+        user_ids = table["userId"]
+        return slice(int(np.searchsorted(user_ids, user_id, side="left")),
+                     int(np.searchsorted(user_ids, user_id, side="right")))
+
+    def user_ratings(self, user_id):
+        """
+        :return: List of tuples (movieId, rating)
+        """
+        rows = self._user_slice(self.ratings, user_id)
+        return list(zip(self.ratings["movieId"][rows].tolist(), self.ratings["rating"][rows].tolist()))
+
+    def user_tag_count(self, user_id):
+        rows = self._user_slice(self.tags, user_id)
+        return rows.stop - rows.start
+
+    def movie_rows(self, movie_ids):
+        """
+        :param movie_ids: Movie IDs
+        :return: Rows of the known movies, in the order given
+        """
+        known = self.movies["movieId"]
+        movie_ids = np.asarray(list(movie_ids), dtype=np.int64)
+        if not len(known) or not len(movie_ids):
+            return np.zeros(0, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(known, movie_ids), len(known) - 1)
+        return positions[known[positions] == movie_ids]
+
+    def movie_record(self, row):
+        return {"movieId": int(self.movies["movieId"][row]), "title": self.movies["title"][row],
+                "genres": self.movies["genres"][row]}
+
+    def rating_movie_rows(self):
+        """
+        Movie row of every rating, computed once; -1 for ratings of unknown movies.
+        """
+        with self._lock:
+            if self._rating_rows is None:
+                known = self.movies["movieId"]
+                movie_ids = self.ratings["movieId"]
+                if len(known):
+                    positions = np.minimum(np.searchsorted(known, movie_ids), len(known) - 1)
+                    self._rating_rows = np.where(known[positions] == movie_ids, positions, -1)
+                else:
+                    self._rating_rows = np.full(len(movie_ids), -1, dtype=np.int64)
+            return self._rating_rows
+
+    def movie_stats(self):
+        """
+        Rating count and average rating of every movie, as the movie aggregates in the graph.
+
+        :return: Tuple of arrays (counts, averages), aligned with the movie rows; averages
+            of unrated movies are NaN
+        """
+        rows = self.rating_movie_rows()
+        with self._lock:
+            if self._movie_stats is None:
+                known = rows >= 0
+                counts = np.bincount(rows[known], minlength=len(self.movies["movieId"]))
+                sums = np.bincount(rows[known], weights=self.ratings["rating"][known].astype(np.float64),
+                                   minlength=len(self.movies["movieId"]))
+                with np.errstate(invalid="ignore", divide="ignore"):
+                    self._movie_stats = counts, np.where(counts > 0, sums / np.maximum(counts, 1), np.nan)
+            return self._movie_stats
+
+    def genre_order(self):
+        """
+        Movie rows ordered by their genres string.
+        """
+        with self._lock:
+            if self._genre_order is None:
+                genres = self.movies["genres"].tolist()
+                self._genre_order = np.asarray(sorted(range(len(genres)), key=genres.__getitem__), dtype=np.int64)
+            return self._genre_order
+
+
+class SnapshotGraph(GraphStandIn):
+    """
+    Driver stand-in answering the read queries of the recommenders from a Snapshot.
+
+    Queries are recognized by their text, as GraphStandIn does. Writes and queries the
+    snapshot cannot answer raise NotImplementedError naming the query.
+    """
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        super().__init__({EXPORT_USERS: self._all_users, EXPORT_MOVIES: self._all_movies})
+
+    # Reads
+
+    def _similar_users(self, parameters, match):
+        # SIMILAR edges are not exported.
+        return []
+
+    def _user_context(self, parameters, match):
+        user_id = parameters["user_id"]
+        if not self.snapshot.has_user(user_id):
+            return []
+        return [{
+            "ratings": [list(rating) for rating in self.snapshot.user_ratings(user_id)],
+            "genre_count": 0,
+            "tag_count": self.snapshot.user_tag_count(user_id),
+            "similar": [],
+        }]
+
+    def _movie_details(self, parameters, match):
+        return [self.snapshot.movie_record(row) for row in self.snapshot.movie_rows(parameters["movie_ids"])]
+
+    def _users_ratings(self, parameters, match):
+        records = []
+        for user_id in parameters["user_ids"]:
+            ratings = self.snapshot.user_ratings(user_id)
+            if ratings:
+                records.append({"userId": user_id, "ratings": [list(rating) for rating in ratings]})
+        return records
+
+    def _users_top_ratings(self, parameters, match):
+        return [
+            dict(record, ratings=sorted(record["ratings"], key=lambda entry: (-entry[1], entry[0]))[:parameters["per_user"]])
+            for record in self._users_ratings(parameters, match)
+        ]
+
+    def _user_ratings(self, parameters, match):
+        return [{"movieId": movie_id, "rating": rating}
+                for movie_id, rating in self.snapshot.user_ratings(parameters["user_id"])]
+
+    def _user_count(self, parameters, match):
+        user_id = parameters["user_id"]
+        count = {
+            "RATED": lambda: len(self.snapshot.user_ratings(user_id)),
+            "LIKES": lambda: 0,
+            "TAGGED": lambda: self.snapshot.user_tag_count(user_id),
+        }[match.group(1)]()
+        return [{match.group(2): count}]
+
+    def _all_users(self, parameters, match):
+        return [{"userId": user_id} for user_id in self.snapshot.users["userId"].tolist()]
+
+    def _all_ratings(self, parameters, match):
+        ratings = self.snapshot.ratings
+        return [{"userId": user_id, "movieId": movie_id, "rating": rating} for user_id, movie_id, rating
+                in zip(ratings["userId"].tolist(), ratings["movieId"].tolist(), ratings["rating"].tolist())]
+
+    def _movie_ratings(self, parameters, match):
+        ratings = self.snapshot.ratings
+        rows = np.flatnonzero(ratings["movieId"] == parameters["movie_id"])
+        return [{"userId": user_id, "rating": rating}
+                for user_id, rating in zip(ratings["userId"][rows].tolist(), ratings["rating"][rows].tolist())]
+
+    def _catalogue_version(self, parameters, match):
+        return [{"version": self.snapshot.catalogue_version}]
+
+    def _all_movies(self, parameters, match):
+        movies = self.snapshot.movies
+        return [{"movieId": movie_id, "title": title, "genres": genres} for movie_id, title, genres
+                in zip(movies["movieId"].tolist(), movies["title"].tolist(), movies["genres"].tolist())]
+
+    def _movie_id_bounds(self, parameters, match):
+        movie_ids = self.snapshot.movies["movieId"]
+        if not len(movie_ids):
+            return [{"low": None, "high": None}]
+        return [{"low": int(movie_ids[0]), "high": int(movie_ids[-1])}]
+
+    def _popular_by_aggregates(self, parameters, match):
+        counts, averages = self.snapshot.movie_stats()
+        rated = np.flatnonzero(counts > 0)
+        top = rated[np.lexsort((-counts[rated], -averages[rated]))[:parameters["limit"]]]
+        return [dict(self.snapshot.movie_record(row), avgRating=float(averages[row]), ratingCount=int(counts[row]))
+                for row in top]
+
+    # Movie aggregates are recomputed from the ratings, so both popularity queries read the same.
+    _popular_by_ratings = _popular_by_aggregates
+
+    def _trending(self, parameters, match):
+        since = int(time.time() * 1000) - 30 * 24 * 60 * 60 * 1000
+        rows = self.snapshot.rating_movie_rows()
+        recent = rows[(self.snapshot.ratings["timestamp"] > since) & (rows >= 0)]
+        counts = np.bincount(recent, minlength=len(self.snapshot.movies["movieId"]))
+        trending = np.flatnonzero(counts)
+        top = trending[np.argsort(-counts[trending], kind="stable")[:parameters["limit"]]]
+        return [dict(self.snapshot.movie_record(row), ratingCount=int(counts[row])) for row in top]
+
+    def _diverse(self, parameters, match):
+        return [self.snapshot.movie_record(row) for row in self.snapshot.genre_order()[:parameters["limit"]]]
+
+
+class SnapshotConnection(Neo4jConnection):
+    """
+    Read-only Neo4jConnection over a Snapshot instead of a Neo4j server, so the recommenders,
+    batch jobs and analysis run without a database. Sessions, `query`, error handling and
+    counters are the ones of Neo4jConnection; writes raise NotImplementedError.
+    """
+
+    def __init__(self, snapshot, database=None):
+        """
+        :param snapshot: Snapshot instance
+        :param database: Ignored, kept for the Neo4jConnection signature
+        """
+        self.snapshot = snapshot
+        super().__init__(None, None, None, database=database)
+
+    @classmethod
+    def load(cls, root=DEFAULT_SNAPSHOT_ROOT, version=None, mmap=True):
+        """
+        Connection over a snapshot version loaded with Snapshot.load.
+        """
+        return cls(Snapshot.load(root, version, mmap))
+
+    def _create_driver(self, uri, auth, config):
+        return SnapshotGraph(self.snapshot)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from .utils import close_connection, get_connection
+
+    parser = argparse.ArgumentParser(description="Export the graph's users, movies, ratings and tags as a columnar snapshot.")
+    parser.add_argument('--output', default=DEFAULT_SNAPSHOT_ROOT, help="snapshot root")
+    parser.add_argument('--version', default=None, help="version name, defaults to the current UTC time")
+    parser.add_argument('--batch-size', type=int, default=1000, help="users per ratings and tags query")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    export_snapshot(get_connection(), args.output, args.version, args.batch_size)
+    close_connection()
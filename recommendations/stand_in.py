@@ -0,0 +1,126 @@
+import contextlib
+import re
+
+from .context import MOVIE_DETAILS, USER_CONTEXT
+from .similarity import SIMILAR_USERS
+from .utils import USERS_TOP_RATINGS
+
+# Read queries every stand-in answers, by handler name. Queries defined as module constants
+# are matched exactly, inline ones by pattern.
+READ_QUERIES = {
+    USER_CONTEXT: "_user_context",
+    MOVIE_DETAILS: "_movie_details",
+    USERS_TOP_RATINGS: "_users_top_ratings",
+    SIMILAR_USERS: "_similar_users",
+}
+
+READ_PATTERNS = [
+    (r"UNWIND \$user_ids AS user_id MATCH \(u:User \{userId: user_id\}\)-\[r:RATED\]->\(m:Movie\) RETURN", "_users_ratings"),
+    (r"^MATCH \(u:User \{userId: \$user_id\}\)-\[r:RATED\]->\(m:Movie\) RETURN m.movieId AS movieId, r.rating AS rating$", "_user_ratings"),
+    (r"^MATCH \(u:User \{userId: \$user_id\}\)-\[:(RATED|LIKES|TAGGED)\]->\(\w+:\w+\) RETURN COUNT\(\*\) AS (\w+)$", "_user_count"),
+    (r"^MATCH \(u:User\)-\[r:RATED\]->\(m:Movie\) RETURN u.userId AS userId, m.movieId AS movieId, r.rating AS rating$", "_all_ratings"),
+    (r"^MATCH \(m:Movie \{movieId: \$movie_id\}\)<-\[r:RATED\]-\(u:User\) RETURN", "_movie_ratings"),
+    (r"^MATCH \(c:Meta \{key: 'catalogue'\}\) RETURN c.version AS version$", "_catalogue_version"),
+    (r"^MATCH \(m:Movie\) RETURN m.movieId AS movieId, m.title AS title, m.genres AS genres$", "_all_movies"),
+    (r"^MATCH \(m:Movie\) RETURN min\(m.movieId\) AS low, max\(m.movieId\) AS high$", "_movie_id_bounds"),
+    (r"WHERE m.avgRating IS NOT NULL .* ORDER BY avgRating DESC, ratingCount DESC LIMIT \$limit$", "_popular_by_aggregates"),
+    (r"AVG\(r.rating\) AS avgRating, COUNT\(r\) AS ratingCount ORDER BY avgRating DESC", "_popular_by_ratings"),
+    (r"WHERE r.timestamp > timestamp\(\) - 30 \* 24 \* 60 \* 60 \* 1000 .* LIMIT \$limit$", "_trending"),
+    (r"ORDER BY m.genres LIMIT \$limit$", "_diverse"),
+]
+
+
+def normalize_query(query):
+    """
+    Query text without comments and with single spaces, as the stand-ins match it.
+    """
+    query = re.sub(r"//[^\n]*", "", query)
+    return " ".join(query.split())
+
+
+class StandInResult(list):
+    """
+    Records of a query, with the parts of the driver's Result API the repo uses.
+    """
+
+    def single(self):
+        return self[0] if self else None
+
+    def consume(self):
+        return None
+
+
+class StandInSession:
+    """
+    Session on a GraphStandIn, with the transaction functions of the neo4j 5 driver API.
+    """
+
+    def __init__(self, graph):
+        self.graph = graph
+
+    def run(self, query, parameters=None, **kwargs):
+        return self.graph.run(query, parameters, **kwargs)
+
+    def execute_write(self, transaction_function, *args, **kwargs):
+        return transaction_function(self, *args, **kwargs)
+
+    execute_read = execute_write
+
+    def close(self):
+        pass
+
+
+class GraphStandIn:
+    """
+    Driver stand-in answering the repo's queries without a Neo4j server, base of
+    SnapshotGraph and the benchmarks' MemoryGraph.
+
+    Queries are recognized by their text, not parsed. Subclasses implement the handlers named
+    in READ_QUERIES and READ_PATTERNS and may register more; a handler takes the query's
+    parameters and its regex match (None for exact queries) and returns a list of record
+    dictionaries. A query no handler answers raises NotImplementedError naming it, which
+    Neo4jConnection.query raises to its caller.
+    """
+
+    def __init__(self, queries=None, patterns=(), lock=None):
+        """
+        :param queries: Dictionary of query constant -> handler, on top of READ_QUERIES
+        :param patterns: List of tuples (regex, handler), tried after READ_PATTERNS
+        :param lock: Lock held while a handler runs, or None for handlers safe to run concurrently
+        """
+        self._lock = lock if lock is not None else contextlib.nullcontext()
+        self._exact = {normalize_query(query): getattr(self, name) for query, name in READ_QUERIES.items()}
+        self._exact.update((normalize_query(query), handler) for query, handler in (queries or {}).items())
+        self._patterns = [(re.compile(pattern), getattr(self, name)) for pattern, name in READ_PATTERNS]
+        self._patterns += [(re.compile(pattern), handler) for pattern, handler in patterns]
+
+    # Driver interface used by Neo4jConnection
+
+    def session(self, **config):
+        return StandInSession(self)
+
+    def close(self):
+        pass
+
+    def run(self, query, parameters=None, **kwargs):
+        """
+        Answer one query.
+
+        :param query: Cypher query text
+        :param parameters: Query parameters, also accepted as keyword arguments
+        :return: StandInResult of dictionaries keyed like the query's RETURN clause
+        :raises NotImplementedError: If no handler answers the query
+        """
+        parameters = dict(parameters or {}, **kwargs)
+        text = normalize_query(query)
+        handler, match = self._exact.get(text), None
+        if handler is None:
+            for pattern, candidate in self._patterns:
+                match = pattern.search(text)
+                if match:
+                    handler = candidate
+                    break
+        if handler is None:
+            raise NotImplementedError(f"{type(self).__name__} does not support this query: {text}")
+        with self._lock:
+            return StandInResult(handler(parameters, match))
@@ -1,7 +1,15 @@
-from neo4j import GraphDatabase
+from neo4j import GraphDatabase, READ_ACCESS, WRITE_ACCESS
 import os
 from dotenv import load_dotenv
+from contextlib import asynccontextmanager, contextmanager
+import logging
 import math
+import threading
+import time
+
+from .metrics import record_query
+
+logger = logging.getLogger(__name__)
 
 # Load environment variables from .env file
 load_dotenv()
@@ -12,35 +20,301 @@ username = os.getenv('NEO4J_USERNAME')
 password = os.getenv('NEO4J_PASSWORD')
 database = os.getenv('NEO4J_DATABASE')
 
-class Neo4jConnection:
-    def __init__(self, uri, user, pwd):
-        self.driver = GraphDatabase.driver(uri, auth=(user, pwd))
+# Bumped whenever movies are ingested so in-process catalogue indexes know to reload.
+BUMP_CATALOGUE_VERSION = """
+MERGE (c:Meta {key: 'catalogue'})
+SET c.version = coalesce(c.version, 0) + 1
+"""
+
+# Ratings of many users, at most $per_user of each, highest rated first.
+USERS_TOP_RATINGS = """
+UNWIND $user_ids AS user_id
+CALL {
+    WITH user_id
+    MATCH (u:User {userId: user_id})-[r:RATED]->(m:Movie)
+    RETURN m.movieId AS movieId, r.rating AS rating
+    ORDER BY rating DESC, movieId
+    LIMIT $per_user
+}
+RETURN user_id AS userId, collect([movieId, rating]) AS ratings
+"""
+
+class ConnectionBase:
+    """
+    Driver configuration and session and query counters shared by Neo4jConnection and
+    AsyncNeo4jConnection. Subclasses provide `_create_driver`, `close`, `session` and `query`.
+    """
+
+    def __init__(self, uri, user, pwd, database=None, max_pool_size=None, fetch_size=None, acquisition_timeout=None):
+        """
+        :param uri: Bolt URI of the server
+        :param user: User name
+        :param pwd: Password
+        :param database: Database used when a query does not name one
+        :param max_pool_size: Maximum number of pooled connections
+        :param fetch_size: Records fetched per round trip while streaming results
+        :param acquisition_timeout: Seconds to wait for a pooled connection
+        """
+        config = {}
+        if max_pool_size is not None:
+            config["max_connection_pool_size"] = max_pool_size
+        if acquisition_timeout is not None:
+            config["connection_acquisition_timeout"] = acquisition_timeout
+        self.driver = self._create_driver(uri, (user, pwd), config)
+        self.database = database
+        self.fetch_size = fetch_size
+        self.max_pool_size = max_pool_size
+        self.acquisition_timeout = acquisition_timeout
+        self._stats_lock = threading.Lock()
+        self._stats = {"sessions_opened": 0, "active_sessions": 0, "peak_active_sessions": 0,
+                       "queries": 0, "failed_queries": 0}
+
+    def _create_driver(self, uri, auth, config):
+        raise NotImplementedError
+
+    def _session_config(self, access_mode, db):
+        config = {"database": db or self.database, "default_access_mode": access_mode}
+        if self.fetch_size is not None:
+            config["fetch_size"] = self.fetch_size
+        return config
+
+    def _session_opened(self):
+        with self._stats_lock:
+            self._stats["sessions_opened"] += 1
+            self._stats["active_sessions"] += 1
+            self._stats["peak_active_sessions"] = max(self._stats["peak_active_sessions"], self._stats["active_sessions"])
+
+    def _session_closed(self):
+        with self._stats_lock:
+            self._stats["active_sessions"] -= 1
+
+    def _query_failed(self):
+        with self._stats_lock:
+            self._stats["failed_queries"] += 1
+
+    def _query_done(self):
+        with self._stats_lock:
+            self._stats["queries"] += 1
+
+    def session_stats(self):
+        """
+        Session and query counters kept by this connection, with its pool configuration.
+
+        These count the sessions and queries run through this object; they are not the
+        driver's own pool statistics (idle or in-use Bolt connections).
+        """
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats.update({
+            "database": self.database,
+            "max_pool_size": self.max_pool_size,
+            "fetch_size": self.fetch_size,
+            "acquisition_timeout": self.acquisition_timeout,
+        })
+        return stats
+
+class Neo4jConnection(ConnectionBase):
+    def _create_driver(self, uri, auth, config):
+        return GraphDatabase.driver(uri, auth=auth, **config)
 
     def close(self):
         self.driver.close()
 
-    def query(self, query, parameters=None, db=None):
+    @contextmanager
+    def session(self, access_mode=WRITE_ACCESS, db=None):
+        """
+        Open a session on the shared pool, using the default database unless `db` is given.
+
+        :param access_mode: READ_ACCESS or WRITE_ACCESS, used for routing in a cluster
+        :param db: Database name
+        """
+        session = self.driver.session(**self._session_config(access_mode, db))
+        self._session_opened()
+        try:
+            yield session
+        finally:
+            session.close()
+            self._session_closed()
+
+    def query(self, query, parameters=None, db=None, access_mode=READ_ACCESS):
         """
         Execute a query in the Neo4j database.
-        
+
+        Queries are routed as reads unless `access_mode` says otherwise; writes go through
+        `session` and a transaction function instead.
+
         :param query: Cypher query string
         :param parameters: Parameters for the query
-        :param db: Database name
+        :param db: Database name, defaults to the connection's database
+        :param access_mode: READ_ACCESS (default) or WRITE_ACCESS
         :return: List of records
+        :raises Exception: The driver's error, after it is logged and counted, so a failed
+            read never looks like an empty result
         """
         assert query is not None
-        session = None
         response = None
+        summary = None
+        start = time.perf_counter()
         try:
-            session = self.driver.session(database=db) if db is not None else self.driver.session()
-            response = list(session.run(query, parameters))
+            with self.session(access_mode, db) as session:
+                result = session.run(query, parameters)
+                response = list(result)
+                summary = result.consume()
         except Exception as e:
-            print("Query failed:", e)
+            self._query_failed()
+            logger.error(f"Query failed: {e}")
+            raise
         finally:
-            if session is not None:
-                session.close()
+            self._query_done()
+            record_query(query, time.perf_counter() - start, response, summary, parameters)
         return response
 
+class AsyncNeo4jConnection(ConnectionBase):
+    """
+    Connection on the async driver (neo4j 5 or later), for the ASGI app.
+
+    Sessions and queries are awaited instead of blocking a thread, so many requests can
+    wait on the database at once; counters and configuration work as in Neo4jConnection.
+    """
+
+    def _create_driver(self, uri, auth, config):
+        from neo4j import AsyncGraphDatabase
+
+        return AsyncGraphDatabase.driver(uri, auth=auth, **config)
+
+    async def close(self):
+        await self.driver.close()
+
+    @asynccontextmanager
+    async def session(self, access_mode=WRITE_ACCESS, db=None):
+        session = self.driver.session(**self._session_config(access_mode, db))
+        self._session_opened()
+        try:
+            yield session
+        finally:
+            await session.close()
+            self._session_closed()
+
+    async def query(self, query, parameters=None, db=None, access_mode=READ_ACCESS):
+        assert query is not None
+        response = None
+        summary = None
+        start = time.perf_counter()
+        try:
+            async with self.session(access_mode, db) as session:
+                result = await session.run(query, parameters)
+                response = [record async for record in result]
+                summary = await result.consume()
+        except Exception as e:
+            self._query_failed()
+            logger.error(f"Query failed: {e}")
+            raise
+        finally:
+            self._query_done()
+            record_query(query, time.perf_counter() - start, response, summary, parameters)
+        return response
+
+class CountingConnection:
+    """
+    Wraps a connection and records every query run through it, so tests can assert how many
+    round trips a code path makes, e.g.
+
+        counting = CountingConnection(get_connection())
+        context = UserContext(counting, user_id)
+        recommender.recommend_within_budget(user_id, context=context)
+        assert counting.query_count == 2
+
+    Other attributes are delegated to the wrapped connection.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.queries = []
+        self._lock = threading.Lock()
+
+    def query(self, query, parameters=None, db=None, access_mode=READ_ACCESS):
+        with self._lock:
+            self.queries.append((query, parameters))
+        return self.connection.query(query, parameters=parameters, db=db, access_mode=access_mode)
+
+    @property
+    def query_count(self):
+        return len(self.queries)
+
+    def reset(self):
+        with self._lock:
+            self.queries = []
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+def connection_settings():
+    """
+    Connection arguments from NEO4J_URI, NEO4J_USERNAME, NEO4J_PASSWORD and NEO4J_DATABASE,
+    plus the optional NEO4J_MAX_POOL_SIZE, NEO4J_FETCH_SIZE and NEO4J_ACQUISITION_TIMEOUT.
+
+    :return: Keyword arguments for Neo4jConnection or AsyncNeo4jConnection
+    """
+    def optional(name, cast):
+        value = os.getenv(name)
+        return cast(value) if value else None
+
+    return {
+        "uri": os.getenv('NEO4J_URI'),
+        "user": os.getenv('NEO4J_USERNAME'),
+        "pwd": os.getenv('NEO4J_PASSWORD'),
+        "database": os.getenv('NEO4J_DATABASE'),
+        "max_pool_size": optional('NEO4J_MAX_POOL_SIZE', int),
+        "fetch_size": optional('NEO4J_FETCH_SIZE', int),
+        "acquisition_timeout": optional('NEO4J_ACQUISITION_TIMEOUT', float),
+    }
+
+_connection = None
+_connection_lock = threading.Lock()
+
+def get_connection():
+    """
+    Connection shared by every module of the process, created on first use and
+    configured by `connection_settings`. With GRAPH_SNAPSHOT set to a snapshot root, it
+    is a read-only SnapshotConnection on the current snapshot there instead.
+
+    :return: Neo4jConnection instance
+    """
+    global _connection
+    if _connection is None:
+        with _connection_lock:
+            if _connection is None and os.getenv('GRAPH_SNAPSHOT'):
+                from .snapshot import SnapshotConnection
+
+                logger.info(f"Reading the graph snapshot at {os.getenv('GRAPH_SNAPSHOT')}")
+                _connection = SnapshotConnection.load(os.getenv('GRAPH_SNAPSHOT'))
+            if _connection is None:
+                logger.info(f"Connecting to Neo4j at {os.getenv('NEO4J_URI')} with user {os.getenv('NEO4J_USERNAME')}")
+                _connection = Neo4jConnection(**connection_settings())
+    return _connection
+
+def set_connection(connection):
+    """
+    Replace the shared connection, e.g. with an in-memory stand-in for benchmarks.
+
+    :param connection: Neo4jConnection instance, or None to open a new one on next use
+    :return: The previous shared connection, which is not closed
+    """
+    global _connection
+    with _connection_lock:
+        previous, _connection = _connection, connection
+    return previous
+
+def close_connection():
+    """
+    Close the shared connection, if it was ever opened.
+    """
+    global _connection
+    with _connection_lock:
+        if _connection is not None:
+            _connection.close()
+            _connection = None
+
 # def get_user_ratings(connection, user_id):
 #     """
 #     Retrieve all ratings made by a user and normalize them.
@@ -80,6 +354,87 @@ def get_user_ratings(connection, user_id):
     
     return ratings
 
+def get_users_ratings(connection, user_ids):
+    """
+    Retrieve the ratings of many users in one query.
+
+    :param connection: Neo4jConnection instance
+    :param user_ids: User IDs
+    :return: Dictionary of userId -> list of tuples (movieId, rating); users without ratings are left out
+    """
+    if not user_ids:
+        return {}
+    query = """
+    UNWIND $user_ids AS user_id
+    MATCH (u:User {userId: user_id})-[r:RATED]->(m:Movie)
+    RETURN user_id AS userId, collect([m.movieId, r.rating]) AS ratings
+    """
+    result = connection.query(query, parameters={"user_ids": list(user_ids)}, access_mode=READ_ACCESS)
+    return {record["userId"]: [(movie_id, rating) for movie_id, rating in record["ratings"]] for record in result}
+
+def get_users_top_ratings(connection, user_ids, per_user):
+    """
+    Retrieve the highest ratings of many users in one query, capped per user in the query
+    itself so that prolific raters cost no more than `per_user` rows each.
+
+    :param connection: Neo4jConnection instance
+    :param user_ids: User IDs
+    :param per_user: Most ratings to return per user
+    :return: Dictionary of userId -> list of tuples (movieId, rating), highest rating first;
+             users without ratings are left out
+    """
+    if not user_ids:
+        return {}
+    result = connection.query(USERS_TOP_RATINGS, parameters={"user_ids": list(user_ids), "per_user": per_user})
+    return {record["userId"]: [(movie_id, rating) for movie_id, rating in record["ratings"]] for record in result}
+
+async def get_user_ratings_async(connection, user_id):
+    """
+    Retrieve all ratings made by a user through an AsyncNeo4jConnection.
+
+    :param connection: AsyncNeo4jConnection instance
+    :param user_id: User ID
+    :return: List of tuples (movieId, rating)
+    """
+    query = """
+    MATCH (u:User {userId: $user_id})-[r:RATED]->(m:Movie)
+    RETURN m.movieId AS movieId, r.rating AS rating
+    """
+    result = await connection.query(query, parameters={"user_id": user_id}, access_mode=READ_ACCESS)
+    return [(record["movieId"], record["rating"]) for record in result]
+
+async def get_users_ratings_async(connection, user_ids):
+    """
+    Async counterpart of get_users_ratings.
+
+    :param connection: AsyncNeo4jConnection instance
+    :param user_ids: User IDs
+    :return: Dictionary of userId -> list of tuples (movieId, rating); users without ratings are left out
+    """
+    if not user_ids:
+        return {}
+    query = """
+    UNWIND $user_ids AS user_id
+    MATCH (u:User {userId: user_id})-[r:RATED]->(m:Movie)
+    RETURN user_id AS userId, collect([m.movieId, r.rating]) AS ratings
+    """
+    result = await connection.query(query, parameters={"user_ids": list(user_ids)}, access_mode=READ_ACCESS)
+    return {record["userId"]: [(movie_id, rating) for movie_id, rating in record["ratings"]] for record in result}
+
+async def get_users_top_ratings_async(connection, user_ids, per_user):
+    """
+    Async counterpart of get_users_top_ratings.
+
+    :param connection: AsyncNeo4jConnection instance
+    :param user_ids: User IDs
+    :param per_user: Most ratings to return per user
+    :return: Dictionary of userId -> list of tuples (movieId, rating), highest rating first
+    """
+    if not user_ids:
+        return {}
+    result = await connection.query(USERS_TOP_RATINGS, parameters={"user_ids": list(user_ids), "per_user": per_user})
+    return {record["userId"]: [(movie_id, rating) for movie_id, rating in record["ratings"]] for record in result}
+
 def get_movie_ratings(connection, movie_id):
     """
     Retrieve all ratings for a movie.
@@ -95,6 +450,20 @@ def get_movie_ratings(connection, movie_id):
     result = connection.query(query, parameters={"movie_id": movie_id})
     return [(record["userId"], record["rating"]) for record in result]
 
+def get_catalogue_version(connection):
+    """
+    Retrieve the current catalogue version.
+
+    :param connection: Neo4jConnection instance
+    :return: Catalogue version, or 0 if movies were never ingested with versioning
+    """
+    query = """
+    MATCH (c:Meta {key: 'catalogue'})
+    RETURN c.version AS version
+    """
+    result = connection.query(query)
+    return result[0]["version"] if result else 0
+
 def calculate_similarity(ratings1, ratings2):
     """
     Calculate the cosine similarity between two sets of normalized ratings.
@@ -0,0 +1,59 @@
+import pytest
+
+from benchmarks.memory_graph import InMemoryConnection, MemoryGraph
+from benchmarks.synthetic import SyntheticDataset
+from recommendations.batch import BatchRecommender, PrecomputedRecommendations, precompute_all
+from recommendations.hybrid import HybridRecommender
+from recommendations.train import ALSTrainer, RatingData
+
+
+@pytest.fixture(scope="module")
+def dataset():
+    return SyntheticDataset.generate(300, 200, seed=5)
+
+
+@pytest.fixture
+def recommender(dataset, tmp_path, monkeypatch):
+    ratings = dataset.ratings
+    model, _ = ALSTrainer(n_factors=8, n_epochs=2).fit(
+        RatingData(ratings["userId"], ratings["movieId"], ratings["rating"]))
+    model.save(str(tmp_path))
+    monkeypatch.setenv("MF_MODEL_DIR", str(tmp_path))
+    monkeypatch.setenv("USER_ANN_INDEX", "0")
+    monkeypatch.setenv("SIMILAR_EDGES", "0")
+    hybrid = HybridRecommender(InMemoryConnection(MemoryGraph.from_dataset(dataset)), max_workers=2)
+    yield hybrid
+    hybrid.executor.shutdown()
+
+
+def sample_users(dataset):
+    return sorted({int(user_id) for user_id in dataset.ratings["userId"][:200]})[:8]
+
+
+def test_batch_matches_online_ranking(dataset, recommender):
+    user_ids = sample_users(dataset)
+
+    results = BatchRecommender(recommender).recommend_many(user_ids, limit=10)
+
+    for result in results:
+        online = recommender.recommend_within_budget(result["userId"], limit=10)["recommendations"]
+        assert online
+        assert [rec["movieId"] for rec in result["recommendations"]] == [rec["movieId"] for rec in online]
+        assert [rec["score"] for rec in result["recommendations"]] == pytest.approx([rec["score"] for rec in online])
+        assert ([rec["predictedRating"] for rec in result["recommendations"]]
+                == pytest.approx([rec["predictedRating"] for rec in online]))
+
+
+def test_precomputed_lists_match_online_ranking(dataset, recommender, tmp_path):
+    user_ids = sample_users(dataset)
+    path = str(tmp_path / "precomputed.npz")
+
+    precompute_all(BatchRecommender(recommender), user_ids, limit=10, workers=1).save(path)
+    precomputed = PrecomputedRecommendations.load(path)
+
+    genre_index = recommender.content_based_filtering.genre_index
+    for user_id in user_ids:
+        online = recommender.recommend_within_budget(user_id, limit=10)["recommendations"]
+        served = precomputed.with_details(user_id, genre_index)
+        assert [rec["movieId"] for rec in served] == [rec["movieId"] for rec in online]
+        assert [rec["score"] for rec in served] == pytest.approx([rec["score"] for rec in online], rel=1e-5)
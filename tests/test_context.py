@@ -0,0 +1,82 @@
+import pytest
+
+from benchmarks.memory_graph import InMemoryConnection, MemoryGraph
+from benchmarks.synthetic import SyntheticDataset
+from recommendations.context import UserContext
+from recommendations.hybrid import HybridRecommender
+from recommendations.train import ALSTrainer, RatingData
+from recommendations.utils import CountingConnection
+
+
+@pytest.fixture(scope="module")
+def dataset():
+    return SyntheticDataset.generate(300, 200, seed=3)
+
+
+@pytest.fixture
+def connection(dataset, tmp_path, monkeypatch):
+    ratings = dataset.ratings
+    model, _ = ALSTrainer(n_factors=8, n_epochs=2).fit(
+        RatingData(ratings["userId"], ratings["movieId"], ratings["rating"]))
+    model.save(str(tmp_path))
+    monkeypatch.setenv("MF_MODEL_DIR", str(tmp_path))
+    monkeypatch.setenv("USER_ANN_INDEX", "0")
+    monkeypatch.setenv("SIMILAR_EDGES", "0")
+    return CountingConnection(InMemoryConnection(MemoryGraph.from_dataset(dataset)))
+
+
+@pytest.fixture
+def recommender(connection):
+    hybrid = HybridRecommender(connection, max_workers=2)
+    # The in-memory indexes are loaded once per process, not per request.
+    hybrid.collaborative_filtering.rating_matrix
+    hybrid.content_based_filtering.genre_index
+    connection.reset()
+    yield hybrid
+    hybrid.executor.shutdown()
+
+
+def test_existing_user_costs_two_queries(dataset, connection, recommender):
+    user_id = int(dataset.ratings["userId"][0])
+    context = UserContext(connection, user_id)
+
+    assert not context.is_new_user()
+    result = recommender.recommend_within_budget(user_id, context=context)
+
+    assert result["recommendations"]
+    assert not result["degraded"]
+    # The user's counts, ratings and SIMILAR edges in one read, the neighbours' ratings in one UNWIND.
+    assert connection.query_count == 2
+
+
+def test_new_user_costs_one_query(dataset, connection):
+    context = UserContext(connection, int(dataset.ratings["userId"].max()) + 1)
+
+    assert context.is_new_user()
+    assert context.ratings == []
+    assert connection.query_count == 1
+
+
+def test_reads_are_memoized(dataset, connection):
+    user_id = int(dataset.ratings["userId"][0])
+    context = UserContext(connection, user_id)
+    neighbours = sorted({int(other) for other in dataset.ratings["userId"][:50]} - {user_id})[:5]
+
+    context.counts()
+    first = context.users_ratings(neighbours)
+    second = context.users_ratings(neighbours + [user_id])
+
+    assert second == {**first, user_id: context.ratings}
+    assert connection.query_count == 2
+
+
+def test_failed_read_is_not_a_new_user(dataset, connection, monkeypatch):
+    def unavailable(*args, **kwargs):
+        raise ConnectionError("database unavailable")
+
+    monkeypatch.setattr(connection.connection.graph, "run", unavailable)
+    context = UserContext(connection, int(dataset.ratings["userId"][0]))
+
+    with pytest.raises(ConnectionError):
+        context.is_new_user()
+    assert connection.session_stats()["failed_queries"] == 1
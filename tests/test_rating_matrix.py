@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+
+from recommendations.rating_matrix import RatingMatrix
+from recommendations.utils import calculate_similarity
+
+
+@pytest.fixture
+def ratings():
+    rng = np.random.default_rng(7)
+    by_user = {}
+    for user_id in range(1, 41):
+        movie_ids = rng.choice(np.arange(100, 160), size=int(rng.integers(3, 15)), replace=False)
+        by_user[user_id] = [(int(movie_id), float(rng.integers(1, 11)) / 2) for movie_id in sorted(movie_ids)]
+    return by_user
+
+
+def build(ratings, **kwargs):
+    rows = [(user_id, movie_id, rating) for user_id, user_ratings in ratings.items() for movie_id, rating in user_ratings]
+    user_ids, movie_ids, values = zip(*rows)
+    return RatingMatrix(user_ids, movie_ids, values, **kwargs)
+
+
+def assert_matches_pure_python(matrix, ratings, user_id):
+    expected = {other_id: calculate_similarity(ratings[user_id], other_ratings)
+                for other_id, other_ratings in ratings.items() if other_id != user_id}
+    neighbours = matrix.most_similar(user_id, ratings[user_id], top_n=len(ratings))
+
+    assert dict(neighbours) == pytest.approx(expected)
+    scores = [score for _, score in neighbours]
+    assert scores == sorted(scores, reverse=True)
+
+
+def test_most_similar_matches_calculate_similarity(ratings):
+    matrix = build(ratings)
+
+    for user_id in (1, 17, 40):
+        assert_matches_pure_python(matrix, ratings, user_id)
+        assert matrix.get_user_ratings(user_id) == ratings[user_id]
+
+
+def test_set_user_ratings_before_and_after_compaction(ratings):
+    matrix = build(ratings, compact_threshold=100)
+    ratings[3] = [(100, 5.0), (101, 0.5), (159, 3.5)]
+    ratings[41] = [(100, 4.0), (130, 2.0)]
+    matrix.set_user_ratings(3, ratings[3])
+    matrix.set_user_ratings(41, ratings[41])
+
+    def check():
+        for user_id in (3, 5, 41):
+            assert matrix.get_user_ratings(user_id) == ratings[user_id]
+            assert_matches_pure_python(matrix, ratings, user_id)
+
+    check()
+    matrix.compact()
+    assert matrix.n_users == 41
+    check()
+
+
+def test_compaction_runs_in_the_background(ratings):
+    matrix = build(ratings, compact_threshold=2)
+    ratings[1] = [(120, 4.5)]
+    ratings[2] = [(120, 1.0), (121, 3.0)]
+    matrix.set_user_ratings(1, ratings[1])
+    matrix.set_user_ratings(2, ratings[2])
+
+    compaction = matrix._compaction
+    if compaction is not None:
+        compaction.join()
+
+    assert not matrix._overlay
+    assert matrix.get_user_ratings(2) == ratings[2]
+    assert_matches_pure_python(matrix, ratings, 2)